@@ -63,3 +63,29 @@ from .models_db import Proveedor
 class ProveedorAdmin(admin.ModelAdmin):
     list_display = ("id", "nombre", "telefono", "direccion")
     search_fields = ("nombre", "telefono")
+
+
+# ====== Despacho por zonas ======
+from .models_db import DireccionGeo, Zona
+from .services_rutas import direccion_sha1, normalizar_direccion
+
+@admin.register(Zona)
+class ZonaAdmin(admin.ModelAdmin):
+    list_display = ("id", "nombre", "palabra_clave", "lat", "lng")
+    search_fields = ("nombre", "palabra_clave")
+
+@admin.register(DireccionGeo)
+class DireccionGeoAdmin(admin.ModelAdmin):
+    list_display = ("direccion", "lat", "lng", "actualizado_en")
+    search_fields = ("direccion",)
+    fields = ("direccion", "lat", "lng")
+
+    def get_readonly_fields(self, request, obj=None):
+        # La dirección es la clave: corregirla es cargar otra fila
+        return ("direccion",) if obj else ()
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            obj.direccion = normalizar_direccion(obj.direccion)
+            obj.direccion_sha1 = direccion_sha1(obj.direccion)
+        super().save_model(request, obj, form, change)
@@ -1,10 +1,14 @@
 # accounts/api.py
-from rest_framework import viewsets, status
+from rest_framework import permissions, viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
+from . import services_kardex
 from .models_db import Usuario, Rol, Permiso, UsuarioRol, RolPermiso
+from .permissions import tiene_permiso
 from .serializers import (
+    MovimientosLoteSerializer,
     PermisoSerializer,
     RolListSerializer, RolWriteSerializer,
     UsuarioListSerializer, UsuarioRolesWriteSerializer,
@@ -49,3 +53,35 @@ class UsuarioViewSet(viewsets.ReadOnlyModelViewSet):
             ignore_conflicts=True,
         )
         return Response({"ok": True, "roles": roles_ids})
+
+
+class InventarioWrite(permissions.BasePermission):
+    def has_permission(self, request, view):
+        return bool(request.user and request.user.is_authenticated
+                    and tiene_permiso(request.user, "INVENTARIO_WRITE"))
+
+
+class MovimientosLoteAPI(APIView):
+    """
+    POST {"filas": [{insumo_id, tipo, motivo, cantidad, observacion?}, ...],
+          "fecha"?: ..., "todo_o_nada"?: false}
+    Responde el resultado por fila; 409 si con todo_o_nada alguna falla.
+    """
+    permission_classes = [InventarioWrite]
+
+    def post(self, request):
+        ser = MovimientosLoteSerializer(data=request.data)
+        ser.is_valid(raise_exception=True)
+        data = ser.validated_data
+        resultados = services_kardex.registrar_movimientos(
+            [dict(f) for f in data["filas"]],
+            fecha=data.get("fecha"),
+            todo_o_nada=data["todo_o_nada"],
+        )
+        fallidas = sum(1 for r in resultados if r["error"])
+        codigo = status.HTTP_409_CONFLICT if fallidas and data["todo_o_nada"] else status.HTTP_200_OK
+        return Response({
+            "aplicadas": sum(1 for r in resultados if r["ok"]),
+            "fallidas": fallidas,
+            "filas": resultados,
+        }, status=codigo)
@@ -16,7 +16,9 @@ class MovimientoInventarioForm(forms.Form):
     motivo = forms.ChoiceField(choices=MOTIVOS)
     cantidad = forms.DecimalField(min_value=0.001, max_digits=12, decimal_places=3)
     observacion = forms.CharField(required=False, max_length=200)
-    fecha = forms.DateTimeField(required=False, help_text="Si no envías, uso la fecha/hora actual.")
+    fecha = forms.DateTimeField(required=False, help_text=(
+        "Si no envías, uso la fecha/hora actual. No puede ser futura ni "
+        "anterior al último movimiento del insumo."))
 
     def clean(self):
         data = super().clean()
@@ -31,3 +33,40 @@ class MovimientoInventarioForm(forms.Form):
 
     def get_fecha(self):
         return self.cleaned_data["fecha"] or timezone.now()
+
+
+class MovimientoFilaForm(forms.Form):
+    """Una fila del formulario de movimientos por lote (vacía = se ignora)."""
+    insumo = forms.TypedChoiceField(coerce=int, required=False)
+    tipo = forms.ChoiceField(choices=TIPOS, required=False)
+    motivo = forms.ChoiceField(choices=MOTIVOS, required=False)
+    cantidad = forms.DecimalField(max_digits=12, decimal_places=3, required=False,
+                                  help_text="En AJUSTE es un delta (+/-).")
+    observacion = forms.CharField(required=False, max_length=200)
+
+    def __init__(self, *args, insumos=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        # Opciones armadas una vez para todo el formset (sin consulta por fila)
+        self.fields["insumo"].choices = [("", "—")] + list(insumos)
+
+    def fila(self):
+        d = self.cleaned_data
+        if not d.get("insumo") or d.get("cantidad") in (None, ""):
+            return None
+        return {"insumo_id": d["insumo"], "tipo": d["tipo"], "motivo": d["motivo"],
+                "cantidad": d["cantidad"], "observacion": d.get("observacion") or ""}
+
+
+MovimientoLoteFormSet = forms.formset_factory(MovimientoFilaForm, extra=0)
+
+
+class MovimientoLoteForm(forms.Form):
+    fecha = forms.DateTimeField(required=False, help_text=(
+        "Si no envías, uso la fecha/hora actual. No puede ser futura ni "
+        "anterior al último movimiento del insumo."))
+    todo_o_nada = forms.BooleanField(required=False, label="Todo o nada")
+
+
+class ConteoInventarioForm(forms.Form):
+    archivo = forms.FileField(help_text="CSV con columnas insumo_id (o insumo) y cantidad contada.")
+    fecha = forms.DateTimeField(required=False, help_text="Fecha del conteo; si no envías, la actual.")
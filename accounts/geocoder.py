@@ -0,0 +1,47 @@
+# accounts/geocoder.py
+"""
+Geocoders para `manage.py geocodificar_direcciones`.
+
+Un geocoder es cualquier callable `(direccion) -> (lat, lng) | None`; el
+comando usa el de DESPACHO_GEOCODER (ruta con puntos). `nominatim` consulta
+OpenStreetMap respetando su política de uso: una consulta por segundo y un
+User-Agent propio.
+"""
+import logging
+import time
+
+import requests
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+PAUSA_S = 1.0
+
+_ultima = 0.0
+
+
+def nominatim(direccion: str):
+    global _ultima
+    ciudad = getattr(settings, "DESPACHO_CIUDAD", "") or ""
+    espera = _ultima + PAUSA_S - time.monotonic()
+    if espera > 0:
+        time.sleep(espera)
+    try:
+        resp = requests.get(
+            getattr(settings, "NOMINATIM_URL", NOMINATIM_URL),
+            params={"q": f"{direccion}, {ciudad}" if ciudad else direccion,
+                    "format": "jsonv2", "limit": 1},
+            headers={"User-Agent": getattr(settings, "NOMINATIM_USER_AGENT", "panaderia-despacho")},
+            timeout=10,
+        )
+        resp.raise_for_status()
+        datos = resp.json()
+    except (requests.RequestException, ValueError) as e:
+        logger.warning("geocoder: no se pudo consultar '%s': %s", direccion, e)
+        return None
+    finally:
+        _ultima = time.monotonic()
+    if not datos:
+        return None
+    return float(datos[0]["lat"]), float(datos[0]["lon"])
@@ -0,0 +1,28 @@
+# accounts/management/commands/auditar_facturas.py
+from django.core.management.base import BaseCommand
+
+from accounts.services_numeracion import HUECO, auditar_huecos, serie_por_defecto
+
+
+class Command(BaseCommand):
+    help = (
+        "Lista los números de factura reservados que no terminaron en una factura "
+        "(HUECO: entregado y no usado; LIBERADO: devuelto al cerrar el proceso; "
+        "PENDIENTE: bloque todavía abierto)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--serie", default=None,
+                            help="Serie a auditar (default: FACTURA_SERIE).")
+
+    def handle(self, *args, **opts):
+        serie = opts["serie"] or serie_por_defecto()
+        faltantes = auditar_huecos(serie)
+        if not faltantes:
+            self.stdout.write(self.style.SUCCESS(f"Serie {serie}: sin huecos."))
+            return
+        for r in faltantes:
+            rango = str(r["desde"]) if r["desde"] == r["hasta"] else f"{r['desde']}-{r['hasta']}"
+            self.stdout.write(f"{r['estado']:<10} {serie} {rango}  ({r['proceso']})")
+        huecos = sum(r["hasta"] - r["desde"] + 1 for r in faltantes if r["estado"] == HUECO)
+        self.stdout.write(self.style.WARNING(f"Serie {serie}: {huecos} número(s) sin factura."))
@@ -0,0 +1,24 @@
+# accounts/management/commands/conciliar_pagos.py
+from django.core.management.base import BaseCommand
+
+from accounts.services_conciliacion import conciliar
+
+
+class Command(BaseCommand):
+    help = (
+        "Concilia los pagos Stripe registrados en `pago` contra las sesiones "
+        "cobradas en Stripe. Incremental: continúa desde el último cursor guardado. "
+        "Las diferencias quedan en la tabla conciliacion_pago."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--hilos", type=int, default=4,
+                            help="Hilos que piden páginas a Stripe en paralelo (default 4).")
+
+    def handle(self, *args, **opts):
+        stats = conciliar(hilos=max(1, opts["hilos"]))
+        self.stdout.write(self.style.SUCCESS(
+            "Sesiones: {sesiones} · conciliadas: {conciliadas} · "
+            "sin pago: {SIN_PAGO} · monto distinto: {MONTO} · "
+            "pedido distinto: {PEDIDO} · sin Stripe: {SIN_STRIPE}".format(**stats)
+        ))
@@ -0,0 +1,20 @@
+# accounts/management/commands/emitir_facturas.py
+from django.core.management.base import BaseCommand
+
+from accounts.services_facturas import emitir_pendientes
+
+
+class Command(BaseCommand):
+    help = (
+        "Emite factura para todos los pedidos totalmente pagados que aún no la "
+        "tienen (NIT 0 y nombre del cliente como razón social). Los PDFs se "
+        "generan en segundo plano."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--serie", default=None,
+                            help="Serie de numeración (default: FACTURA_SERIE).")
+
+    def handle(self, *args, **opts):
+        ids = emitir_pendientes(opts["serie"])
+        self.stdout.write(self.style.SUCCESS(f"Facturas emitidas: {len(ids)}"))
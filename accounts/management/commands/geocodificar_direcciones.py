@@ -0,0 +1,43 @@
+# accounts/management/commands/geocodificar_direcciones.py
+import csv
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from accounts.services_rutas import geocodificar, guardar_coordenadas
+
+
+class Command(BaseCommand):
+    help = (
+        "Llena direccion_geo con las coordenadas de las direcciones de entrega "
+        "en cola que aún no las tienen (geocoder de DESPACHO_GEOCODER), o carga "
+        "un CSV direccion,lat,lng con --csv."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--csv", default=None,
+                            help="Archivo con columnas direccion, lat, lng (no consulta el geocoder).")
+        parser.add_argument("--limite", type=int, default=200,
+                            help="Máximo de direcciones a geocodificar por corrida (default 200).")
+
+    def handle(self, *args, **opts):
+        if opts["csv"]:
+            try:
+                with open(opts["csv"], encoding="utf-8-sig", newline="") as fh:
+                    filas = [(f["direccion"], float(f["lat"]), float(f["lng"]))
+                             for f in csv.DictReader(fh) if (f.get("direccion") or "").strip()]
+            except (OSError, KeyError, ValueError) as e:
+                raise CommandError(f"CSV inválido: {e}")
+            n = guardar_coordenadas(filas)
+            self.stdout.write(self.style.SUCCESS(f"{n} dirección(es) cargadas."))
+            return
+
+        ruta = getattr(settings, "DESPACHO_GEOCODER", "") or ""
+        if not ruta:
+            raise CommandError("DESPACHO_GEOCODER no está configurado; usa --csv o configúralo.")
+        guardadas, sin_resultado = geocodificar(import_string(ruta), limite=max(1, opts["limite"]))
+        for d in sin_resultado:
+            self.stdout.write(self.style.WARNING(f"sin resultado: {d}"))
+        self.stdout.write(self.style.SUCCESS(
+            f"{guardadas} dirección(es) geocodificadas, {len(sin_resultado)} sin resultado."))
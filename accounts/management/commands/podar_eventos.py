@@ -0,0 +1,24 @@
+# accounts/management/commands/podar_eventos.py
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.services_eventos import podar
+
+
+class Command(BaseCommand):
+    help = (
+        "Borra de pedido_evento los eventos más viejos que la retención "
+        "(programar, p. ej. una vez al día). Sólo se reponen eventos recientes "
+        "a clientes SSE que reconectan."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dias", type=int, default=None,
+                            help="Días a conservar (default: EVENTOS_RETENCION_DIAS).")
+
+    def handle(self, *args, **opts):
+        dias = opts["dias"] if opts["dias"] is not None else getattr(settings, "EVENTOS_RETENCION_DIAS", 7)
+        if dias < 1:
+            raise CommandError("--dias debe ser al menos 1.")
+        n = podar(dias)
+        self.stdout.write(self.style.SUCCESS(f"{n} evento(s) anteriores a {dias} día(s) borrados."))
@@ -0,0 +1,17 @@
+# accounts/management/commands/recalcular_reservas.py
+from django.core.management.base import BaseCommand
+
+from accounts.services_reservas import recalcular
+
+
+class Command(BaseCommand):
+    help = (
+        "Borra las reservas de insumos de pedidos que ya no están CONFIRMADO / "
+        "EN_PRODUCCION y rehace insumo.cantidad_reservada desde reserva_insumo."
+    )
+
+    def handle(self, *args, **opts):
+        borradas = recalcular()
+        self.stdout.write(self.style.SUCCESS(
+            f"Reservas recalculadas ({borradas} reserva(s) huérfana(s) borradas)."
+        ))
@@ -0,0 +1,47 @@
+# accounts/management/commands/snapshot_kardex.py
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from accounts.services_kardex import deriva, reconstruir, tomar_snapshots
+
+
+class Command(BaseCommand):
+    help = (
+        "Escribe puntos de control del saldo por kardex (programar, p. ej. cada hora). "
+        "Con --desde/--hasta reconstruye los puntos de fin de día de ese rango."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--desde", default=None, help="YYYY-MM-DD (reconstrucción).")
+        parser.add_argument("--hasta", default=None, help="YYYY-MM-DD (default: hoy).")
+        parser.add_argument("--deriva", action="store_true",
+                            help="Sólo lista insumos cuyo stock no coincide con el último saldo del kardex.")
+
+    def handle(self, *args, **opts):
+        if opts["deriva"]:
+            filas = deriva()
+            for f in filas:
+                self.stdout.write(
+                    f"{f['insumo']}: stock {f['stock']} / kardex {f['saldo_kardex']} "
+                    f"(movimiento #{f['kardex_id']})"
+                )
+            estilo = self.style.WARNING if filas else self.style.SUCCESS
+            self.stdout.write(estilo(f"{len(filas)} insumo(s) con deriva."))
+            return
+        if opts["desde"]:
+            try:
+                desde = date.fromisoformat(opts["desde"])
+                hasta = date.fromisoformat(opts["hasta"]) if opts["hasta"] else timezone.localdate()
+            except ValueError as e:
+                raise CommandError(f"Fecha inválida: {e}")
+            if hasta < desde:
+                raise CommandError("--hasta es anterior a --desde.")
+            n = reconstruir(desde, hasta)
+            self.stdout.write(self.style.SUCCESS(
+                f"Reconstruidos {n} punto(s) de control entre {desde} y {hasta}."
+            ))
+            return
+        n = tomar_snapshots()
+        self.stdout.write(self.style.SUCCESS(f"{n} punto(s) de control nuevos."))
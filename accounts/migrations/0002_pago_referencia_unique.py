@@ -0,0 +1,62 @@
+# Tabla `pago` es managed=False: el índice se aplica con SQL explícito.
+# MySQL admite varios NULL en un índice UNIQUE, así que los pagos manuales
+# sin referencia no se ven afectados.
+#
+# Antes del índice se limpian los duplicados que dejó la confirmación doble
+# de Stripe (misma referencia, mismo pedido): se conserva el pago de menor
+# id y los demás se mueven a `pago_duplicado` para poder revisarlos. Si una
+# referencia aparece en pedidos distintos no es una confirmación repetida:
+# la migración se detiene y lista los casos para resolverlos a mano.
+
+from django.db import migrations
+
+DUPLICADOS = """
+    SELECT referencia, MIN(id) AS conservar
+    FROM pago
+    WHERE referencia IS NOT NULL
+    GROUP BY referencia
+    HAVING COUNT(*) > 1
+"""
+
+
+def deduplicar(apps, schema_editor):
+    with schema_editor.connection.cursor() as cur:
+        cur.execute("""
+            SELECT referencia, GROUP_CONCAT(DISTINCT pedido_id ORDER BY pedido_id)
+            FROM pago
+            WHERE referencia IS NOT NULL
+            GROUP BY referencia
+            HAVING COUNT(DISTINCT pedido_id) > 1
+            LIMIT 50
+        """)
+        conflictos = cur.fetchall()
+        if conflictos:
+            detalle = "; ".join(f"{ref} (pedidos {ids})" for ref, ids in conflictos)
+            raise RuntimeError(
+                "pago.referencia repetida en pedidos distintos; corregir antes de migrar: " + detalle
+            )
+        cur.execute("CREATE TABLE IF NOT EXISTS pago_duplicado LIKE pago")
+        cur.execute(f"""
+            INSERT INTO pago_duplicado
+            SELECT p.* FROM pago p
+            JOIN ({DUPLICADOS}) d ON d.referencia = p.referencia AND p.id <> d.conservar
+        """)
+        cur.execute(f"""
+            DELETE p FROM pago p
+            JOIN ({DUPLICADOS}) d ON d.referencia = p.referencia AND p.id <> d.conservar
+        """)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(deduplicar, migrations.RunPython.noop),
+        migrations.RunSQL(
+            sql="CREATE UNIQUE INDEX ux_pago_referencia ON pago (referencia)",
+            reverse_sql="DROP INDEX ux_pago_referencia ON pago",
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Caché de sesiones de Stripe Checkout abiertas (ver accounts/services_checkout.py).
+# expires_at en epoch (segundos), tal como lo entrega Stripe.
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_pago_referencia_unique'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE checkout_session_cache (
+                    pedido_id   INT          NOT NULL,
+                    saldo_cents BIGINT       NOT NULL,
+                    session_id  VARCHAR(120) NOT NULL,
+                    url         VARCHAR(1000) NOT NULL,
+                    expires_at  BIGINT       NOT NULL,
+                    created_at  DATETIME     NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (pedido_id, saldo_cents),
+                    CONSTRAINT fk_checkout_cache_pedido
+                        FOREIGN KEY (pedido_id) REFERENCES pedido (id) ON DELETE CASCADE
+                )
+            """,
+            reverse_sql="DROP TABLE checkout_session_cache",
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Conciliación de pagos Stripe (ver accounts/services_conciliacion.py).
+# - proceso_cursor: posición guardada de procesos incrementales.
+# - conciliacion_pago: diferencias detectadas entre `pago` y Stripe.
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_checkout_session_cache'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE proceso_cursor (
+                    nombre         VARCHAR(60) NOT NULL PRIMARY KEY,
+                    valor          BIGINT      NOT NULL,
+                    actualizado_en DATETIME    NOT NULL DEFAULT CURRENT_TIMESTAMP
+                                               ON UPDATE CURRENT_TIMESTAMP
+                )
+            """,
+            reverse_sql="DROP TABLE proceso_cursor",
+        ),
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE conciliacion_pago (
+                    id           BIGINT AUTO_INCREMENT PRIMARY KEY,
+                    referencia   VARCHAR(120)  NOT NULL,
+                    tipo         VARCHAR(20)   NOT NULL,
+                    pedido_id    INT           NULL,
+                    pago_id      INT           NULL,
+                    monto_stripe DECIMAL(12,2) NULL,
+                    monto_pago   DECIMAL(12,2) NULL,
+                    detectado_en DATETIME      NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE KEY ux_conciliacion_ref_tipo (referencia, tipo),
+                    KEY ix_conciliacion_detectado (detectado_en)
+                )
+            """,
+            reverse_sql="DROP TABLE conciliacion_pago",
+        ),
+    ]
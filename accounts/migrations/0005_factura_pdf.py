@@ -0,0 +1,26 @@
+# PDF de facturas guardado en disco por contenido (ver accounts/services_facturas.py).
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0004_conciliacion_pagos'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE factura_pdf (
+                    factura_id   INT      NOT NULL PRIMARY KEY,
+                    sha256       CHAR(64) NOT NULL,
+                    bytes        INT      NOT NULL,
+                    generado_en  DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    CONSTRAINT fk_factura_pdf_factura
+                        FOREIGN KEY (factura_id) REFERENCES factura (id) ON DELETE CASCADE
+                )
+            """,
+            reverse_sql="DROP TABLE factura_pdf",
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Numeración fiscal de facturas por serie (ver accounts/services_numeracion.py).
+# - factura_serie: contador por serie (p.ej. una por punto de venta).
+# - factura_bloque: bloques de números reservados por cada proceso, para auditar huecos.
+# - factura.serie / factura.numero: número asignado; las facturas "F-<pedido_id>"
+#   existentes quedan en la serie F y el contador arranca después de ellas.
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0005_factura_pdf'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE factura_serie (
+                    serie      VARCHAR(20) NOT NULL PRIMARY KEY,
+                    siguiente  BIGINT      NOT NULL DEFAULT 1,
+                    bloque     INT         NOT NULL DEFAULT 50
+                )
+            """,
+            reverse_sql="DROP TABLE factura_serie",
+        ),
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE factura_bloque (
+                    id            BIGINT AUTO_INCREMENT PRIMARY KEY,
+                    serie         VARCHAR(20)  NOT NULL,
+                    desde         BIGINT       NOT NULL,
+                    hasta         BIGINT       NOT NULL,
+                    proceso       VARCHAR(120) NOT NULL,
+                    reservado_en  DATETIME     NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    liberado_en   DATETIME     NULL,
+                    usado_hasta   BIGINT       NULL,
+                    KEY ix_factura_bloque_serie (serie, desde)
+                )
+            """,
+            reverse_sql="DROP TABLE factura_bloque",
+        ),
+        migrations.RunSQL(
+            sql="""
+                ALTER TABLE factura
+                    ADD COLUMN serie  VARCHAR(20) NULL,
+                    ADD COLUMN numero BIGINT      NULL,
+                    ADD UNIQUE KEY ux_factura_serie_numero (serie, numero)
+            """,
+            reverse_sql="""
+                ALTER TABLE factura
+                    DROP INDEX ux_factura_serie_numero,
+                    DROP COLUMN numero,
+                    DROP COLUMN serie
+            """,
+        ),
+        migrations.RunSQL(
+            sql=[
+                "UPDATE factura SET serie = 'F', numero = pedido_id "
+                "WHERE nro = CONCAT('F-', pedido_id)",
+                "INSERT INTO factura_serie (serie, siguiente) "
+                "SELECT 'F', COALESCE(MAX(numero), 0) + 1 FROM factura WHERE serie = 'F'",
+            ],
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
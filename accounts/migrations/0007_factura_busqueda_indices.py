@@ -0,0 +1,24 @@
+# Índices para la búsqueda de facturas (ver views_facturas.factura_list).
+# - factura(fecha, id): rangos por fecha y paginación keyset en el mismo orden.
+# - cliente.nombre: FULLTEXT con parser ngram (encuentra subcadenas del nombre).
+# nro y usuario.email ya son UNIQUE, así que sus búsquedas por prefijo usan ese índice.
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0006_factura_serie'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="CREATE INDEX ix_factura_fecha_id ON factura (fecha, id)",
+            reverse_sql="DROP INDEX ix_factura_fecha_id ON factura",
+        ),
+        migrations.RunSQL(
+            sql="ALTER TABLE cliente ADD FULLTEXT INDEX ft_cliente_nombre (nombre) WITH PARSER ngram",
+            reverse_sql="ALTER TABLE cliente DROP INDEX ft_cliente_nombre",
+        ),
+    ]
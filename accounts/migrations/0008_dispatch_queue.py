@@ -0,0 +1,38 @@
+# Cola de despacho mantenida en cada transacción (ver accounts/services_despacho.py).
+# Se llena una vez con los pedidos que hoy cumplen la precondición de CU24.
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0007_factura_busqueda_indices'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE dispatch_queue (
+                    pedido_id    INT      NOT NULL PRIMARY KEY,
+                    listo_desde  DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    CONSTRAINT fk_dispatch_queue_pedido
+                        FOREIGN KEY (pedido_id) REFERENCES pedido (id) ON DELETE CASCADE
+                )
+            """,
+            reverse_sql="DROP TABLE dispatch_queue",
+        ),
+        migrations.RunSQL(
+            sql="""
+                INSERT INTO dispatch_queue (pedido_id)
+                SELECT p.id
+                FROM pedido p
+                LEFT JOIN envio e ON e.pedido_id = p.id
+                WHERE e.id IS NULL
+                  AND p.estado = 'CONFIRMADO'
+                  AND (SELECT COALESCE(SUM(pg.monto), 0) FROM pago pg
+                       WHERE pg.pedido_id = p.id) >= p.total
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,77 @@
+# Rutas de despacho por zona (ver accounts/services_rutas.py).
+# - zona: tabla local de zonas; `palabra_clave` se busca en direccion_entrega.
+# - direccion_geo: coordenadas cacheadas por dirección normalizada (sha1).
+# - despacho_ruta: un repartidor asignado a un grupo de pedidos DELIVERY.
+# - envio.ruta_id / envio.orden: parada dentro de la ruta.
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0008_dispatch_queue'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE zona (
+                    id             INT AUTO_INCREMENT PRIMARY KEY,
+                    nombre         VARCHAR(80)   NOT NULL,
+                    palabra_clave  VARCHAR(80)   NOT NULL,
+                    lat            DECIMAL(9,6)  NULL,
+                    lng            DECIMAL(9,6)  NULL,
+                    UNIQUE KEY ux_zona_palabra_clave (palabra_clave)
+                )
+            """,
+            reverse_sql="DROP TABLE zona",
+        ),
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE direccion_geo (
+                    direccion_sha1  CHAR(40)      NOT NULL PRIMARY KEY,
+                    direccion       VARCHAR(200)  NOT NULL,
+                    lat             DECIMAL(9,6)  NOT NULL,
+                    lng             DECIMAL(9,6)  NOT NULL,
+                    actualizado_en  DATETIME      NOT NULL DEFAULT CURRENT_TIMESTAMP
+                                                  ON UPDATE CURRENT_TIMESTAMP
+                )
+            """,
+            reverse_sql="DROP TABLE direccion_geo",
+        ),
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE despacho_ruta (
+                    id                   BIGINT AUTO_INCREMENT PRIMARY KEY,
+                    zona_id              INT          NULL,
+                    nombre_repartidor    VARCHAR(120) NOT NULL,
+                    telefono_repartidor  VARCHAR(40)  NULL,
+                    estado               VARCHAR(9)   NOT NULL DEFAULT 'ABIERTA',
+                    creada_en            DATETIME     NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    cerrada_en           DATETIME     NULL,
+                    KEY ix_despacho_ruta_estado (estado, id),
+                    CONSTRAINT fk_despacho_ruta_zona
+                        FOREIGN KEY (zona_id) REFERENCES zona (id) ON DELETE SET NULL
+                )
+            """,
+            reverse_sql="DROP TABLE despacho_ruta",
+        ),
+        migrations.RunSQL(
+            sql="""
+                ALTER TABLE envio
+                    ADD COLUMN ruta_id BIGINT NULL,
+                    ADD COLUMN orden   INT    NULL,
+                    ADD KEY ix_envio_ruta (ruta_id, orden),
+                    ADD CONSTRAINT fk_envio_ruta
+                        FOREIGN KEY (ruta_id) REFERENCES despacho_ruta (id) ON DELETE SET NULL
+            """,
+            reverse_sql="""
+                ALTER TABLE envio
+                    DROP FOREIGN KEY fk_envio_ruta,
+                    DROP INDEX ix_envio_ruta,
+                    DROP COLUMN orden,
+                    DROP COLUMN ruta_id
+            """,
+        ),
+    ]
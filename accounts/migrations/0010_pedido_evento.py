@@ -0,0 +1,30 @@
+# Eventos de pedido para el stream SSE (ver accounts/services_eventos.py).
+# Con varios workers, cada uno lee aquí los eventos publicados por los demás.
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0009_despacho_rutas'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE pedido_evento (
+                    id            BIGINT AUTO_INCREMENT PRIMARY KEY,
+                    pedido_id     INT          NOT NULL,
+                    cliente_id    INT          NOT NULL,
+                    tipo          VARCHAR(10)  NOT NULL,
+                    estado        VARCHAR(20)  NULL,
+                    estado_envio  VARCHAR(9)   NULL,
+                    origen        VARCHAR(120) NOT NULL,
+                    creado_en     DATETIME     NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    KEY ix_pedido_evento_creado (creado_en)
+                )
+            """,
+            reverse_sql="DROP TABLE pedido_evento",
+        ),
+    ]
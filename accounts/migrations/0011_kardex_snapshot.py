@@ -0,0 +1,30 @@
+# Puntos de control del saldo por kardex (ver accounts/services_kardex.py).
+# Cada fila es el saldo de un insumo sumando todos sus movimientos con
+# id <= hasta_id; el stock actual es el último punto + los movimientos
+# posteriores (el índice de kardex.insumo_id ya incluye el id en InnoDB).
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0010_pedido_evento'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE kardex_snapshot (
+                    insumo_id  INT           NOT NULL,
+                    hasta_id   BIGINT        NOT NULL,
+                    saldo      DECIMAL(14,3) NOT NULL,
+                    corte      DATETIME      NOT NULL,
+                    creado_en  DATETIME      NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (insumo_id, hasta_id),
+                    KEY ix_kardex_snapshot_corte (corte)
+                )
+            """,
+            reverse_sql="DROP TABLE kardex_snapshot",
+        ),
+    ]
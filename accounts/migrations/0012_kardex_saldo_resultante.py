@@ -0,0 +1,49 @@
+# Saldo del insumo después de cada movimiento (ver services_kardex.registrar_movimiento).
+# Se escribe bajo el mismo lock de fila que actualiza insumo.cantidad_disponible.
+# El histórico se rellena anclado al stock actual: saldo de una fila =
+# stock actual - movimientos posteriores a ella.
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0011_kardex_snapshot'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+                ALTER TABLE kardex
+                    ADD COLUMN saldo_resultante DECIMAL(14,3) NULL,
+                    ADD KEY ix_kardex_insumo_fecha (insumo_id, fecha, id)
+            """,
+            reverse_sql="""
+                ALTER TABLE kardex
+                    DROP KEY ix_kardex_insumo_fecha,
+                    DROP COLUMN saldo_resultante
+            """,
+        ),
+        migrations.RunSQL(
+            sql="""
+                UPDATE kardex k
+                JOIN (
+                    SELECT x.id,
+                           x.stock - (SUM(x.signo) OVER (PARTITION BY x.insumo_id)
+                                      - SUM(x.signo) OVER (PARTITION BY x.insumo_id ORDER BY x.id))
+                             AS saldo
+                    FROM (
+                        SELECT k2.id, k2.insumo_id, i.cantidad_disponible AS stock,
+                               CASE WHEN k2.tipo = 'SALIDA' THEN -k2.cantidad
+                                    WHEN k2.tipo IN ('ENTRADA', 'AJUSTE') THEN k2.cantidad
+                                    ELSE 0 END AS signo
+                        FROM kardex k2
+                        JOIN insumo i ON i.id = k2.insumo_id
+                    ) x
+                ) s ON s.id = k.id
+                SET k.saldo_resultante = s.saldo
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Reservas de insumos de pedidos confirmados (ver accounts/services_reservas.py).
+# insumo.cantidad_reservada es la suma de reserva_insumo por insumo, mantenida
+# bajo el lock de la fila del insumo; disponible para prometer =
+# cantidad_disponible - cantidad_reservada. Se siembra con los pedidos que
+# ya están CONFIRMADO / EN_PRODUCCION.
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0012_kardex_saldo_resultante'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE reserva_insumo (
+                    pedido_id  INT           NOT NULL,
+                    insumo_id  INT           NOT NULL,
+                    cantidad   DECIMAL(14,3) NOT NULL,
+                    creado_en  DATETIME      NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (pedido_id, insumo_id),
+                    KEY ix_reserva_insumo_insumo (insumo_id)
+                )
+            """,
+            reverse_sql="DROP TABLE reserva_insumo",
+        ),
+        migrations.RunSQL(
+            sql="ALTER TABLE insumo ADD COLUMN cantidad_reservada DECIMAL(14,3) NOT NULL DEFAULT 0",
+            reverse_sql="ALTER TABLE insumo DROP COLUMN cantidad_reservada",
+        ),
+        migrations.RunSQL(
+            sql=[
+                """
+                INSERT INTO reserva_insumo (pedido_id, insumo_id, cantidad)
+                SELECT dp.pedido_id, r.insumo_id, SUM(r.cantidad * dp.cantidad)
+                FROM detalle_pedido dp
+                JOIN pedido p ON p.id = dp.pedido_id
+                JOIN receta r ON r.producto_id = dp.producto_id
+                WHERE p.estado IN ('CONFIRMADO', 'EN_PRODUCCION')
+                GROUP BY dp.pedido_id, r.insumo_id
+                """,
+                """
+                UPDATE insumo i
+                JOIN (
+                    SELECT insumo_id, SUM(cantidad) AS reservado
+                    FROM reserva_insumo GROUP BY insumo_id
+                ) x ON x.insumo_id = i.id
+                SET i.cantidad_reservada = x.reservado
+                """,
+            ],
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
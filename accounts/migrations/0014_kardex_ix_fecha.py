@@ -0,0 +1,18 @@
+# Índice para el listado general del kardex por keyset (fecha, id).
+# El filtrado por insumo ya usa ix_kardex_insumo_fecha (insumo_id, fecha, id) de 0012.
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0013_reserva_insumo'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="ALTER TABLE kardex ADD KEY ix_kardex_fecha (fecha, id)",
+            reverse_sql="ALTER TABLE kardex DROP KEY ix_kardex_fecha",
+        ),
+    ]
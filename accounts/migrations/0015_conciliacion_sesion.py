@@ -0,0 +1,26 @@
+# Sesiones pagadas de Stripe vistas por la conciliación (ver
+# accounts/services_conciliacion.py). Reemplaza el set en memoria de la
+# corrida: los pagos nuevos se cruzan con un anti-join y las filas fuera
+# de la ventana de solape se podan al final de cada corrida.
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0014_kardex_ix_fecha'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE conciliacion_sesion (
+                    referencia VARCHAR(120) NOT NULL PRIMARY KEY,
+                    created    BIGINT       NOT NULL,
+                    KEY ix_conciliacion_sesion_created (created)
+                )
+            """,
+            reverse_sql="DROP TABLE conciliacion_sesion",
+        ),
+    ]
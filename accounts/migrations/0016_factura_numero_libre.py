@@ -0,0 +1,27 @@
+# Números de factura devueltos por transacciones que no confirmaron y que
+# el proceso no alcanzó a reutilizar antes de terminar (ver
+# accounts/services_numeracion.py). La auditoría los informa como
+# LIBERADO en vez de HUECO.
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0015_conciliacion_sesion'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE factura_numero_libre (
+                    serie       VARCHAR(20) NOT NULL,
+                    numero      BIGINT      NOT NULL,
+                    liberado_en DATETIME    NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (serie, numero)
+                )
+            """,
+            reverse_sql="DROP TABLE factura_numero_libre",
+        ),
+    ]
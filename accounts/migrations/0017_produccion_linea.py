@@ -0,0 +1,27 @@
+# Líneas de pedido ya producidas una por una desde gestionar_produccion
+# (ver accounts/services_produccion.py): "Producir todo" las saltea para no
+# descontar dos veces sus insumos.
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0016_factura_numero_libre'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+                CREATE TABLE produccion_linea (
+                    pedido_id    INT      NOT NULL,
+                    producto_id  INT      NOT NULL,
+                    sabor_id     INT      NOT NULL,
+                    producido_en DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (pedido_id, producto_id, sabor_id)
+                )
+            """,
+            reverse_sql="DROP TABLE produccion_linea",
+        ),
+    ]
@@ -334,6 +334,44 @@ class Envio(models.Model):
         db_table = 'envio'
 
 
+# ============================
+# Despacho por zonas (ver services_rutas)
+# ============================
+class Zona(models.Model):
+    id = models.AutoField(primary_key=True)
+    nombre = models.CharField(max_length=80)
+    palabra_clave = models.CharField(
+        max_length=80, unique=True,
+        help_text="Texto que se busca en la dirección de entrega (sin distinguir mayúsculas ni tildes).",
+    )
+    lat = models.DecimalField(max_digits=9, decimal_places=6, blank=True, null=True)
+    lng = models.DecimalField(max_digits=9, decimal_places=6, blank=True, null=True)
+
+    class Meta:
+        managed = False
+        db_table = 'zona'
+        ordering = ['nombre']
+
+    def __str__(self):
+        return self.nombre
+
+
+class DireccionGeo(models.Model):
+    # sha1 de la dirección normalizada (services_rutas.normalizar_direccion)
+    direccion_sha1 = models.CharField(primary_key=True, max_length=40)
+    direccion = models.CharField(max_length=200)
+    lat = models.DecimalField(max_digits=9, decimal_places=6)
+    lng = models.DecimalField(max_digits=9, decimal_places=6)
+    actualizado_en = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        managed = False
+        db_table = 'direccion_geo'
+
+    def __str__(self):
+        return self.direccion
+
+
 class Factura(models.Model):
     pedido = models.OneToOneField(Pedido, models.DO_NOTHING)
     nro = models.CharField(unique=True, max_length=60)
@@ -341,10 +379,13 @@ class Factura(models.Model):
     nit_cliente = models.CharField(max_length=60)
     razon_social = models.CharField(max_length=200)
     total = models.DecimalField(max_digits=12, decimal_places=2)
+    serie = models.CharField(max_length=20, blank=True, null=True)
+    numero = models.BigIntegerField(blank=True, null=True)
 
     class Meta:
         managed = False
         db_table = 'factura'
+        unique_together = (('serie', 'numero'),)
 
 
 class Calificacion(models.Model):
@@ -369,6 +410,8 @@ class Insumo(models.Model):
     nombre = models.CharField(max_length=120, unique=True)
     unidad_medida = models.CharField(max_length=10, choices=UNIDADES)
     cantidad_disponible = models.DecimalField(max_digits=12, decimal_places=3, default=0)
+    # Suma de reserva_insumo (ver services_reservas); no se edita a mano
+    cantidad_reservada = models.DecimalField(max_digits=14, decimal_places=3, default=0, editable=False)
     fecha_actualizacion = models.DateTimeField(auto_now=True, editable=False)
 
     class Meta:
@@ -387,6 +430,7 @@ class Kardex(models.Model):
     motivo = models.CharField(max_length=7)  # COMPRA/CONSUMO/AJUSTE
     cantidad = models.DecimalField(max_digits=12, decimal_places=3)
     observacion = models.CharField(max_length=200, blank=True, null=True)
+    saldo_resultante = models.DecimalField(max_digits=14, decimal_places=3, blank=True, null=True)
 
     class Meta:
         managed = False
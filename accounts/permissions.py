@@ -13,6 +13,18 @@ from .models_db import Usuario, UsuarioRol, RolPermiso, Pedido
 # -------------------------------------------------
 # Permisos por código (lo que ya tenías)
 # -------------------------------------------------
+def tiene_permiso(user, codigo_permiso) -> bool:
+    email = (getattr(user, "email", "") or "").lower()
+    try:
+        u = Usuario.objects.get(email=email)
+    except Usuario.DoesNotExist:
+        return False
+    return RolPermiso.objects.filter(
+        rol__in=UsuarioRol.objects.filter(usuario=u).values("rol"),
+        permiso__codigo=codigo_permiso,
+    ).exists()
+
+
 def requiere_permiso(codigo_permiso):
     def wrapper(view):
         def inner(request, *args, **kwargs):
@@ -21,17 +33,7 @@ def requiere_permiso(codigo_permiso):
                 from django.contrib.auth.views import redirect_to_login
                 return redirect_to_login(request.get_full_path())
 
-            email = (request.user.email or "").lower()
-            try:
-                u = Usuario.objects.get(email=email)
-                tiene = RolPermiso.objects.filter(
-                    rol__in=UsuarioRol.objects.filter(usuario=u).values("rol"),
-                    permiso__codigo=codigo_permiso,
-                ).exists()
-            except Usuario.DoesNotExist:
-                tiene = False
-
-            if not tiene:
+            if not tiene_permiso(request.user, codigo_permiso):
                 raise PermissionDenied("No tienes permiso.")
             return view(request, *args, **kwargs)
         return inner
@@ -67,3 +67,18 @@ class UsuarioRolesWriteSerializer(serializers.Serializer):
         child=serializers.IntegerField(min_value=1),
         allow_empty=True
     )
+
+
+# ---------- Inventario: movimientos por lote ----------
+class MovimientoFilaSerializer(serializers.Serializer):
+    insumo_id = serializers.IntegerField(min_value=1)
+    tipo = serializers.ChoiceField(choices=["ENTRADA", "SALIDA", "AJUSTE"])
+    motivo = serializers.ChoiceField(choices=["COMPRA", "CONSUMO", "AJUSTE"])
+    cantidad = serializers.DecimalField(max_digits=12, decimal_places=3)
+    observacion = serializers.CharField(max_length=200, required=False, allow_blank=True)
+
+
+class MovimientosLoteSerializer(serializers.Serializer):
+    filas = MovimientoFilaSerializer(many=True, allow_empty=False)
+    fecha = serializers.DateTimeField(required=False)
+    todo_o_nada = serializers.BooleanField(required=False, default=False)
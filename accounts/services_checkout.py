@@ -0,0 +1,125 @@
+# accounts/services_checkout.py
+"""
+Reutilización de sesiones de Stripe Checkout por (pedido, saldo en centavos).
+
+Tabla `checkout_session_cache`, compartida por todos los workers, con un
+diccionario en memoria por proceso delante:
+
+- Un acierto en memoria se confía sin consultar nada hasta que la sesión
+  esté por expirar o pasen VERIFICAR_S segundos desde que se verificó.
+- Una entrada que sólo está en la tabla (la guardó otro worker, o la de
+  memoria ya es vieja) se consulta una vez en Stripe: se reutiliza si
+  sigue `open` y sin pagar; si no, se descarta.
+- Se invalida explícitamente cuando entra un pago o cambia el total del
+  pedido. En los demás workers la copia en memoria puede durar hasta
+  VERIFICAR_S, pero el saldo es parte de la clave: un pago o un total
+  nuevo cambian el saldo y nunca se redirige a una sesión con otro monto.
+"""
+import logging
+import threading
+import time
+
+import stripe
+from django.db import connection
+
+from .stripe_service import get_client
+
+logger = logging.getLogger(__name__)
+
+# No reutilizar sesiones a punto de expirar
+MARGEN_EXPIRACION_S = 300
+VERIFICAR_S = 60
+_MAX_MEMORIA = 2000
+
+# {(pedido_id, saldo_cents): (session_id, url, expires_at, verificado_en)}
+_memoria: dict[tuple[int, int], tuple[str, str, int, float]] = {}
+_lock = threading.Lock()
+
+
+def obtener_url(pedido_id: int, saldo_cents: int) -> str | None:
+    """URL de una sesión abierta para este pedido y saldo, o None."""
+    ahora = time.time()
+    clave = (pedido_id, saldo_cents)
+    with _lock:
+        hit = _memoria.get(clave)
+    if hit and hit[2] > ahora + MARGEN_EXPIRACION_S and ahora - hit[3] < VERIFICAR_S:
+        return hit[1]
+
+    with connection.cursor() as cur:
+        cur.execute("""
+            SELECT session_id, url, expires_at FROM checkout_session_cache
+            WHERE pedido_id=%s AND saldo_cents=%s
+        """, [pedido_id, saldo_cents])
+        row = cur.fetchone()
+    if not row:
+        _olvidar(lambda k: k == clave)
+        return None
+    session_id, url, expires_at = row
+    if int(expires_at) > ahora + MARGEN_EXPIRACION_S and _sigue_abierta(session_id):
+        _recordar(clave, session_id, url, int(expires_at), ahora)
+        return url
+    _descartar(pedido_id, saldo_cents, session_id)
+    return None
+
+
+def _sigue_abierta(session_id: str) -> bool:
+    """La sesión puede cobrarse todavía (no se pagó ni expiró del lado de Stripe)."""
+    try:
+        ses = get_client().v1.checkout.sessions.retrieve(session_id)
+    except stripe.StripeError as e:
+        logger.warning("checkout: no se pudo consultar %s: %s", session_id, e)
+        return False
+    return ses.status == "open" and ses.payment_status == "unpaid"
+
+
+def _descartar(pedido_id: int, saldo_cents: int, session_id: str):
+    with connection.cursor() as cur:
+        cur.execute("""
+            DELETE FROM checkout_session_cache
+            WHERE pedido_id=%s AND saldo_cents=%s AND session_id=%s
+        """, [pedido_id, saldo_cents, session_id])
+    _olvidar(lambda k: k == (pedido_id, saldo_cents))
+
+
+def guardar(pedido_id: int, saldo_cents: int, session_id: str, url: str, expires_at: int):
+    with connection.cursor() as cur:
+        cur.execute("""
+            REPLACE INTO checkout_session_cache
+              (pedido_id, saldo_cents, session_id, url, expires_at)
+            VALUES (%s, %s, %s, %s, %s)
+        """, [pedido_id, saldo_cents, session_id, url, int(expires_at)])
+    # Recién creada: abierta por definición
+    _recordar((pedido_id, saldo_cents), session_id, url, int(expires_at), time.time())
+
+
+def invalidar(pedido_id: int):
+    """Descarta toda sesión cacheada del pedido (pago registrado o total modificado)."""
+    with connection.cursor() as cur:
+        cur.execute("DELETE FROM checkout_session_cache WHERE pedido_id=%s", [pedido_id])
+    _olvidar(lambda k: k[0] == pedido_id)
+
+
+def invalidar_lote(pedido_ids):
+    """`invalidar()` para muchos pedidos con un solo DELETE."""
+    ids = {int(i) for i in pedido_ids}
+    if not ids:
+        return
+    marks = ",".join(["%s"] * len(ids))
+    with connection.cursor() as cur:
+        cur.execute(f"DELETE FROM checkout_session_cache WHERE pedido_id IN ({marks})", sorted(ids))
+    _olvidar(lambda k: k[0] in ids)
+
+
+def _recordar(clave, session_id: str, url: str, expires_at: int, verificado_en: float):
+    with _lock:
+        if len(_memoria) >= _MAX_MEMORIA:
+            ahora = time.time()
+            for k in [k for k, v in _memoria.items() if v[2] <= ahora] or list(_memoria):
+                del _memoria[k]
+        _memoria[clave] = (session_id, url, expires_at, verificado_en)
+
+
+def _olvidar(cond):
+    with _lock:
+        for k in [k for k in _memoria if cond(k)]:
+            del _memoria[k]
@@ -1,8 +1,8 @@
 # accounts/services_compras.py
 from django.db import transaction
-from django.db.models import F
 from django.utils import timezone
-from .models_db import Compra, CompraDetalle, Insumo, Kardex
+from .models_db import Compra, CompraDetalle
+from .services_kardex import registrar_movimiento
 
 @transaction.atomic
 def recepcionar_compra(compra_id: int) -> int:
@@ -25,21 +25,10 @@ def recepcionar_compra(compra_id: int) -> int:
         Compra.objects.filter(pk=compra.id).update(total=total)
 
     movs = 0
-    for d in detalles:
-        ins = Insumo.objects.select_for_update().get(pk=d.insumo_id)
-        # Sumar stock
-        Insumo.objects.filter(pk=ins.pk).update(
-            cantidad_disponible=F("cantidad_disponible") + d.cantidad
-        )
-        # Kardex
-        Kardex.objects.create(
-            insumo=ins,
-            fecha=timezone.now(),
-            tipo="ENTRADA",
-            motivo="COMPRA",
-            cantidad=d.cantidad,
-            observacion=f"Compra #{compra.id}"
-        )
+    for d in sorted(detalles, key=lambda d: d.insumo_id):  # locks en orden de id
+        # Suma stock y escribe el kardex con su saldo, bajo el lock del insumo
+        registrar_movimiento(d.insumo_id, "ENTRADA", "COMPRA", d.cantidad,
+                             f"Compra #{compra.id}")
         movs += 1
 
     Compra.objects.filter(pk=compra.id).update(
@@ -0,0 +1,234 @@
+# accounts/services_conciliacion.py
+"""
+Conciliación de pagos Stripe contra la tabla `pago`.
+
+`pago.referencia` guarda el id de la Checkout Session, así que el libro
+del procesador que se recorre son las sesiones completadas de Stripe.
+
+- El rango [cursor - SOLAPE, ahora) se parte en `hilos * VENTANAS_POR_HILO`
+  ventanas por `created` y cada ventana se pagina en un hilo del pool (la
+  paginación de Stripe es secuencial dentro de una ventana, no entre ellas).
+- Las páginas llegan por una cola acotada: en memoria sólo hay unas
+  pocas páginas a la vez, sin importar cuántas sesiones tenga la corrida.
+- Cada página se cruza con `pago` en un único SELECT ... IN sobre el
+  índice único ux_pago_referencia, y sus ids se anotan en
+  `conciliacion_sesion` (clave única por referencia). Los pagos nuevos se
+  cruzan contra esa tabla con un anti-join; al final se podan las sesiones
+  que ya quedaron fuera de la ventana de solape.
+- Las diferencias se escriben en `conciliacion_pago` (INSERT IGNORE, así
+  las ventanas solapadas no duplican hallazgos).
+"""
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.db import connection
+
+from .stripe_service import get_client
+from .utils import guardar_cursor, leer_cursor
+
+CURSOR_CREATED = "conciliacion.stripe_created"
+CURSOR_PAGO = "conciliacion.pago_id"
+
+# Una sesión vive como máximo 24 h: el pago puede registrarse hasta un día
+# después de creada, así que se relee ese tramo en cada corrida.
+SOLAPE_S = 24 * 3600
+VENTANAS_POR_HILO = 4
+PAGINA = 100
+CHUNK_PAGOS = 1000
+
+SIN_PAGO = "SIN_PAGO"        # Stripe cobró, no hay fila en pago
+SIN_STRIPE = "SIN_STRIPE"    # fila en pago sin sesión pagada en Stripe
+MONTO = "MONTO"              # montos distintos
+PEDIDO = "PEDIDO"            # metadata.pedido_id distinto de pago.pedido_id
+
+_FIN = object()
+
+
+def _ventanas(desde: int, hasta: int, n: int):
+    paso = max(1, -(-(hasta - desde) // n))
+    t = desde
+    while t < hasta:
+        yield t, min(t + paso, hasta)
+        t += paso
+
+
+def _plano(ses) -> tuple:
+    meta = ses.get("metadata") or {}
+    pid = meta.get("pedido_id")
+    return (
+        ses["id"],
+        ses.get("payment_status"),
+        Decimal(int(ses.get("amount_total") or 0)) / Decimal("100"),
+        int(pid) if pid and str(pid).isdigit() else None,
+        int(ses.get("created") or 0),
+    )
+
+
+def _encolar(cola: queue.Queue, item, parar: threading.Event) -> bool:
+    """put() que se rinde si el consumidor abandonó la corrida."""
+    while not parar.is_set():
+        try:
+            cola.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _paginar_ventana(client, desde: int, hasta: int, cola: queue.Queue, parar: threading.Event):
+    try:
+        params = {"status": "complete", "limit": PAGINA,
+                  "created": {"gte": desde, "lt": hasta}}
+        while not parar.is_set():
+            page = client.v1.checkout.sessions.list(params=params)
+            if page.data and not _encolar(cola, [_plano(s) for s in page.data], parar):
+                return
+            if not page.has_more or not page.data:
+                break
+            params["starting_after"] = page.data[-1]["id"]
+    except Exception as e:
+        _encolar(cola, e, parar)
+    finally:
+        _encolar(cola, _FIN, parar)
+
+
+def _stream_sesiones(client, desde: int, hasta: int, hilos: int):
+    """Genera páginas de sesiones; las ventanas se piden en paralelo."""
+    ventanas = list(_ventanas(desde, hasta, hilos * VENTANAS_POR_HILO))
+    cola: queue.Queue = queue.Queue(maxsize=hilos * 2)
+    pendientes = len(ventanas)
+
+    parar = threading.Event()
+
+    with ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="conciliar") as pool:
+        for a, b in ventanas:
+            pool.submit(_paginar_ventana, client, a, b, cola, parar)
+        try:
+            error = None
+            while pendientes:
+                item = cola.get()
+                if item is _FIN:
+                    pendientes -= 1
+                elif isinstance(item, Exception):
+                    error = error or item
+                    parar.set()
+                elif error is None:
+                    yield item
+            if error is not None:
+                raise error
+        finally:
+            # Si el consumidor sale antes (error en BD), libera a los hilos
+            parar.set()
+
+
+def _pagos_por_referencia(refs: list[str]) -> dict:
+    if not refs:
+        return {}
+    marks = ",".join(["%s"] * len(refs))
+    with connection.cursor() as cur:
+        cur.execute(f"""
+            SELECT referencia, id, pedido_id, monto
+            FROM pago WHERE referencia IN ({marks})
+        """, refs)
+        return {r[0]: (r[1], r[2], Decimal(r[3])) for r in cur.fetchall()}
+
+
+def _guardar_hallazgos(filas: list[tuple]):
+    if not filas:
+        return
+    marks = ",".join(["(%s,%s,%s,%s,%s,%s)"] * len(filas))
+    with connection.cursor() as cur:
+        cur.execute(f"""
+            INSERT IGNORE INTO conciliacion_pago
+              (referencia, tipo, pedido_id, pago_id, monto_stripe, monto_pago)
+            VALUES {marks}
+        """, [v for f in filas for v in f])
+
+
+def _anotar_sesiones(sesiones: list[tuple]):
+    """Registra las sesiones pagadas vistas; las ventanas solapadas no duplican."""
+    if not sesiones:
+        return
+    marks = ",".join(["(%s,%s)"] * len(sesiones))
+    with connection.cursor() as cur:
+        cur.execute(f"""
+            INSERT INTO conciliacion_sesion (referencia, created) VALUES {marks}
+            ON DUPLICATE KEY UPDATE created = VALUES(created)
+        """, [v for s in sesiones for v in s])
+
+
+def conciliar(hilos: int = 4, client=None) -> dict:
+    """
+    Corre una conciliación incremental y avanza los cursores.
+    Devuelve contadores de la corrida.
+    """
+    client = client or get_client()
+    hasta = int(time.time())
+    desde = max(0, leer_cursor(CURSOR_CREATED) - SOLAPE_S)
+    pago_desde = leer_cursor(CURSOR_PAGO)
+    with connection.cursor() as cur:
+        cur.execute("SELECT COALESCE(MAX(id), 0) FROM pago")
+        (pago_hasta,) = cur.fetchone()
+
+    stats = {"sesiones": 0, "conciliadas": 0, SIN_PAGO: 0, MONTO: 0, PEDIDO: 0, SIN_STRIPE: 0}
+
+    # 1) Stripe -> pago
+    for pagina in _stream_sesiones(client, desde, hasta, hilos):
+        pagadas = [s for s in pagina if s[1] == "paid"]
+        mapa = _pagos_por_referencia([s[0] for s in pagadas])
+        hallazgos = []
+        _anotar_sesiones([(s[0], s[4]) for s in pagadas])
+        for ref, _status, monto_stripe, pedido_meta, _created in pagadas:
+            stats["sesiones"] += 1
+            pago = mapa.get(ref)
+            if pago is None:
+                hallazgos.append((ref, SIN_PAGO, pedido_meta, None, monto_stripe, None))
+                continue
+            pago_id, pedido_id, monto_pago = pago
+            ok = True
+            if abs(monto_pago - monto_stripe) > Decimal("0.01"):
+                hallazgos.append((ref, MONTO, pedido_id, pago_id, monto_stripe, monto_pago))
+                ok = False
+            if pedido_meta is not None and pedido_meta != pedido_id:
+                hallazgos.append((ref, PEDIDO, pedido_id, pago_id, monto_stripe, monto_pago))
+                ok = False
+            stats["conciliadas"] += ok
+        for h in hallazgos:
+            stats[h[1]] += 1
+        _guardar_hallazgos(hallazgos)
+
+    # 2) pago -> Stripe (sólo pagos nuevos desde la última corrida)
+    ultimo = pago_desde
+    while ultimo < pago_hasta:
+        with connection.cursor() as cur:
+            cur.execute("""
+                SELECT p.id, p.pedido_id, p.referencia, p.monto, s.referencia IS NOT NULL
+                FROM pago p
+                LEFT JOIN conciliacion_sesion s ON s.referencia = p.referencia
+                WHERE p.id > %s AND p.id <= %s
+                  AND p.metodo IN ('TRANSFERENCIA', 'STRIPE')
+                  AND p.referencia LIKE 'cs\\_%%'
+                ORDER BY p.id
+                LIMIT %s
+            """, [ultimo, pago_hasta, CHUNK_PAGOS])
+            filas = cur.fetchall()
+        if not filas:
+            break
+        hallazgos = [
+            (ref, SIN_STRIPE, pedido_id, pago_id, None, Decimal(monto))
+            for pago_id, pedido_id, ref, monto, vista in filas if not vista
+        ]
+        stats[SIN_STRIPE] += len(hallazgos)
+        _guardar_hallazgos(hallazgos)
+        ultimo = filas[-1][0]
+
+    # La próxima corrida relee desde hasta - SOLAPE: lo anterior ya no se consulta
+    with connection.cursor() as cur:
+        cur.execute("DELETE FROM conciliacion_sesion WHERE created < %s", [hasta - 2 * SOLAPE_S])
+
+    guardar_cursor(CURSOR_CREATED, hasta)
+    guardar_cursor(CURSOR_PAGO, pago_hasta)
+    return stats
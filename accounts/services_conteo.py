@@ -0,0 +1,143 @@
+# accounts/services_conteo.py
+"""
+Conteo físico de inventario (toma mensual) contra el sistema.
+
+- `leer_conteo()` recorre el CSV fila a fila sin cargarlo entero. Acepta
+  columnas `insumo_id` o `insumo` (nombre) y `cantidad`; los nombres se
+  resuelven contra el catálogo en memoria.
+- `comparar()` trae disponible y saldo por kardex de todos los insumos
+  contados en una consulta y calcula las diferencias en Decimal.
+- `aplicar()` recibe, junto con lo contado, el stock que mostró la vista
+  previa: el AJUSTE es contado - ese stock, así los movimientos que
+  entraron entre la vista previa y la aprobación se conservan. Bloquea los
+  insumos y escribe todos los AJUSTE con `registrar_movimientos()`: una
+  transacción, sin consultas por insumo.
+"""
+import csv
+import io
+import itertools
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation
+
+from django.db import connection, transaction
+
+from . import services_insumos, services_kardex
+from .utils import reintentar_si_deadlock
+
+OBSERVACION = "Conteo físico"
+
+
+@dataclass
+class Conteo:
+    # {insumo_id: cantidad contada}
+    contados: dict = field(default_factory=dict)
+    # ["línea N: motivo", ...]
+    errores: list = field(default_factory=list)
+
+
+def _marks(n: int) -> str:
+    return ",".join(["%s"] * n)
+
+
+def leer_conteo(archivo) -> Conteo:
+    """Parsea el CSV subido (UploadedFile o binario). Un insumo repetido suma."""
+    conteo = Conteo()
+    catalogo = services_insumos.catalogo()
+    ids = {iid for iid, _n in catalogo}
+    por_nombre = {n.strip().lower(): iid for iid, n in catalogo}
+
+    texto = io.TextIOWrapper(archivo, encoding="utf-8-sig", newline="")
+    try:
+        cabecera = texto.readline()
+        # Excel en español suele guardar con ';'
+        sep = max(",;\t", key=cabecera.count)
+        lector = csv.DictReader(itertools.chain([cabecera], texto), delimiter=sep)
+        cols = {(c or "").strip().lower() for c in lector.fieldnames or []}
+        if "cantidad" not in cols or not cols & {"insumo_id", "insumo"}:
+            conteo.errores.append("el archivo debe tener columnas insumo_id (o insumo) y cantidad")
+            return conteo
+        for n, fila in enumerate(lector, start=2):
+            fila = {(k or "").strip().lower(): (v or "").strip() for k, v in fila.items()}
+            ref = fila.get("insumo_id") or fila.get("insumo") or ""
+            if not ref and not fila.get("cantidad"):
+                continue
+            iid = int(ref) if ref.isdigit() and int(ref) in ids else por_nombre.get(ref.lower())
+            if iid is None:
+                conteo.errores.append(f"línea {n}: insumo '{ref}' no existe")
+                continue
+            try:
+                cant = Decimal(fila.get("cantidad", "").replace(",", "."))
+            except InvalidOperation:
+                cant = None
+            if cant is None or not cant.is_finite() or cant < 0:
+                conteo.errores.append(f"línea {n}: cantidad inválida")
+                continue
+            conteo.contados[iid] = conteo.contados.get(iid, Decimal("0")) + cant
+    finally:
+        texto.detach()
+    return conteo
+
+
+def comparar(contados: dict) -> list[dict]:
+    """
+    [{insumo_id, insumo, um, contado, disponible, saldo_kardex, diferencia,
+    deriva}] de los insumos contados, ordenado por nombre. `diferencia` =
+    contado - disponible (lo que ajustaría); `deriva` = saldo_kardex - disponible.
+    """
+    ids = sorted(contados)
+    if not ids:
+        return []
+    marks = _marks(len(ids))
+    with connection.cursor() as cur:
+        cur.execute(f"""
+            SELECT i.id, i.nombre, i.unidad_medida, i.cantidad_disponible, COALESCE(s.saldo, 0)
+            FROM insumo i
+            LEFT JOIN ({services_kardex.sql_saldos(
+                f"SELECT id AS insumo_id FROM insumo WHERE id IN ({marks})")}) s
+              ON s.insumo_id = i.id
+            WHERE i.id IN ({marks})
+            ORDER BY i.nombre
+        """, ids + ids)
+        filas = cur.fetchall()
+
+    out = []
+    for iid, nombre, um, d, s in filas:
+        disponible, saldo = Decimal(str(d or 0)), Decimal(str(s or 0))
+        out.append({
+            "insumo_id": iid, "insumo": nombre, "um": um,
+            "contado": contados[iid], "disponible": disponible, "saldo_kardex": saldo,
+            "diferencia": contados[iid] - disponible, "deriva": saldo - disponible,
+        })
+    return out
+
+
+@reintentar_si_deadlock()
+def aplicar(contados: dict, previos: dict, fecha=None) -> list[dict]:
+    """
+    Lleva cada insumo contado a lo contado más lo que se movió desde la
+    vista previa: AJUSTE = contado - `previos[insumo]` (el stock que se
+    mostró al comparar). Las salidas o entradas registradas entre la vista
+    previa y la aprobación no se pisan. Devuelve el resultado por fila de
+    `registrar_movimientos()`.
+    """
+    contados = {int(i): Decimal(str(c)) for i, c in contados.items()}
+    previos = {int(i): Decimal(str(p)) for i, p in previos.items()}
+    ids = sorted(i for i in contados if i in previos)
+    if not ids:
+        return []
+    with transaction.atomic():
+        with connection.cursor() as cur:
+            # Lock en orden de id antes de escribir (registrar_movimientos los reusa)
+            cur.execute(f"""
+                SELECT id FROM insumo
+                WHERE id IN ({_marks(len(ids))}) ORDER BY id FOR UPDATE
+            """, ids)
+            existentes = {r[0] for r in cur.fetchall()}
+        filas = [
+            {"insumo_id": iid, "tipo": "AJUSTE", "motivo": "AJUSTE",
+             "cantidad": contados[iid] - previos[iid], "observacion": OBSERVACION}
+            for iid in ids if iid in existentes and contados[iid] != previos[iid]
+        ]
+        if not filas:
+            return []
+        return services_kardex.registrar_movimientos(filas, fecha=fecha, todo_o_nada=True)
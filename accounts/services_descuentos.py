@@ -0,0 +1,337 @@
+# accounts/services_descuentos.py
+"""
+Motor de descuentos (CU30).
+
+- Los descuentos activos se compilan a `Regla`s en memoria; cada regla
+  sabe calcular su monto en Python y como expresión SQL.
+- El set compilado se invalida al guardar o (des)activar un descuento. Para
+  los demás workers se guarda una versión en `proceso_cursor`, que se
+  revisa como mucho cada VERIFICAR_S segundos.
+- `previsualizar()` calcula el impacto sobre un conjunto de pedidos con
+  una sola consulta, sin escribir.
+- Un pedido lleva un solo descuento efectivo: una regla nueva reemplaza a
+  los que tenga sólo si descuenta más que ellos (misma regla al aplicar en
+  lote y al crear/editar), y su monto nunca supera la base.
+- Sólo se tocan pedidos editables: sin pagos, sin factura y ni ENTREGADO
+  ni CANCELADO.
+- `aplicar_lote()` bloquea cada bloque de LOTE pedidos, revalida el
+  conjunto bajo lock, reemplaza los descuentos con un upsert multi-fila y
+  recalcula los totales con un UPDATE ... JOIN.
+- Al crear/editar un pedido, `mejor_descuento()` elige en memoria la regla
+  que más descuenta y `guardar_descuento()` la compara con los descuentos
+  que ya tenga (p. ej. aplicados a mano) en la misma transacción, así el
+  total final se calcula en Python sin recalcular.
+"""
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.db import connection, transaction
+
+from . import services_checkout, services_despacho
+from .models_db import Descuento
+from .utils import guardar_cursor, leer_cursor
+
+CURSOR_VERSION = "descuentos.version"
+VERIFICAR_S = 5
+LOTE = 1000
+MUESTRA = 50
+# Estados en los que un pedido ya no se reprecia
+NO_EDITABLES = ("ENTREGADO", "CANCELADO")
+
+_reglas: dict | None = None
+_version = None
+_verificado_en = 0.0
+_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class Regla:
+    id: int
+    nombre: str
+    tipo: str
+    valor: Decimal
+
+    def monto(self, base: Decimal) -> Decimal:
+        """Monto a descontar sobre `base` (nunca mayor que la base)."""
+        base = Decimal(base)
+        if base <= 0:
+            return Decimal("0.00")
+        if self.tipo == Descuento.TIPO_FIJO:
+            m = self.valor
+        else:
+            m = (base * self.valor / Decimal("100")).quantize(Decimal("0.01"), ROUND_HALF_UP)
+        return min(m, base)
+
+    def sql_monto(self, base_sql: str) -> tuple[str, list]:
+        """La misma cuenta como expresión SQL sobre la columna/expresión `base_sql`."""
+        if self.tipo == Descuento.TIPO_FIJO:
+            return f"LEAST(%s, {base_sql})", [str(self.valor)]
+        return f"LEAST(ROUND({base_sql} * %s / 100, 2), {base_sql})", [str(self.valor)]
+
+
+@dataclass
+class FiltroPedidos:
+    """
+    Conjunto de pedidos objetivo: estados + rango semiabierto de created_at,
+    siempre limitado a pedidos editables (sin pago, sin factura, no cerrados).
+    """
+    estados: list[str] = field(default_factory=lambda: ["PENDIENTE"])
+    desde: date | None = None
+    hasta: date | None = None
+
+    def sql(self, alias: str = "p") -> tuple[str, list]:
+        where = [
+            f"{alias}.estado NOT IN ({','.join(['%s'] * len(NO_EDITABLES))})",
+            f"NOT EXISTS (SELECT 1 FROM pago pg WHERE pg.pedido_id = {alias}.id)",
+            f"NOT EXISTS (SELECT 1 FROM factura fa WHERE fa.pedido_id = {alias}.id)",
+        ]
+        params = list(NO_EDITABLES)
+        if self.estados:
+            where.append(f"{alias}.estado IN ({','.join(['%s'] * len(self.estados))})")
+            params += list(self.estados)
+        if self.desde:
+            where.append(f"{alias}.created_at >= %s")
+            params.append(self.desde)
+        if self.hasta:
+            where.append(f"{alias}.created_at < %s")
+            params.append(self.hasta + timedelta(days=1))
+        return " AND ".join(where), params
+
+
+# -----------------------
+# Reglas compiladas
+# -----------------------
+def _compilar() -> dict[int, Regla]:
+    return {
+        d.id: Regla(d.id, d.nombre, d.tipo, Decimal(d.valor))
+        for d in Descuento.objects.filter(activo=True)
+    }
+
+
+def reglas_activas() -> dict[int, Regla]:
+    """{descuento_id: Regla} de los descuentos activos."""
+    global _reglas, _version, _verificado_en
+    ahora = time.monotonic()
+    with _lock:
+        if _reglas is not None and ahora - _verificado_en < VERIFICAR_S:
+            return _reglas
+
+    version = leer_cursor(CURSOR_VERSION)
+    with _lock:
+        if _reglas is not None and version == _version:
+            _verificado_en = ahora
+            return _reglas
+
+    reglas = _compilar()
+    with _lock:
+        _reglas, _version, _verificado_en = reglas, version, ahora
+    return reglas
+
+
+def invalidar():
+    """Llamar tras crear/editar/(des)activar un descuento."""
+    global _reglas
+    guardar_cursor(CURSOR_VERSION, time.time_ns() // 1000)
+    with _lock:
+        _reglas = None
+
+
+def mejor_descuento(base: Decimal) -> tuple[Regla | None, Decimal]:
+    """(regla, monto) que más descuenta sobre `base`; (None, 0) si ninguna aplica."""
+    mejor, monto = None, Decimal("0.00")
+    for regla in sorted(reglas_activas().values(), key=lambda r: r.id):
+        m = regla.monto(base)
+        if m > monto:
+            mejor, monto = regla, m
+    return mejor, monto
+
+
+def _descuentos_actuales(cur, pedido_id: int, base: Decimal) -> list[tuple[int, Decimal]]:
+    """
+    [(descuento_id, monto)] del pedido recalculados sobre `base`; juntos
+    nunca descuentan más que la base.
+    """
+    cur.execute("""
+        SELECT d.id, d.nombre, d.tipo, d.valor
+        FROM pedido_descuento pd
+        JOIN descuento d ON d.id = pd.descuento_id
+        WHERE pd.pedido_id = %s
+        ORDER BY d.id
+    """, [pedido_id])
+    restante, out = Decimal(base), []
+    for did, nombre, tipo, valor in cur.fetchall():
+        m = min(Regla(did, nombre, tipo, Decimal(valor)).monto(base), max(restante, Decimal("0")))
+        restante -= m
+        out.append((did, m))
+    return out
+
+
+def guardar_descuento(pedido_id: int, regla: Regla | None, monto: Decimal, base: Decimal) -> Decimal:
+    """
+    Misma regla que `aplicar_lote()`: `regla` reemplaza a los descuentos del
+    pedido sólo si descuenta más que ellos (recalculados sobre `base`); si
+    no, o sin regla aplicable, se conservan los que tenga con el monto
+    recalculado. Devuelve la suma de descuentos que queda.
+    """
+    with connection.cursor() as cur:
+        actuales = _descuentos_actuales(cur, pedido_id, base)
+        vigente = sum((m for _did, m in actuales), Decimal("0.00"))
+        if regla is None or monto <= vigente:
+            for did, m in actuales:
+                cur.execute(
+                    "UPDATE pedido_descuento SET monto_aplicado=%s WHERE pedido_id=%s AND descuento_id=%s",
+                    [str(m), pedido_id, did],
+                )
+            return vigente
+        cur.execute(
+            "DELETE FROM pedido_descuento WHERE pedido_id=%s AND descuento_id<>%s",
+            [pedido_id, regla.id],
+        )
+        cur.execute("""
+            INSERT INTO pedido_descuento (pedido_id, descuento_id, monto_aplicado)
+            VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                descuento_id = VALUES(descuento_id),
+                monto_aplicado = VALUES(monto_aplicado)
+        """, [pedido_id, regla.id, str(monto)])
+    return monto
+
+
+# -----------------------
+# Consultas por conjunto
+# -----------------------
+def _sql_bases(regla: Regla, filtro: FiltroPedidos) -> tuple[str, list]:
+    """
+    SELECT por pedido del conjunto: id, total, base (items + envío), otros
+    descuentos y monto de la regla. Sólo pedidos con base > 0 en los que
+    la regla descuenta más que los descuentos que ya tienen.
+    """
+    w_p, prm_p = filtro.sql("p")
+    w_p2, prm_p2 = filtro.sql("p2")
+    monto_sql, prm_monto = regla.sql_monto("b.base")
+    sql = f"""
+        SELECT c.id, c.total, c.base, c.otros, c.monto
+        FROM (
+            SELECT b.id, b.total, b.base, b.otros, {monto_sql} AS monto
+            FROM (
+                SELECT p.id, p.total,
+                       COALESCE(x.items, 0) + COALESCE(p.costo_envio, 0) AS base,
+                       COALESCE(o.otros, 0) AS otros
+                FROM pedido p
+                LEFT JOIN (
+                    SELECT dp.pedido_id, SUM(dp.cantidad * dp.precio_unitario) AS items
+                    FROM detalle_pedido dp
+                    JOIN pedido p2 ON p2.id = dp.pedido_id
+                    WHERE {w_p2}
+                    GROUP BY dp.pedido_id
+                ) x ON x.pedido_id = p.id
+                LEFT JOIN (
+                    SELECT pedido_id, SUM(monto_aplicado) AS otros
+                    FROM pedido_descuento
+                    WHERE descuento_id <> %s
+                    GROUP BY pedido_id
+                ) o ON o.pedido_id = p.id
+                WHERE {w_p}
+            ) b
+            WHERE b.base > 0
+        ) c
+        WHERE c.monto > c.otros
+    """
+    return sql, prm_monto + prm_p2 + [regla.id] + prm_p
+
+
+def previsualizar(regla: Regla, filtro: FiltroPedidos, muestra: int = MUESTRA) -> dict:
+    """Impacto de aplicar `regla` al conjunto, sin escribir nada."""
+    base_sql, params = _sql_bases(regla, filtro)
+    with connection.cursor() as cur:
+        cur.execute(f"""
+            SELECT COUNT(*), COALESCE(SUM(t.total), 0), COALESCE(SUM(t.monto), 0)
+            FROM ({base_sql}) t
+        """, params)
+        n, total_actual, descuento = cur.fetchone()
+        cur.execute(f"{base_sql} ORDER BY c.id DESC LIMIT %s", params + [muestra])
+        cols = [c[0] for c in cur.description]
+        filas = [dict(zip(cols, r)) for r in cur.fetchall()]
+
+    for f in filas:
+        # Los otros descuentos se reemplazan: queda sólo la regla
+        f["total_nuevo"] = Decimal(f["base"]) - Decimal(f["monto"])
+    return {
+        "pedidos": int(n),
+        "total_actual": Decimal(total_actual),
+        "descuento": Decimal(descuento),
+        "muestra": filas,
+    }
+
+
+def recalcular_totales(ids: list[int]):
+    """total = items + costo_envio - descuentos, para varios pedidos en un UPDATE."""
+    if not ids:
+        return
+    marks = ",".join(["%s"] * len(ids))
+    with connection.cursor() as cur:
+        cur.execute(f"""
+            UPDATE pedido p
+            JOIN (
+              SELECT pedido_id, SUM(cantidad * precio_unitario) AS items
+              FROM detalle_pedido
+              WHERE pedido_id IN ({marks})
+              GROUP BY pedido_id
+            ) x ON x.pedido_id = p.id
+            LEFT JOIN (
+              SELECT pedido_id, COALESCE(SUM(monto_aplicado), 0) AS descuentos
+              FROM pedido_descuento
+              WHERE pedido_id IN ({marks})
+              GROUP BY pedido_id
+            ) d ON d.pedido_id = p.id
+            SET p.total = x.items + p.costo_envio - COALESCE(d.descuentos, 0)
+            WHERE p.id IN ({marks})
+        """, ids * 3)
+
+
+def aplicar_lote(regla: Regla, filtro: FiltroPedidos) -> int:
+    """
+    Aplica `regla` a los pedidos del conjunto en los que descuenta más que
+    lo que ya tienen, reemplazando esos descuentos. Devuelve cuántos tocó.
+    """
+    base_sql, params = _sql_bases(regla, filtro)
+    with connection.cursor() as cur:
+        cur.execute(f"SELECT t.id FROM ({base_sql}) t ORDER BY t.id", params)
+        candidatos = [r[0] for r in cur.fetchall()]
+
+    n = 0
+    with transaction.atomic():
+        for i in range(0, len(candidatos), LOTE):
+            bloque = candidatos[i:i + LOTE]
+            marks = ",".join(["%s"] * len(bloque))
+            with connection.cursor() as cur:
+                # Bajo lock se revalida: un pago, una factura o un cambio de
+                # estado entre la selección y aquí saca al pedido del lote
+                cur.execute(f"SELECT id FROM pedido WHERE id IN ({marks}) ORDER BY id FOR UPDATE",
+                            bloque)
+                cur.execute(f"SELECT t.id, t.monto FROM ({base_sql}) t WHERE t.id IN ({marks})",
+                            params + bloque)
+                filas = cur.fetchall()
+                if not filas:
+                    continue
+                ids = [r[0] for r in filas]
+                marks = ",".join(["%s"] * len(ids))
+                cur.execute(
+                    f"DELETE FROM pedido_descuento WHERE pedido_id IN ({marks}) AND descuento_id <> %s",
+                    ids + [regla.id],
+                )
+                cur.execute(f"""
+                    INSERT INTO pedido_descuento (pedido_id, descuento_id, monto_aplicado)
+                    VALUES {",".join(["(%s,%s,%s)"] * len(filas))}
+                    ON DUPLICATE KEY UPDATE
+                        descuento_id = VALUES(descuento_id),
+                        monto_aplicado = VALUES(monto_aplicado)
+                """, [v for pid, monto in filas for v in (pid, regla.id, monto)])
+            recalcular_totales(ids)
+            services_despacho.sincronizar_lote(ids)
+            services_checkout.invalidar_lote(ids)
+            n += len(ids)
+    return n
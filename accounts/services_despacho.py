@@ -0,0 +1,93 @@
+# accounts/services_despacho.py
+"""
+Cola de despacho: pedidos listos para gestionar envío (CU24).
+
+Un pedido está en `dispatch_queue` mientras:
+- pedido.estado = 'CONFIRMADO'
+- suma(pago.monto) >= pedido.total
+- no tiene fila en envio
+
+`sincronizar(pedido_id)` se llama dentro de la misma transacción que
+inserta un pago, cambia el estado/total del pedido o crea su envío, así la
+cola nunca queda desfasada y `envio_list` sólo lee filas listas por PK.
+"""
+from django.db import connection
+
+ESTADO_LISTO = "CONFIRMADO"
+
+
+def sincronizar(pedido_id: int) -> bool:
+    """Recalcula si el pedido va en la cola y la ajusta. Devuelve si quedó listo."""
+    with connection.cursor() as cur:
+        # Lock del pedido: serializa pagos concurrentes del mismo pedido; con
+        # READ COMMITTED la suma de abajo ya ve lo que confirmó el otro.
+        cur.execute("SELECT estado, total FROM pedido WHERE id=%s FOR UPDATE", [pedido_id])
+        row = cur.fetchone()
+        listo = False
+        if row and row[0] == ESTADO_LISTO:
+            cur.execute("""
+                SELECT (SELECT COALESCE(SUM(monto), 0) FROM pago WHERE pedido_id=%s),
+                       EXISTS(SELECT 1 FROM envio WHERE pedido_id=%s)
+            """, [pedido_id, pedido_id])
+            pagado, tiene_envio = cur.fetchone()
+            listo = not tiene_envio and pagado >= (row[1] or 0)
+
+        if listo:
+            cur.execute("INSERT IGNORE INTO dispatch_queue (pedido_id) VALUES (%s)", [pedido_id])
+        else:
+            cur.execute("DELETE FROM dispatch_queue WHERE pedido_id=%s", [pedido_id])
+    return listo
+
+
+def sincronizar_lote(pedido_ids) -> None:
+    """`sincronizar()` para muchos pedidos con consultas por conjunto."""
+    ids = sorted({int(i) for i in pedido_ids})
+    if not ids:
+        return
+    marks = ",".join(["%s"] * len(ids))
+    with connection.cursor() as cur:
+        cur.execute(f"SELECT id FROM pedido WHERE id IN ({marks}) ORDER BY id FOR UPDATE", ids)
+        cur.execute(f"""
+            SELECT p.id
+            FROM pedido p
+            LEFT JOIN envio e ON e.pedido_id = p.id
+            LEFT JOIN (
+                SELECT pedido_id, SUM(monto) AS pagado
+                FROM pago WHERE pedido_id IN ({marks})
+                GROUP BY pedido_id
+            ) pg ON pg.pedido_id = p.id
+            WHERE p.id IN ({marks})
+              AND p.estado = %s
+              AND e.id IS NULL
+              AND COALESCE(pg.pagado, 0) >= p.total
+        """, ids + ids + [ESTADO_LISTO])
+        listos = [r[0] for r in cur.fetchall()]
+        fuera = sorted(set(ids) - set(listos))
+
+        if fuera:
+            cur.execute(
+                f"DELETE FROM dispatch_queue WHERE pedido_id IN ({','.join(['%s'] * len(fuera))})",
+                fuera,
+            )
+        if listos:
+            # INSERT IGNORE: los que ya estaban conservan su listo_desde
+            cur.execute(
+                "INSERT IGNORE INTO dispatch_queue (pedido_id) VALUES "
+                + ",".join(["(%s)"] * len(listos)),
+                listos,
+            )
+
+
+def pedidos_listos() -> list[dict]:
+    """Filas de la cola con los datos que muestra envio_list."""
+    with connection.cursor() as cur:
+        cur.execute("""
+          SELECT p.id, c.nombre AS cliente, p.metodo_envio, p.direccion_entrega,
+                 p.total, dq.listo_desde
+          FROM dispatch_queue dq
+          JOIN pedido  p ON p.id = dq.pedido_id
+          JOIN cliente c ON c.id = p.cliente_id
+          ORDER BY dq.pedido_id DESC
+        """)
+        cols = [c[0] for c in cur.description]
+        return [dict(zip(cols, r)) for r in cur.fetchall()]
@@ -0,0 +1,207 @@
+# accounts/services_eventos.py
+"""
+Pub/sub en proceso para cambios de pedidos (estado, pago, envío).
+
+- `registrar(ids, tipo)` se llama dentro de la transacción del cambio:
+  guarda el evento en `pedido_evento` y, al confirmar, lo entrega a los
+  suscriptores SSE de este proceso (views_eventos).
+- Con varios workers (EVENTOS_POLL_S > 0) cada event loop tiene un único
+  poller que lee de `pedido_evento` los eventos de *otros* procesos y los
+  reparte: una consulta por intervalo y worker, no una por cliente. Lee
+  con un intervalo de retraso: sólo hasta el MAX(id) visto en la vuelta
+  anterior, así un id menor que confirma tarde todavía entra.
+- La tabla también sirve para reponer eventos perdidos (Last-Event-ID);
+  `podar()` borra lo que ya no se repone (comando podar_eventos).
+"""
+import asyncio
+import os
+import socket
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+
+ESTADO = "ESTADO"
+PAGO = "PAGO"
+ENVIO = "ENVIO"
+
+COLA_MAX = 200
+LOTE_POLL = 500
+LOTE_PODA = 5000
+
+_ORIGEN = f"{socket.gethostname()}:{os.getpid()}"
+
+_suscripciones: set = set()
+_lock = threading.Lock()
+_pollers: dict = {}  # event loop -> asyncio.Task
+
+
+class Suscripcion:
+    """Cola asyncio de un cliente SSE; `filtro(evento)` decide qué recibe."""
+
+    def __init__(self, filtro):
+        self.loop = asyncio.get_running_loop()
+        self.cola: asyncio.Queue = asyncio.Queue(maxsize=COLA_MAX)
+        self.filtro = filtro
+        self.desbordada = False
+
+    def _entregar(self, evento: dict):
+        try:
+            self.cola.put_nowait(evento)
+        except asyncio.QueueFull:
+            # El cliente no da abasto: se le pide recargar en vez de crecer sin límite
+            self.desbordada = True
+
+
+def _origen() -> str:
+    # Después de un fork el pid cambia
+    global _ORIGEN
+    if not _ORIGEN.endswith(f":{os.getpid()}"):
+        _ORIGEN = f"{socket.gethostname()}:{os.getpid()}"
+    return _ORIGEN
+
+
+# -----------------------
+# Publicación (código síncrono)
+# -----------------------
+def _despachar(eventos: list[dict]):
+    with _lock:
+        subs = list(_suscripciones)
+    for s in subs:
+        for ev in eventos:
+            if s.filtro(ev):
+                s.loop.call_soon_threadsafe(s._entregar, ev)
+
+
+def registrar(pedido_ids, tipo: str):
+    """Guarda un evento por pedido con su estado actual y lo publica al confirmar."""
+    ids = list(dict.fromkeys(int(i) for i in pedido_ids))
+    if not ids:
+        return
+    marks = ",".join(["%s"] * len(ids))
+    origen = _origen()
+    with connection.cursor() as cur:
+        cur.execute(f"""
+            SELECT p.id, p.cliente_id, p.estado, e.estado
+            FROM pedido p
+            LEFT JOIN envio e ON e.pedido_id = p.id
+            WHERE p.id IN ({marks})
+        """, ids)
+        filas = cur.fetchall()
+        if not filas:
+            return
+        valores = ",".join(["(%s,%s,%s,%s,%s,%s)"] * len(filas))
+        cur.execute(f"""
+            INSERT INTO pedido_evento (pedido_id, cliente_id, tipo, estado, estado_envio, origen)
+            VALUES {valores}
+        """, [v for pid, cid, est, env in filas for v in (pid, cid, tipo, est, env, origen)])
+        # Con innodb_autoinc_lock_mode=2 los ids del INSERT multi-fila pueden
+        # intercalarse con los de otras sesiones: se releen las filas propias
+        # (las no confirmadas de otras transacciones no se ven)
+        cur.execute(f"""
+            SELECT id FROM pedido_evento
+            WHERE id >= %s AND origen = %s AND tipo = %s AND pedido_id IN ({marks})
+            ORDER BY id LIMIT %s
+        """, [cur.lastrowid, origen, tipo, *ids, len(filas)])
+        nuevos = [r[0] for r in cur.fetchall()]
+    eventos = [
+        {"id": eid, "pedido_id": pid, "cliente_id": cid, "tipo": tipo,
+         "estado": est, "estado_envio": env}
+        for eid, (pid, cid, est, env) in zip(nuevos, filas)
+    ]
+    transaction.on_commit(lambda: _despachar(eventos))
+
+
+def eventos_desde(ultimo_id: int, limite: int = LOTE_POLL, excluir_origen: str | None = None,
+                  hasta_id: int | None = None) -> list[dict]:
+    sql = """
+        SELECT id, pedido_id, cliente_id, tipo, estado, estado_envio
+        FROM pedido_evento WHERE id > %s
+    """
+    params = [ultimo_id]
+    if hasta_id is not None:
+        sql += " AND id <= %s"
+        params.append(hasta_id)
+    if excluir_origen:
+        sql += " AND origen <> %s"
+        params.append(excluir_origen)
+    sql += " ORDER BY id LIMIT %s"
+    params.append(limite)
+    with connection.cursor() as cur:
+        cur.execute(sql, params)
+        cols = [c[0] for c in cur.description]
+        return [dict(zip(cols, r)) for r in cur.fetchall()]
+
+
+def _ultimo_id() -> int:
+    with connection.cursor() as cur:
+        cur.execute("SELECT COALESCE(MAX(id), 0) FROM pedido_evento")
+        return int(cur.fetchone()[0])
+
+
+def _leer_otros(ultimo_id: int, tope: int) -> tuple[list[dict], int]:
+    """Eventos de otros procesos en (ultimo_id, tope] y el MAX(id) actual (próximo tope)."""
+    try:
+        siguiente_tope = _ultimo_id()
+        return eventos_desde(ultimo_id, excluir_origen=_origen(), hasta_id=tope), siguiente_tope
+    finally:
+        close_old_connections()
+
+
+def podar(dias: int) -> int:
+    """Borra los eventos de más de `dias` días, en tandas cortas. Devuelve cuántos."""
+    total = 0
+    while True:
+        with connection.cursor() as cur:
+            cur.execute(
+                "DELETE FROM pedido_evento WHERE creado_en < NOW() - INTERVAL %s DAY "
+                "ORDER BY creado_en LIMIT %s",
+                [dias, LOTE_PODA],
+            )
+            total += cur.rowcount
+            if cur.rowcount < LOTE_PODA:
+                return total
+
+
+# -----------------------
+# Suscripción (código async)
+# -----------------------
+async def _poll(loop):
+    # Arranca sin pasado: la primera vuelta sólo fija el tope
+    ultimo = tope = await sync_to_async(_ultimo_id, thread_sensitive=False)()
+    intervalo = float(getattr(settings, "EVENTOS_POLL_S", 0))
+    try:
+        while True:
+            await asyncio.sleep(intervalo)
+            with _lock:
+                activos = any(s.loop is loop for s in _suscripciones)
+            if not activos:
+                return
+            eventos, siguiente_tope = await sync_to_async(_leer_otros, thread_sensitive=False)(ultimo, tope)
+            if eventos:
+                _despachar(eventos)
+            if len(eventos) == LOTE_POLL:
+                # Ventana sin terminar: se sigue desde ahí con el mismo tope
+                ultimo = eventos[-1]["id"]
+            else:
+                ultimo, tope = tope, max(tope, siguiente_tope)
+    finally:
+        with _lock:
+            _pollers.pop(loop, None)
+
+
+def suscribir(filtro) -> Suscripcion:
+    s = Suscripcion(filtro)
+    with _lock:
+        _suscripciones.add(s)
+        necesita_poller = (float(getattr(settings, "EVENTOS_POLL_S", 0)) > 0
+                           and s.loop not in _pollers)
+        if necesita_poller:
+            _pollers[s.loop] = s.loop.create_task(_poll(s.loop))
+    return s
+
+
+def desuscribir(s: Suscripcion):
+    with _lock:
+        _suscripciones.discard(s)
@@ -0,0 +1,305 @@
+# accounts/services_facturas.py
+"""
+PDF de facturas (ReportLab), generado fuera del request.
+
+- `encolar_pdf(factura_id)` lo manda a un pool de hilos de fondo; si ya hay
+  un render en curso para esa factura se reutiliza el mismo Future.
+- El archivo se guarda por contenido: FACTURAS_PDF_DIR/ab/<sha256>.pdf
+  (canvas `invariant=1`, así el mismo contenido da el mismo hash).
+- La tabla `factura_pdf` apunta factura -> sha256; ese hash es el ETag.
+
+`emitir_pendientes()` factura en lote todos los pedidos pagados sin factura.
+"""
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from decimal import Decimal
+from pathlib import Path
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+
+from .services_numeracion import devolver, formatear, reservar_rango
+
+_pool: ThreadPoolExecutor | None = None
+_pool_lock = threading.Lock()
+_en_curso: dict[int, Future] = {}
+_en_curso_lock = threading.Lock()
+
+# Consumidor final: sin NIT declarado
+NIT_POR_DEFECTO = "0"
+LOTE_INSERT = 500
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(
+                    max_workers=int(getattr(settings, "FACTURAS_PDF_WORKERS", 2)),
+                    thread_name_prefix="factura-pdf",
+                )
+    return _pool
+
+
+def _base_dir() -> Path:
+    return Path(settings.FACTURAS_PDF_DIR)
+
+
+def ruta_pdf(sha256: str) -> Path:
+    return _base_dir() / sha256[:2] / f"{sha256}.pdf"
+
+
+# -----------------------
+# Consultas
+# -----------------------
+def pdf_de_factura(factura_id: int) -> tuple[str, Path] | None:
+    """(sha256, ruta) si el PDF ya está generado y en disco; si no, None."""
+    with connection.cursor() as cur:
+        cur.execute("SELECT sha256 FROM factura_pdf WHERE factura_id=%s", [factura_id])
+        row = cur.fetchone()
+    if not row:
+        return None
+    path = ruta_pdf(row[0])
+    return (row[0], path) if path.exists() else None
+
+
+def items_pedido(pedido_id: int):
+    """Devuelve el detalle del pedido para imprimir en factura."""
+    with connection.cursor() as cur:
+        cur.execute("""
+            SELECT pr.nombre AS producto,
+                   s.nombre  AS sabor,
+                   dp.cantidad,
+                   dp.precio_unitario,
+                   dp.sub_total
+            FROM detalle_pedido dp
+            JOIN producto pr ON pr.id = dp.producto_id
+            JOIN sabor    s  ON s.id = dp.sabor_id
+            WHERE dp.pedido_id = %s
+            ORDER BY pr.nombre, s.nombre
+        """, [pedido_id])
+        cols = [c[0] for c in cur.description]
+        return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+
+def _datos_factura(factura_id: int) -> dict | None:
+    with connection.cursor() as cur:
+        cur.execute("""
+            SELECT f.id, f.pedido_id, f.nro, f.fecha, f.nit_cliente, f.razon_social, f.total
+            FROM factura f WHERE f.id = %s
+        """, [factura_id])
+        row = cur.fetchone()
+        if not row:
+            return None
+        cols = [c[0] for c in cur.description]
+    return dict(zip(cols, row))
+
+
+# -----------------------
+# Render
+# -----------------------
+def _render_pdf(f: dict, items: list[dict]) -> bytes:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import cm
+    from reportlab.pdfgen import canvas
+
+    buf = io.BytesIO()
+    p = canvas.Canvas(buf, pagesize=A4, invariant=1)
+    width, height = A4
+    x = 2 * cm
+    y = height - 2 * cm
+
+    p.setFont("Helvetica-Bold", 16)
+    p.drawString(x, y, f"Factura {f['nro']}")
+    y -= 0.9 * cm
+    p.setFont("Helvetica", 10)
+    fecha = f["fecha"].strftime("%Y-%m-%d %H:%M") if f["fecha"] else "-"
+    for linea in (
+        f"Fecha: {fecha}",
+        f"Pedido: #{f['pedido_id']}",
+        f"NIT/CI: {f['nit_cliente']}",
+        f"Razón social: {f['razon_social']}",
+    ):
+        p.drawString(x, y, linea)
+        y -= 0.55 * cm
+    y -= 0.5 * cm
+
+    headers = ["Producto", "Sabor", "Cant.", "P. Unit.", "Subtotal"]
+    col_x = [x, x + 6 * cm, x + 10.5 * cm, x + 12.5 * cm, x + 15 * cm]
+
+    def _cabecera(yy):
+        p.setFont("Helvetica-Bold", 10)
+        for i, h in enumerate(headers):
+            p.drawString(col_x[i], yy, h)
+        p.setFont("Helvetica", 10)
+
+    _cabecera(y)
+    y -= 0.6 * cm
+    for it in items:
+        if y < 2.5 * cm:
+            p.showPage()
+            y = height - 2 * cm
+            _cabecera(y)
+            y -= 0.6 * cm
+        vals = [
+            str(it.get("producto") or "")[:32],
+            str(it.get("sabor") or "")[:24],
+            str(it.get("cantidad") or 0),
+            f"{Decimal(it.get('precio_unitario') or 0):.2f}",
+            f"{Decimal(it.get('sub_total') or 0):.2f}",
+        ]
+        for i, v in enumerate(vals):
+            p.drawString(col_x[i], y, v)
+        y -= 0.55 * cm
+
+    y -= 0.4 * cm
+    p.setFont("Helvetica-Bold", 11)
+    p.drawString(col_x[3], y, "Total")
+    p.drawString(col_x[4], y, f"{Decimal(f['total'] or 0):.2f} Bs.")
+
+    p.showPage()
+    p.save()
+    return buf.getvalue()
+
+
+def _guardar_en_disco(data: bytes) -> str:
+    sha = hashlib.sha256(data).hexdigest()
+    destino = ruta_pdf(sha)
+    if not destino.exists():
+        destino.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=destino.parent, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp, destino)  # atómico: nunca se sirve un archivo a medias
+    return sha
+
+
+def generar_pdf(factura_id: int) -> str | None:
+    """Renderiza, guarda y registra el PDF. Devuelve el sha256."""
+    f = _datos_factura(factura_id)
+    if not f:
+        return None
+    data = _render_pdf(f, items_pedido(f["pedido_id"]))
+    sha = _guardar_en_disco(data)
+    with connection.cursor() as cur:
+        cur.execute("""
+            INSERT INTO factura_pdf (factura_id, sha256, bytes) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE sha256=VALUES(sha256), bytes=VALUES(bytes),
+                                    generado_en=CURRENT_TIMESTAMP
+        """, [factura_id, sha, len(data)])
+    return sha
+
+
+# -----------------------
+# Cola de fondo
+# -----------------------
+def _tarea(factura_id: int):
+    try:
+        return generar_pdf(factura_id)
+    finally:
+        with _en_curso_lock:
+            _en_curso.pop(factura_id, None)
+        close_old_connections()
+        connection.close()
+
+
+def encolar_pdf(factura_id: int) -> Future:
+    """Agenda el render; pedidos concurrentes de la misma factura comparten Future."""
+    with _en_curso_lock:
+        fut = _en_curso.get(factura_id)
+        if fut is None:
+            fut = _executor().submit(_tarea, factura_id)
+            _en_curso[factura_id] = fut
+        return fut
+
+
+def render_en_curso(factura_id: int) -> bool:
+    with _en_curso_lock:
+        return factura_id in _en_curso
+
+
+# -----------------------
+# Emisión en lote
+# -----------------------
+def pedidos_por_facturar() -> list[tuple]:
+    """
+    (pedido_id, total, razón social) de pedidos pagados sin factura. Cuenta
+    como pagado el pedido confirmado (ni PENDIENTE ni CANCELADO) con un neto
+    cobrado positivo que cubre el total; los pagos se suman sólo para esos
+    candidatos, no sobre toda la tabla.
+    """
+    with connection.cursor() as cur:
+        cur.execute("""
+            SELECT p.id, p.total, c.nombre
+            FROM (SELECT q.id, SUM(pg.monto) AS pagado
+                  FROM pedido q
+                  LEFT JOIN factura f ON f.pedido_id = q.id
+                  JOIN pago pg ON pg.pedido_id = q.id
+                  WHERE f.id IS NULL
+                    AND q.estado NOT IN ('PENDIENTE', 'CANCELADO')
+                  GROUP BY q.id) cand
+            JOIN pedido p ON p.id = cand.id
+            JOIN cliente c ON c.id = p.cliente_id
+            WHERE cand.pagado > 0
+              AND cand.pagado >= p.total
+            ORDER BY p.id
+        """)
+        return cur.fetchall()
+
+
+def emitir_pendientes(serie: str | None = None) -> list[int]:
+    """
+    Emite factura para cada pedido pagado sin factura, con NIT de consumidor
+    final y el nombre del cliente como razón social. Devuelve los ids creados
+    (sus PDFs quedan encolados al confirmar). Abre su propia transacción:
+    los números que no terminan en factura se devuelven a la numeración.
+    """
+    if connection.in_atomic_block:
+        raise RuntimeError("emitir_pendientes() debe abrir su propia transacción")
+    pendientes = pedidos_por_facturar()
+    if not pendientes:
+        return []
+
+    serie, desde, hasta = reservar_rango(len(pendientes), serie)
+    filas = []
+    for numero, (pedido_id, total, nombre) in zip(range(desde, hasta + 1), pendientes):
+        filas.append((pedido_id, serie, numero, formatear(serie, numero),
+                      NIT_POR_DEFECTO, (nombre or "SIN NOMBRE")[:200], str(total or 0)))
+
+    try:
+        with transaction.atomic():
+            with connection.cursor() as cur:
+                for i in range(0, len(filas), LOTE_INSERT):
+                    lote = filas[i:i + LOTE_INSERT]
+                    marks = ",".join(["(%s,%s,%s,%s,NOW(),%s,%s,%s)"] * len(lote))
+                    # Si otro proceso facturó el pedido entretanto (ux pedido_id) la
+                    # fila no se inserta y su número se devuelve abajo; cualquier
+                    # otro error (truncado, FK) aborta el lote
+                    cur.execute(f"""
+                        INSERT INTO factura
+                          (pedido_id, serie, numero, nro, fecha, nit_cliente, razon_social, total)
+                        VALUES {marks}
+                        ON DUPLICATE KEY UPDATE id = id
+                    """, [v for f in lote for v in f])
+                cur.execute(
+                    "SELECT id, numero FROM factura WHERE serie=%s AND numero BETWEEN %s AND %s "
+                    "ORDER BY numero",
+                    [serie, desde, hasta],
+                )
+                emitidas = cur.fetchall()
+            ids = [r[0] for r in emitidas]
+            transaction.on_commit(lambda: [encolar_pdf(fid) for fid in ids])
+    except BaseException:
+        # El rango se reservó fuera de la transacción: sin commit vuelve entero
+        devolver(serie, range(desde, hasta + 1))
+        raise
+    usados = {r[1] for r in emitidas}
+    sobrantes = [n for n in range(desde, hasta + 1) if n not in usados]
+    if sobrantes:
+        devolver(serie, sobrantes)
+    return ids
@@ -0,0 +1,286 @@
+# accounts/services_horneado.py
+"""
+Programa de horneado: tandas por producto × sabor dentro de ventanas de
+entrega, para cambiar de masa/sabor lo menos posible.
+
+- Las líneas pendientes (pedidos CONFIRMADO / EN_PRODUCCION, sin las ya
+  producidas una por una en `produccion_linea`) se agrupan por
+  (ventana de entrega, producto, sabor). La ventana es la entrega truncada
+  a bloques de PROGRAMA_VENTANA_H horas.
+- Cada grupo se parte en tandas de hasta HORNO_CAPACIDAD unidades; una
+  tanda ocupa un turno de HORNO_SLOT_MIN minutos entre HORNO_INICIO y
+  HORNO_FIN. Los grupos se asignan en orden (ventana, producto, sabor), así
+  dentro de una ventana los mismos productos/sabores van seguidos.
+- Una tanda queda "tarde" si termina después de la entrega más temprana de
+  sus pedidos menos PROGRAMA_ANTICIPACION_MIN.
+- El programa se guarda en memoria del proceso. Cuando un pedido entra o
+  sale (ver services_reservas) o se produce una línea suelta (ver
+  services_produccion) sólo se rehacen los grupos desde la primera
+  ventana afectada; las tandas anteriores quedan como estaban. Los demás
+  workers lo rehacen entero al ver otra versión en `proceso_cursor`.
+"""
+import math
+import threading
+import time as _time
+from dataclasses import dataclass, field
+from datetime import date, datetime, time, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .utils import guardar_cursor, leer_cursor
+
+ACTIVOS = ("CONFIRMADO", "EN_PRODUCCION")
+CURSOR_VERSION = "horneado.version"
+TTL_S = 300
+
+_programa = None
+_lock = threading.Lock()
+
+
+def _cfg(nombre: str, default):
+    return getattr(settings, nombre, default)
+
+
+@dataclass
+class Grupo:
+    ventana: datetime
+    producto_id: int
+    producto: str
+    sabor_id: int
+    sabor: str
+    # {pedido_id: (cantidad, entrega)}
+    por_pedido: dict = field(default_factory=dict)
+
+    @property
+    def clave(self) -> tuple:
+        return (self.ventana, self.producto_id, self.sabor_id)
+
+    @property
+    def cantidad(self) -> int:
+        return sum(c for c, _e in self.por_pedido.values())
+
+
+@dataclass
+class Tanda:
+    inicio: datetime
+    fin: datetime
+    producto: str
+    sabor: str
+    cantidad: int
+    pedidos: list
+    limite: datetime
+    clave: tuple
+
+    @property
+    def tarde(self) -> bool:
+        return self.fin > self.limite
+
+
+@dataclass
+class Programa:
+    desde: date
+    hasta: date  # exclusivo
+    comienzo: datetime
+    version: int
+    creado: float
+    grupos: dict = field(default_factory=dict)
+    tandas: list = field(default_factory=list)
+
+    @property
+    def tardes(self) -> list:
+        return [t for t in self.tandas if t.tarde]
+
+    def por_dia(self) -> list[tuple[date, list]]:
+        dias: dict = {}
+        for t in self.tandas:
+            dias.setdefault(timezone.localtime(t.inicio).date(), []).append(t)
+        return sorted(dias.items())
+
+
+# -----------------------
+# Turnos y ventanas
+# -----------------------
+def _hhmm(txt: str) -> time:
+    h, m = txt.split(":")
+    return time(int(h), int(m))
+
+
+def _turnos(comienzo: datetime):
+    """Inicio de cada turno de horno desde `comienzo`, día por día."""
+    tz = timezone.get_current_timezone()
+    paso = timedelta(minutes=int(_cfg("HORNO_SLOT_MIN", 30)))
+    abre, cierra = _hhmm(_cfg("HORNO_INICIO", "07:00")), _hhmm(_cfg("HORNO_FIN", "19:00"))
+    if paso <= timedelta(0) or datetime.combine(date.min, abre) + paso > datetime.combine(date.min, cierra):
+        raise ValueError("HORNO_INICIO/HORNO_FIN/HORNO_SLOT_MIN no dejan ningún turno por día.")
+    dia = timezone.localtime(comienzo).date()
+    while True:
+        t = timezone.make_aware(datetime.combine(dia, abre), tz)
+        fin_dia = timezone.make_aware(datetime.combine(dia, cierra), tz)
+        while t + paso <= fin_dia:
+            if t >= comienzo:
+                yield t
+            t += paso
+        dia += timedelta(days=1)
+
+
+def _ventana(entrega: datetime) -> datetime:
+    horas = int(_cfg("PROGRAMA_VENTANA_H", 4))
+    local = timezone.localtime(entrega)
+    return local.replace(hour=local.hour - local.hour % horas, minute=0, second=0, microsecond=0)
+
+
+# -----------------------
+# Carga de líneas
+# -----------------------
+def _lineas(desde: date, hasta: date, pedido_id: int | None = None) -> list[tuple]:
+    tz = timezone.get_current_timezone()
+    ini = timezone.make_aware(datetime.combine(desde, time.min), tz)
+    fin = timezone.make_aware(datetime.combine(hasta, time.min), tz)
+    where = [f"p.estado IN ({','.join(['%s'] * len(ACTIVOS))})",
+             "p.fecha_entrega_programada >= %s", "p.fecha_entrega_programada < %s"]
+    params = list(ACTIVOS) + [ini, fin]
+    if pedido_id is not None:
+        where.append("p.id = %s")
+        params.append(pedido_id)
+    with connection.cursor() as cur:
+        cur.execute(f"""
+            SELECT dp.pedido_id, dp.producto_id, pr.nombre, dp.sabor_id, s.nombre,
+                   dp.cantidad, p.fecha_entrega_programada
+            FROM detalle_pedido dp
+            JOIN pedido   p  ON p.id = dp.pedido_id
+            JOIN producto pr ON pr.id = dp.producto_id
+            JOIN sabor    s  ON s.id = dp.sabor_id
+            LEFT JOIN produccion_linea pl
+              ON pl.pedido_id = dp.pedido_id AND pl.producto_id = dp.producto_id
+             AND pl.sabor_id = dp.sabor_id
+            WHERE {" AND ".join(where)} AND pl.pedido_id IS NULL
+        """, params)
+        return cur.fetchall()
+
+
+def _agregar(grupos: dict, lineas) -> set:
+    """Suma las líneas a sus grupos. Devuelve las claves tocadas."""
+    tocadas = set()
+    for pid, prod_id, prod, sab_id, sab, cant, entrega in lineas:
+        # Las consultas crudas devuelven fechas naive en UTC (USE_TZ sin TIME_ZONE de BD)
+        if timezone.is_naive(entrega):
+            entrega = timezone.make_aware(entrega, dt_timezone.utc)
+        v = _ventana(entrega)
+        g = grupos.get((v, prod_id, sab_id))
+        if g is None:
+            g = grupos[(v, prod_id, sab_id)] = Grupo(v, prod_id, prod, sab_id, sab)
+        c, e = g.por_pedido.get(pid, (0, entrega))
+        g.por_pedido[pid] = (c + int(cant), min(e, entrega))
+        tocadas.add(g.clave)
+    return tocadas
+
+
+def _quitar(grupos: dict, pedido_id: int) -> set:
+    tocadas = set()
+    for clave, g in list(grupos.items()):
+        if g.por_pedido.pop(pedido_id, None) is not None:
+            tocadas.add(clave)
+            if not g.por_pedido:
+                del grupos[clave]
+    return tocadas
+
+
+# -----------------------
+# Asignación a turnos
+# -----------------------
+def _asignar(programa: Programa, desde_clave: tuple | None = None):
+    """
+    (Re)asigna turnos a los grupos con clave >= desde_clave; las tandas de
+    grupos anteriores se conservan. Una tanda por turno.
+    """
+    capacidad = int(_cfg("HORNO_CAPACIDAD", 48))
+    paso = timedelta(minutes=int(_cfg("HORNO_SLOT_MIN", 30)))
+    anticipa = timedelta(minutes=int(_cfg("PROGRAMA_ANTICIPACION_MIN", 60)))
+
+    if desde_clave is None:
+        tandas = []
+    else:
+        tandas = [t for t in programa.tandas if t.clave < desde_clave]
+    turnos = _turnos(programa.comienzo)
+    for _ in range(len(tandas)):
+        next(turnos)
+
+    for clave in sorted(k for k in programa.grupos if desde_clave is None or k >= desde_clave):
+        g = programa.grupos[clave]
+        # Reparte los pedidos (por entrega) en tandas de hasta `capacidad`
+        pendientes = sorted(g.por_pedido.items(), key=lambda kv: (kv[1][1], kv[0]))
+        n_tandas = math.ceil(g.cantidad / capacidad)
+        for _ in range(n_tandas):
+            inicio = next(turnos)
+            cupo, pedidos, limite = capacidad, [], None
+            while pendientes and cupo > 0:
+                pid, (cant, entrega) = pendientes[0]
+                toma = min(cant, cupo)
+                cupo -= toma
+                pedidos.append(pid)
+                limite = entrega if limite is None else min(limite, entrega)
+                if toma == cant:
+                    pendientes.pop(0)
+                else:
+                    pendientes[0] = (pid, (cant - toma, entrega))
+            tandas.append(Tanda(inicio, inicio + paso, g.producto, g.sabor,
+                                capacidad - cupo, pedidos, limite - anticipa, clave))
+    programa.tandas = tandas
+
+
+# -----------------------
+# API
+# -----------------------
+def planificar(desde: date | None = None, dias: int = 7) -> Programa:
+    """Programa completo para las entregas en [desde, desde + dias)."""
+    desde = desde or timezone.localdate()
+    hasta = desde + timedelta(days=max(int(dias), 1))
+    tz = timezone.get_current_timezone()
+    comienzo = max(timezone.now(), timezone.make_aware(datetime.combine(desde, time.min), tz))
+    prog = Programa(desde, hasta, comienzo, leer_cursor(CURSOR_VERSION), _time.monotonic())
+    _agregar(prog.grupos, _lineas(desde, hasta))
+    _asignar(prog)
+    return prog
+
+
+def programa(desde: date | None = None, dias: int = 7) -> Programa:
+    """El programa en memoria si sigue vigente; si no, uno nuevo."""
+    global _programa
+    desde = desde or timezone.localdate()
+    hasta = desde + timedelta(days=max(int(dias), 1))
+    version = leer_cursor(CURSOR_VERSION)
+    with _lock:
+        p = _programa
+        if (p is not None and p.desde == desde and p.hasta == hasta and p.version == version
+                and _time.monotonic() - p.creado < TTL_S):
+            return p
+    p = planificar(desde, dias)
+    with _lock:
+        _programa = p
+    return p
+
+
+def pedido_cambio(pedido_id: int):
+    """
+    Un pedido entró, cambió o salió del conjunto activo: rehace sólo sus
+    grupos y los posteriores en el programa en memoria.
+    """
+    global _programa
+    version = _time.time_ns() // 1000
+    with _lock:
+        p = _programa
+    if p is not None:
+        try:
+            lineas = _lineas(p.desde, p.hasta, pedido_id)
+            with _lock:
+                tocadas = _quitar(p.grupos, pedido_id) | _agregar(p.grupos, lineas)
+                if tocadas:
+                    _asignar(p, min(tocadas))
+                p.version = version
+        except Exception:
+            # Corre tras el commit: no romper la respuesta, rehacer en la próxima lectura
+            with _lock:
+                _programa = None
+    guardar_cursor(CURSOR_VERSION, version)
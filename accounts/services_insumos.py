@@ -0,0 +1,167 @@
+# accounts/services_insumos.py
+"""
+Requerimiento de insumos para producción.
+
+- `requerimientos()` recibe uno o más pedidos y en UNA consulta trae sus
+  líneas × receta junto con el stock actual de cada insumo involucrado.
+  El saldo por kardex se calcula una sola vez por insumo (no una por
+  línea), desde su último punto de control (ver services_kardex).
+- La demanda se suma por insumo entre todas las líneas: un insumo que
+  alcanza para cada línea por separado pero no para todas juntas aparece
+  como faltante del conjunto.
+- Stock de referencia: saldo por kardex; si el kardex aún no tiene
+  movimientos, `insumo.cantidad_disponible` (misma regla de siempre). Se
+  compara lo disponible para prometer: ese stock menos lo reservado por
+  pedidos fuera del conjunto (la reserva propia sí cuenta), igual que
+  services_produccion. Las líneas ya producidas no suman demanda.
+- `catalogo()` es la lista (id, nombre) para combos y búsquedas, guardada
+  en memoria del proceso. Se invalida con `catalogo_cambio()` al crear,
+  editar o borrar insumos; los demás workers lo notan por la versión en
+  `proceso_cursor`, que se revisa como mucho cada VERIFICAR_S segundos:
+  entre revisiones un acierto no hace ninguna consulta.
+"""
+import threading
+import time as _time
+from dataclasses import dataclass, field
+from decimal import Decimal
+
+from django.db import connection
+
+from . import services_kardex
+from .utils import guardar_cursor, leer_cursor
+
+CERO = Decimal("0")
+CURSOR_CATALOGO = "insumos.catalogo.version"
+TTL_CATALOGO_S = 600
+VERIFICAR_S = 5
+
+_catalogo = None  # (version, creado, [(id, nombre), ...])
+_verificado_en = 0.0
+_lock = threading.Lock()
+
+
+@dataclass
+class Requerimientos:
+    # {(pedido_id, producto_id, sabor_id): [check, ...]} — un check por insumo de la receta
+    lineas: dict = field(default_factory=dict)
+    # {insumo_id: {insumo, um, stock, necesario, faltante}} — demanda sumada entre líneas
+    insumos: dict = field(default_factory=dict)
+
+    def checks(self, pedido_id: int, producto_id: int, sabor_id: int) -> list[dict]:
+        return self.lineas.get((pedido_id, producto_id, sabor_id), [])
+
+    def linea_ok(self, pedido_id: int, producto_id: int, sabor_id: int) -> bool:
+        return all(c["faltante"] <= 0 for c in self.checks(pedido_id, producto_id, sabor_id))
+
+    @property
+    def faltantes(self) -> list[dict]:
+        return [i for i in self.insumos.values() if i["faltante"] > 0]
+
+    @property
+    def ok(self) -> bool:
+        return not self.faltantes
+
+
+def _stock_ref(stock_kardex, stock_db) -> Decimal:
+    stock = Decimal(stock_kardex or 0)
+    if not stock:  # si kardex aún no tiene movimientos, usa el stock_db
+        stock = Decimal(stock_db or 0)
+    return stock
+
+
+def requerimientos(pedido_ids: list[int]) -> Requerimientos:
+    """Líneas × receta de los pedidos con el stock actual, en una consulta."""
+    ids = list(dict.fromkeys(int(i) for i in pedido_ids))
+    req = Requerimientos()
+    if not ids:
+        return req
+    marks = ",".join(["%s"] * len(ids))
+    # Saldo sólo de los insumos de estos pedidos
+    saldos_sql = services_kardex.sql_saldos(f"""
+        SELECT r2.insumo_id
+        FROM detalle_pedido dp2
+        JOIN receta r2 ON r2.producto_id = dp2.producto_id
+        WHERE dp2.pedido_id IN ({marks})
+    """)
+
+    with connection.cursor() as cur:
+        cur.execute(f"""
+            SELECT dp.pedido_id, dp.producto_id, dp.sabor_id,
+                   r.insumo_id, i.nombre AS insumo, i.unidad_medida AS um,
+                   i.cantidad_disponible AS stock_db,
+                   COALESCE(s.saldo, 0) AS stock_kardex,
+                   i.cantidad_reservada - COALESCE(ri.propia, 0) AS reservada_otros,
+                   r.cantidad * dp.cantidad AS necesario,
+                   pl.pedido_id IS NOT NULL AS producida
+            FROM detalle_pedido dp
+            JOIN receta r ON r.producto_id = dp.producto_id
+            JOIN insumo i ON i.id = r.insumo_id
+            LEFT JOIN ({saldos_sql}) s ON s.insumo_id = r.insumo_id
+            LEFT JOIN (
+                SELECT insumo_id, SUM(cantidad) AS propia
+                FROM reserva_insumo
+                WHERE pedido_id IN ({marks})
+                GROUP BY insumo_id
+            ) ri ON ri.insumo_id = r.insumo_id
+            LEFT JOIN produccion_linea pl
+              ON pl.pedido_id = dp.pedido_id AND pl.producto_id = dp.producto_id
+             AND pl.sabor_id = dp.sabor_id
+            WHERE dp.pedido_id IN ({marks})
+            ORDER BY dp.pedido_id, dp.producto_id, dp.sabor_id, i.nombre
+        """, ids + ids + ids)
+        cols = [c[0] for c in cur.description]
+        filas = [dict(zip(cols, r)) for r in cur.fetchall()]
+
+    for f in filas:
+        clave = (f.pop("pedido_id"), f.pop("producto_id"), f.pop("sabor_id"))
+        f["producida"] = bool(f["producida"])
+        # Una línea ya producida no pide nada más
+        f["necesario"] = CERO if f["producida"] else Decimal(f["necesario"])
+        f["atp"] = _stock_ref(f["stock_kardex"], f["stock_db"]) - max(Decimal(f.pop("reservada_otros") or 0), CERO)
+        f["faltante"] = max(f["necesario"] - f["atp"], CERO)
+        req.lineas.setdefault(clave, []).append(f)
+
+        tot = req.insumos.setdefault(f["insumo_id"], {
+            "insumo_id": f["insumo_id"], "insumo": f["insumo"], "um": f["um"],
+            "stock": f["atp"], "necesario": CERO,
+        })
+        tot["necesario"] += f["necesario"]
+
+    for tot in req.insumos.values():
+        tot["faltante"] = max(tot["necesario"] - tot["stock"], CERO)
+    return req
+
+
+# -----------------------
+# Catálogo en memoria
+# -----------------------
+def catalogo() -> list[tuple[int, str]]:
+    """[(insumo_id, nombre)] ordenado por nombre."""
+    global _catalogo, _verificado_en
+    ahora = _time.monotonic()
+    with _lock:
+        c = _catalogo
+        if c is not None and ahora - c[1] < TTL_CATALOGO_S and ahora - _verificado_en < VERIFICAR_S:
+            return c[2]
+
+    version = leer_cursor(CURSOR_CATALOGO)
+    with _lock:
+        c = _catalogo
+        if c is not None and c[0] == version and ahora - c[1] < TTL_CATALOGO_S:
+            _verificado_en = ahora
+            return c[2]
+
+    with connection.cursor() as cur:
+        cur.execute("SELECT id, nombre FROM insumo ORDER BY nombre")
+        filas = cur.fetchall()
+    with _lock:
+        _catalogo, _verificado_en = (version, ahora, filas), ahora
+    return filas
+
+
+def catalogo_cambio():
+    """Un insumo se creó, renombró o borró."""
+    global _catalogo
+    with _lock:
+        _catalogo = None
+    guardar_cursor(CURSOR_CATALOGO, _time.time_ns() // 1000)
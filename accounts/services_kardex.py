@@ -0,0 +1,544 @@
+# accounts/services_kardex.py
+"""
+Saldo de insumos por kardex con puntos de control.
+
+- `kardex_snapshot` guarda, por insumo, el saldo de todos sus movimientos
+  con id <= hasta_id. El saldo actual es el último punto + la suma de los
+  movimientos posteriores: el costo depende de lo reciente, no del historial.
+- `tomar_snapshots()` (comando `snapshot_kardex`, programado) agrega un
+  punto por insumo con movimientos nuevos. Sólo cubre ids hasta el máximo
+  visto en la pasada anterior: un id menor que aún no hizo commit no puede
+  quedar saltado por el punto de control.
+- `reconstruir(desde, hasta)` rehace los puntos de fin de día de un rango
+  sumando el historial completo (para reparar o sembrar).
+- Cada movimiento lleva `saldo_resultante` (stock del insumo después del
+  movimiento), escrito por `registrar_movimiento()` bajo el mismo lock de
+  fila que actualiza `insumo.cantidad_disponible`. `saldo_al()` es una
+  lectura indexada y `deriva()` compara la última fila con el insumo.
+- Regla de fechas: un movimiento con fecha explícita no puede ser futuro
+  ni anterior al último movimiento del insumo (`FechaFueraDeOrden`). Así
+  el orden por (fecha, id) de cada insumo es el mismo orden por id en que
+  se escribió saldo_resultante.
+- `registrar_movimientos()` hace lo mismo para muchas filas: un SELECT
+  ... FOR UPDATE ordenado, validación en memoria, un UPDATE ... CASE y un
+  bulk_create del kardex, con resultado por fila.
+- `pagina()` lista movimientos por keyset sobre (fecha, id): cada página
+  es un rango del índice, sin COUNT(*) ni OFFSET.
+- `exportar()` genera el CSV del kardex para contabilidad en bloques por
+  rango de id; en modo incremental sigue desde el último id exportado
+  (cursor `kardex.export.ultimo`). Bajo ASGI se sirve con
+  `exportar_async()`, que pide cada bloque en un hilo: StreamingHttpResponse
+  consumiría un generador síncrono entero en memoria antes de enviarlo.
+"""
+import csv
+import io
+import zlib
+from datetime import date, datetime, time, timedelta, timezone as dt_timezone
+from decimal import Decimal
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from .models_db import Kardex
+from .utils import guardar_cursor, leer_cursor, reintentar_si_deadlock
+
+CURSOR_TOPE = "kardex.snapshot.tope"
+CURSOR_EXPORT = "kardex.export.ultimo"
+CURSOR_EXPORT_TOPE = "kardex.export.tope"
+BLOQUE_EXPORT = 5000
+TIPOS = ("ENTRADA", "SALIDA", "AJUSTE")
+MOTIVOS = ("COMPRA", "CONSUMO", "AJUSTE")
+
+# Signo de cada movimiento (AJUSTE ya viene con signo)
+SQL_SIGNO = """
+    CASE
+        WHEN k.tipo = 'ENTRADA' THEN k.cantidad
+        WHEN k.tipo = 'SALIDA'  THEN -k.cantidad
+        WHEN k.tipo = 'AJUSTE'  THEN k.cantidad
+        ELSE 0
+    END
+"""
+
+# Último punto de control de cada insumo
+_SQL_ULTIMO = """
+    SELECT ks.insumo_id, ks.hasta_id, ks.saldo
+    FROM kardex_snapshot ks
+    JOIN (
+        SELECT insumo_id, MAX(hasta_id) AS hasta_id
+        FROM kardex_snapshot
+        GROUP BY insumo_id
+    ) m ON m.insumo_id = ks.insumo_id AND m.hasta_id = ks.hasta_id
+"""
+
+
+# -----------------------
+# Movimientos
+# -----------------------
+def delta(tipo: str, cantidad) -> Decimal:
+    """Efecto del movimiento sobre el stock (AJUSTE ya viene con signo)."""
+    cantidad = Decimal(cantidad)
+    return -cantidad if tipo == "SALIDA" else cantidad
+
+
+class FechaFueraDeOrden(ValueError):
+    """La fecha pedida es futura o anterior al último movimiento del insumo."""
+
+
+def _fecha_explicita(fecha):
+    """Fecha aware para un movimiento fechado a mano; rechaza las futuras."""
+    if timezone.is_naive(fecha):
+        fecha = timezone.make_aware(fecha)
+    if fecha > timezone.now():
+        raise FechaFueraDeOrden("la fecha no puede ser futura")
+    return fecha
+
+
+def _con_movimientos_posteriores(cur, ids: list[int], fecha) -> set[int]:
+    """Insumos de `ids` con algún movimiento después de `fecha` (índice insumo_id, fecha)."""
+    if not ids:
+        return set()
+    cur.execute(f"""
+        SELECT DISTINCT insumo_id FROM kardex
+        WHERE insumo_id IN ({",".join(["%s"] * len(ids))}) AND fecha > %s
+    """, [*ids, fecha])
+    return {r[0] for r in cur.fetchall()}
+
+
+def registrar_movimiento(insumo_id: int, tipo: str, motivo: str, cantidad,
+                         observacion: str | None = None, fecha=None) -> Decimal:
+    """
+    Bloquea el insumo, aplica el movimiento a `cantidad_disponible` y lo
+    escribe en kardex con su saldo_resultante. Devuelve el saldo nuevo.
+    Una `fecha` explícita futura o anterior al último movimiento del insumo
+    lanza FechaFueraDeOrden.
+    """
+    if fecha is not None:
+        fecha = _fecha_explicita(fecha)
+    with transaction.atomic(savepoint=False):
+        with connection.cursor() as cur:
+            cur.execute(
+                "SELECT cantidad_disponible FROM insumo WHERE id=%s FOR UPDATE",
+                [insumo_id],
+            )
+            row = cur.fetchone()
+            if row is None:
+                raise ValueError(f"No existe el insumo {insumo_id}.")
+            if fecha is not None and _con_movimientos_posteriores(cur, [insumo_id], fecha):
+                raise FechaFueraDeOrden("el insumo tiene movimientos posteriores a esa fecha")
+            saldo = Decimal(row[0] or 0) + delta(tipo, cantidad)
+            cur.execute(
+                "UPDATE insumo SET cantidad_disponible=%s WHERE id=%s",
+                [saldo, insumo_id],
+            )
+            cur.execute("""
+                INSERT INTO kardex (insumo_id, fecha, tipo, motivo, cantidad,
+                                    observacion, saldo_resultante)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """, [insumo_id, fecha or timezone.now(), tipo, motivo, Decimal(cantidad),
+                  (observacion or "")[:200] or None, saldo])
+    return saldo
+
+
+@reintentar_si_deadlock()
+def registrar_movimientos(filas: list[dict], fecha=None, todo_o_nada: bool = False) -> list[dict]:
+    """
+    Aplica varias filas {insumo_id, tipo, motivo, cantidad, observacion} en
+    una transacción. Cada fila se valida en orden sobre el saldo que dejan
+    las anteriores (una SALIDA no puede dejar stock negativo; un AJUSTE es
+    un delta con signo). Devuelve por fila {fila, insumo_id, ok, error, saldo}.
+    Con `todo_o_nada`, si alguna falla no se escribe ninguna. Con `fecha`
+    explícita se rechazan las filas de insumos con movimientos posteriores.
+    """
+    error_fecha = None
+    if fecha is not None:
+        try:
+            fecha = _fecha_explicita(fecha)
+        except FechaFueraDeOrden as e:
+            error_fecha = str(e)
+    resultados = []
+    for n, f in enumerate(filas, start=1):
+        r = {"fila": n, "insumo_id": f.get("insumo_id"), "ok": False, "error": None, "saldo": None}
+        try:
+            cantidad = Decimal(str(f.get("cantidad")))
+        except Exception:
+            cantidad = None
+        if f.get("tipo") not in TIPOS:
+            r["error"] = "tipo inválido"
+        elif f.get("motivo") not in MOTIVOS:
+            r["error"] = "motivo inválido"
+        elif cantidad is None or not cantidad.is_finite():
+            r["error"] = "cantidad inválida"
+        elif cantidad == 0 or (cantidad < 0 and f["tipo"] != "AJUSTE"):
+            r["error"] = "la cantidad debe ser positiva (o un delta no nulo en AJUSTE)"
+        elif error_fecha:
+            r["error"] = error_fecha
+        else:
+            r["_cantidad"] = cantidad
+        resultados.append(r)
+
+    ids = sorted({int(r["insumo_id"]) for r in resultados
+                  if not r["error"] and str(r["insumo_id"]).isdigit()})
+    with transaction.atomic():
+        with connection.cursor() as cur:
+            stock = {}
+            if ids:
+                cur.execute(f"""
+                    SELECT id, cantidad_disponible FROM insumo
+                    WHERE id IN ({",".join(["%s"] * len(ids))}) ORDER BY id FOR UPDATE
+                """, ids)
+                stock = {iid: Decimal(d or 0) for iid, d in cur.fetchall()}
+            posteriores = _con_movimientos_posteriores(cur, sorted(stock), fecha) if fecha else set()
+            fecha = fecha or timezone.now()
+
+            nuevos = []
+            for r, f in zip(resultados, filas):
+                if r["error"]:
+                    continue
+                iid = int(r["insumo_id"])
+                if iid not in stock:
+                    r["error"] = "insumo inexistente"
+                    continue
+                if iid in posteriores:
+                    r["error"] = "el insumo tiene movimientos posteriores a esa fecha"
+                    continue
+                saldo = stock[iid] + delta(f["tipo"], r["_cantidad"])
+                if f["tipo"] == "SALIDA" and saldo < 0:
+                    r["error"] = f"stock insuficiente (hay {stock[iid]})"
+                    continue
+                stock[iid] = r["saldo"] = saldo
+                r["ok"] = True
+                nuevos.append(Kardex(
+                    insumo_id=iid, fecha=fecha, tipo=f["tipo"], motivo=f["motivo"],
+                    cantidad=r["_cantidad"],
+                    observacion=(f.get("observacion") or "").strip()[:200] or None,
+                    saldo_resultante=saldo,
+                ))
+
+            if not nuevos or (todo_o_nada and any(r["error"] for r in resultados)):
+                for r in resultados:
+                    r.pop("_cantidad", None)
+                    if todo_o_nada and r["ok"]:
+                        r["ok"], r["saldo"] = False, None
+                return resultados
+
+            tocados = sorted({k.insumo_id for k in nuevos})
+            casos = " ".join(["WHEN %s THEN %s"] * len(tocados))
+            cur.execute(f"""
+                UPDATE insumo SET cantidad_disponible = CASE id {casos} END
+                WHERE id IN ({",".join(["%s"] * len(tocados))})
+            """, [v for iid in tocados for v in (iid, stock[iid])] + tocados)
+        Kardex.objects.bulk_create(nuevos, batch_size=500)
+
+    for r in resultados:
+        r.pop("_cantidad", None)
+    return resultados
+
+
+def pagina(insumo_id: int | None = None, antes: int | None = None, n: int = 20):
+    """
+    (movimientos, siguiente): hasta `n` movimientos del más reciente al más
+    antiguo, anteriores al movimiento `antes` en orden (fecha, id).
+    `siguiente` es el id a pasar como `antes` para la página más antigua,
+    o None si no hay más.
+    """
+    from django.db.models import Q
+
+    qs = Kardex.objects.all()
+    if insumo_id:
+        qs = qs.filter(insumo_id=insumo_id)
+    if antes:
+        ref = Kardex.objects.filter(pk=antes).values_list("fecha", "id").first()
+        if ref:
+            fecha, kid = ref
+            qs = qs.filter(Q(fecha__lt=fecha) | Q(fecha=fecha, id__lt=kid))
+    filas = list(qs.order_by("-fecha", "-id")[:n + 1])
+    siguiente = filas[n - 1].id if len(filas) > n else None
+    return filas[:n], siguiente
+
+
+def saldo_al(insumo_id: int, momento) -> Decimal | None:
+    """
+    Stock del insumo en `momento`: saldo_resultante del último movimiento
+    con fecha <= momento (índice insumo_id, fecha, id). None si no hay.
+    Vale porque las fechas de un insumo no retroceden (ver la regla de
+    fechas arriba): el último por fecha es el último escrito.
+    """
+    with connection.cursor() as cur:
+        cur.execute("""
+            SELECT saldo_resultante FROM kardex
+            WHERE insumo_id=%s AND fecha <= %s
+            ORDER BY fecha DESC, id DESC
+            LIMIT 1
+        """, [insumo_id, momento])
+        row = cur.fetchone()
+    return Decimal(row[0]) if row and row[0] is not None else None
+
+
+def deriva() -> list[dict]:
+    """Insumos cuyo stock no coincide con el saldo_resultante de su último movimiento."""
+    with connection.cursor() as cur:
+        cur.execute("""
+            SELECT i.id AS insumo_id, i.nombre AS insumo, i.cantidad_disponible AS stock,
+                   k.saldo_resultante AS saldo_kardex, k.id AS kardex_id
+            FROM insumo i
+            JOIN (
+                SELECT insumo_id, MAX(id) AS id FROM kardex GROUP BY insumo_id
+            ) u ON u.insumo_id = i.id
+            JOIN kardex k ON k.id = u.id
+            WHERE k.saldo_resultante IS NOT NULL
+              AND k.saldo_resultante <> i.cantidad_disponible
+            ORDER BY i.nombre
+        """)
+        cols = [c[0] for c in cur.description]
+        return [dict(zip(cols, r)) for r in cur.fetchall()]
+
+
+# -----------------------
+# Saldo por movimientos
+# -----------------------
+def sql_saldos(insumos_sql: str) -> str:
+    """
+    Tabla derivada (insumo_id, saldo) para los insumos que devuelve
+    `insumos_sql` (un SELECT con columna insumo_id; los parámetros son
+    los de ese SELECT).
+    """
+    return f"""
+        SELECT b.insumo_id, COALESCE(s.saldo, 0) + COALESCE(SUM({SQL_SIGNO}), 0) AS saldo
+        FROM (SELECT DISTINCT x.insumo_id FROM ({insumos_sql}) x) b
+        LEFT JOIN kardex_snapshot s
+          ON s.insumo_id = b.insumo_id
+         AND s.hasta_id = (SELECT MAX(s2.hasta_id) FROM kardex_snapshot s2
+                           WHERE s2.insumo_id = b.insumo_id)
+        LEFT JOIN kardex k
+          ON k.insumo_id = b.insumo_id AND k.id > COALESCE(s.hasta_id, 0)
+        GROUP BY b.insumo_id, s.saldo
+    """
+
+
+def saldos(insumo_ids: list[int]) -> dict[int, Decimal]:
+    """{insumo_id: saldo por kardex} de los insumos dados."""
+    ids = list(dict.fromkeys(int(i) for i in insumo_ids))
+    if not ids:
+        return {}
+    marks = ",".join(["%s"] * len(ids))
+    with connection.cursor() as cur:
+        cur.execute(sql_saldos(f"SELECT id AS insumo_id FROM insumo WHERE id IN ({marks})"), ids)
+        return {iid: Decimal(saldo) for iid, saldo in cur.fetchall()}
+
+
+def tomar_snapshots() -> int:
+    """
+    Nuevo punto de control para cada insumo con movimientos desde el
+    anterior. Devuelve cuántos puntos escribió.
+    """
+    tope = leer_cursor(CURSOR_TOPE)
+    with transaction.atomic():
+        with connection.cursor() as cur:
+            cur.execute("SELECT COALESCE(MAX(id), 0) FROM kardex")
+            siguiente_tope = cur.fetchone()[0]
+            escritos = 0
+            if tope:
+                cur.execute(f"""
+                    INSERT INTO kardex_snapshot (insumo_id, hasta_id, saldo, corte)
+                    SELECT k.insumo_id, MAX(k.id), COALESCE(s.saldo, 0) + SUM({SQL_SIGNO}), NOW()
+                    FROM kardex k
+                    LEFT JOIN ({_SQL_ULTIMO}) s ON s.insumo_id = k.insumo_id
+                    WHERE k.id > COALESCE(s.hasta_id, 0) AND k.id <= %s
+                    GROUP BY k.insumo_id, s.saldo
+                """, [tope])
+                escritos = cur.rowcount
+        guardar_cursor(CURSOR_TOPE, siguiente_tope)
+    return escritos
+
+
+def reconstruir(desde: date, hasta: date) -> int:
+    """
+    Rehace los puntos de fin de día entre `desde` y `hasta` (inclusive):
+    para cada día, el saldo de cada insumo hasta su último movimiento con
+    fecha anterior al corte (00:00 del día siguiente). Devuelve cuántos
+    puntos escribió.
+    """
+    tope = leer_cursor(CURSOR_TOPE)
+    tz = timezone.get_current_timezone()
+    ini = timezone.make_aware(datetime.combine(desde + timedelta(days=1), time.min), tz)
+    fin = timezone.make_aware(datetime.combine(hasta + timedelta(days=1), time.min), tz)
+    escritos = 0
+    with transaction.atomic():
+        with connection.cursor() as cur:
+            cur.execute(
+                "DELETE FROM kardex_snapshot WHERE corte >= %s AND corte <= %s",
+                [ini, fin],
+            )
+            corte = ini
+            while corte <= fin:
+                # Cada punto es autosuficiente: suma todo hasta su hasta_id
+                cur.execute(f"""
+                    INSERT INTO kardex_snapshot (insumo_id, hasta_id, saldo, corte)
+                    SELECT m.insumo_id, m.hasta_id, SUM({SQL_SIGNO}), %s
+                    FROM (
+                        SELECT insumo_id, MAX(id) AS hasta_id
+                        FROM kardex
+                        WHERE fecha < %s AND (%s = 0 OR id <= %s)
+                        GROUP BY insumo_id
+                    ) m
+                    JOIN kardex k ON k.insumo_id = m.insumo_id AND k.id <= m.hasta_id
+                    GROUP BY m.insumo_id, m.hasta_id
+                    ON DUPLICATE KEY UPDATE saldo = VALUES(saldo), corte = VALUES(corte)
+                """, [corte, corte, tope, tope])
+                escritos += cur.rowcount
+                corte += timedelta(days=1)
+    return escritos
+
+
+# -----------------------
+# Exportación
+# -----------------------
+COLUMNAS_EXPORT = [
+    "id", "fecha", "insumo_id", "insumo", "unidad", "tipo", "motivo", "cantidad",
+    "saldo", "costo_unitario", "valor_movimiento", "valor_saldo", "observacion",
+]
+
+
+def _costos() -> dict[int, Decimal]:
+    """{insumo_id: costo_unitario} de la última compra recepcionada de cada insumo."""
+    with connection.cursor() as cur:
+        cur.execute("""
+            SELECT insumo_id, costo_unitario FROM (
+                SELECT cd.insumo_id, cd.costo_unitario,
+                       ROW_NUMBER() OVER (PARTITION BY cd.insumo_id
+                                          ORDER BY c.fecha_recepcion DESC, cd.id DESC) AS n
+                FROM compra_detalle cd
+                JOIN compra c ON c.id = cd.compra_id
+                WHERE c.recepcionada = 1
+            ) x WHERE n = 1
+        """)
+        return {iid: Decimal(c) for iid, c in cur.fetchall()}
+
+
+def _fecha_local(fecha: datetime) -> str:
+    # Las consultas crudas devuelven fechas naive en UTC (USE_TZ sin TIME_ZONE de BD)
+    if timezone.is_naive(fecha):
+        fecha = timezone.make_aware(fecha, dt_timezone.utc)
+    return timezone.localtime(fecha).isoformat()
+
+
+def exportar(desde: date | None = None, hasta: date | None = None,
+             insumo_id: int | None = None, incremental: bool = False, avanzar: bool = False,
+             comprimir: bool = False):
+    """
+    Generador de bytes del CSV (o gzip) del kardex en orden de id, para
+    StreamingHttpResponse. La cabecera sale antes de la primera consulta.
+
+    - Lee de a BLOQUE_EXPORT filas con `id > último` (rango del PK): la
+      memoria no depende del tamaño del kardex y ninguna consulta queda
+      abierta mientras el cliente descarga.
+    - Valorización al costo de la última compra recepcionada del insumo.
+    - `incremental`: sólo movimientos posteriores a la exportación anterior
+      y hasta el id máximo que vio esa exportación, como en
+      tomar_snapshots(): un id menor todavía sin commit al leer el máximo
+      ya está escrito en la corrida siguiente. La primera corrida sólo fija
+      el tope. El cursor es global, así que en este modo no se aplican
+      filtros de fecha ni insumo.
+    - `avanzar`: con `incremental`, mueve el cursor si la descarga llegó al
+      final. Sin él la exportación es una vista previa de lo pendiente.
+    """
+    gz = zlib.compressobj(wbits=31) if comprimir else None
+    buf = io.StringIO()
+    w = csv.writer(buf)
+
+    def _salida(final=False) -> bytes:
+        datos = buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+        if gz is not None:
+            # SYNC_FLUSH: cada bloque sale completo, sin esperar al final
+            datos = gz.compress(datos) + gz.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+        return datos
+
+    w.writerow(COLUMNAS_EXPORT)
+    yield _salida()
+
+    tz = timezone.get_current_timezone()
+    where, params = ["k.id > %s", "k.id <= %s"], []
+    if incremental:
+        desde = hasta = insumo_id = None
+    if desde:
+        where.append("k.fecha >= %s")
+        params.append(timezone.make_aware(datetime.combine(desde, time.min), tz))
+    if hasta:
+        where.append("k.fecha < %s")
+        params.append(timezone.make_aware(datetime.combine(hasta + timedelta(days=1), time.min), tz))
+    if insumo_id:
+        where.append("k.insumo_id = %s")
+        params.append(insumo_id)
+
+    ultimo = leer_cursor(CURSOR_EXPORT) if incremental else 0
+    costos = _costos()
+    with connection.cursor() as cur:
+        cur.execute("SELECT COALESCE(MAX(id), 0) FROM kardex")
+        maximo = cur.fetchone()[0]
+    tope = leer_cursor(CURSOR_EXPORT_TOPE) if incremental else maximo
+
+    sql = f"""
+        SELECT k.id, k.fecha, k.insumo_id, i.nombre, i.unidad_medida, k.tipo, k.motivo,
+               k.cantidad, k.saldo_resultante, k.observacion
+        FROM kardex k
+        JOIN insumo i ON i.id = k.insumo_id
+        WHERE {" AND ".join(where)}
+        ORDER BY k.id
+        LIMIT {BLOQUE_EXPORT}
+    """
+    desde_id = ultimo
+    while desde_id < tope:
+        with connection.cursor() as cur:
+            cur.execute(sql, [desde_id, tope] + params)
+            filas = cur.fetchall()
+        if not filas:
+            break
+        for kid, fecha, iid, nombre, um, tipo, motivo, cant, saldo, obs in filas:
+            costo = costos.get(iid)
+            w.writerow([
+                kid, _fecha_local(fecha) if fecha else "", iid, nombre, um,
+                tipo, motivo, cant, "" if saldo is None else saldo,
+                "" if costo is None else costo,
+                "" if costo is None else f"{delta(tipo, cant) * costo:.2f}",
+                "" if costo is None or saldo is None else f"{saldo * costo:.2f}",
+                obs or "",
+            ])
+        desde_id = filas[-1][0]
+        yield _salida()
+
+    if incremental and avanzar:
+        with transaction.atomic():
+            guardar_cursor(CURSOR_EXPORT, max(tope, ultimo))
+            guardar_cursor(CURSOR_EXPORT_TOPE, maximo)
+    final = _salida(final=True)
+    if final:
+        yield final
+
+
+def _siguiente_bloque(gen) -> bytes | None:
+    try:
+        return next(gen)
+    except StopIteration:
+        return None
+    finally:
+        close_old_connections()
+
+
+async def exportar_async(**filtros):
+    """
+    `exportar()` como generador asíncrono: cada bloque (una consulta de
+    BLOQUE_EXPORT filas) se produce en un hilo con sync_to_async y se
+    entrega en cuanto está listo, sin leer el resto del kardex.
+    """
+    gen = exportar(**filtros)
+    siguiente = sync_to_async(_siguiente_bloque, thread_sensitive=False)
+    try:
+        while (datos := await siguiente(gen)) is not None:
+            yield datos
+    finally:
+        # Si se canceló a mitad de un bloque, el hilo sigue dentro del generador
+        if not gen.gi_running:
+            gen.close()
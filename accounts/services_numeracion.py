@@ -0,0 +1,264 @@
+# accounts/services_numeracion.py
+"""
+Numeración fiscal de facturas por serie, con reserva de bloques.
+
+- `factura_serie` guarda el próximo número libre de cada serie.
+- Cada proceso reserva un bloque de `bloque` números en una transacción
+  corta sobre su propia conexión (el lock de la fila dura sólo eso, no la
+  transacción de la factura) y lo reparte desde memoria: la mayoría de las
+  facturas no tocan el contador.
+- `numero_factura()` entrega el número junto con la transacción de la
+  factura: si esa transacción no llega al commit (IntegrityError, rollback)
+  el número vuelve al proceso con `devolver()` y lo toma la próxima factura.
+- Cada bloque queda registrado en `factura_bloque`; al terminar el proceso
+  se anota hasta dónde se usó y los devueltos que nadie reutilizó van a
+  `factura_numero_libre`. `auditar_huecos()` cruza los bloques con
+  `factura` y clasifica los números que no llegaron a una factura.
+"""
+import atexit
+import heapq
+import os
+import socket
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+
+LIBERADO = "LIBERADO"    # sobrante o devuelto sin reutilizar al cerrar el proceso
+PENDIENTE = "PENDIENTE"  # bloque aún abierto (proceso vivo o caído sin cerrar)
+HUECO = "HUECO"          # número entregado que no terminó en factura
+
+
+@dataclass
+class _Bloque:
+    id: int
+    serie: str
+    siguiente: int
+    hasta: int  # inclusive
+    pid: int
+
+
+_bloques: dict[str, _Bloque] = {}
+# Números devueltos por transacciones que no confirmaron, por (serie, pid):
+# un hijo de fork no reparte los devueltos del padre
+_devueltos: dict[tuple[str, int], list[int]] = {}
+_lock = threading.Lock()
+
+
+def _proceso() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def serie_por_defecto() -> str:
+    return getattr(settings, "FACTURA_SERIE", "F")
+
+
+def formatear(serie: str, numero: int) -> str:
+    """Número visible de la factura (mismo formato que las F-<n> históricas)."""
+    return f"{serie}-{numero}"
+
+
+def _reservar_bloque(serie: str, tam: int | None = None, cerrado: bool = False) -> _Bloque:
+    """
+    Toma el siguiente bloque de la serie en una transacción propia.
+    `tam` fuerza el tamaño (si no, el `bloque` de la serie); `cerrado` lo
+    registra ya consumido entero (emisión por lote).
+    """
+    conn = connections.create_connection(DEFAULT_DB_ALIAS)
+    try:
+        conn.set_autocommit(False)
+        with conn.cursor() as cur:
+            cur.execute("INSERT IGNORE INTO factura_serie (serie) VALUES (%s)", [serie])
+            cur.execute(
+                "SELECT siguiente, bloque FROM factura_serie WHERE serie=%s FOR UPDATE",
+                [serie],
+            )
+            desde, tam_serie = cur.fetchone()
+            hasta = desde + (tam or tam_serie) - 1
+            cur.execute(
+                "UPDATE factura_serie SET siguiente = %s WHERE serie=%s",
+                [hasta + 1, serie],
+            )
+            cur.execute(
+                """
+                INSERT INTO factura_bloque (serie, desde, hasta, proceso, liberado_en, usado_hasta)
+                VALUES (%s, %s, %s, %s, IF(%s, NOW(), NULL), %s)
+                """,
+                [serie, desde, hasta, _proceso(), cerrado, hasta if cerrado else None],
+            )
+            bloque_id = cur.lastrowid
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return _Bloque(bloque_id, serie, desde, hasta, os.getpid())
+
+
+def siguiente_numero(serie: str | None = None) -> tuple[str, int]:
+    """
+    (serie, número) siguiente: primero los devueltos, después el bloque.
+    Sólo va a la BD cuando se agota el bloque.
+    """
+    serie = serie or serie_por_defecto()
+    with _lock:
+        libres = _devueltos.get((serie, os.getpid()))
+        if libres:
+            return serie, heapq.heappop(libres)
+        b = _bloques.get(serie)
+        # Un bloque heredado por fork pertenece al padre: no se comparte
+        if b is None or b.siguiente > b.hasta or b.pid != os.getpid():
+            b = _reservar_bloque(serie)
+            _bloques[serie] = b
+        numero = b.siguiente
+        b.siguiente += 1
+    return serie, numero
+
+
+def reservar_rango(n: int, serie: str | None = None) -> tuple[str, int, int]:
+    """(serie, desde, hasta) contiguos para `n` facturas, en un solo viaje a la BD."""
+    serie = serie or serie_por_defecto()
+    b = _reservar_bloque(serie, tam=n, cerrado=True)
+    return serie, b.siguiente, b.hasta
+
+
+def devolver(serie: str, numeros) -> None:
+    """
+    Devuelve números que no terminaron en factura. El último entregado del
+    bloque abierto sólo retrocede el bloque; el resto queda para las
+    próximas facturas de este proceso.
+    """
+    pid = os.getpid()
+    with _lock:
+        b = _bloques.get(serie)
+        libres = _devueltos.setdefault((serie, pid), [])
+        for n in sorted(numeros, reverse=True):
+            if b is not None and b.pid == pid and n == b.siguiente - 1:
+                b.siguiente -= 1
+            else:
+                heapq.heappush(libres, n)
+
+
+@contextmanager
+def numero_factura(serie: str | None = None):
+    """
+    with numero_factura() as (serie, numero): ... INSERT INTO factura ...
+
+    Abre la transacción de la factura. Si el bloque sale con excepción o el
+    commit falla, el número se devuelve. Tiene que ser la transacción
+    externa: dentro de otra, un rollback posterior dejaría el hueco.
+    """
+    if connection.in_atomic_block:
+        raise RuntimeError("numero_factura() debe abrir su propia transacción")
+    serie, numero = siguiente_numero(serie)
+    try:
+        with transaction.atomic():
+            yield serie, numero
+    except BaseException:
+        devolver(serie, [numero])
+        raise
+
+
+@atexit.register
+def liberar_bloques():
+    """
+    Anota hasta dónde se usó cada bloque abierto y los números devueltos
+    que no se reutilizaron (para la auditoría).
+    """
+    pid = os.getpid()
+    with _lock:
+        abiertos = [b for b in _bloques.values() if b.pid == pid]
+        libres = [(serie, n) for (serie, p), ns in _devueltos.items() if p == pid for n in ns]
+        _bloques.clear()
+        _devueltos.clear()
+    if not abiertos and not libres:
+        return
+    try:
+        conn = connections.create_connection(DEFAULT_DB_ALIAS)
+        try:
+            with conn.cursor() as cur:
+                for b in abiertos:
+                    cur.execute(
+                        "UPDATE factura_bloque SET usado_hasta=%s, liberado_en=NOW() WHERE id=%s",
+                        [b.siguiente - 1, b.id],
+                    )
+                if libres:
+                    cur.execute(
+                        "INSERT IGNORE INTO factura_numero_libre (serie, numero) VALUES "
+                        + ",".join(["(%s,%s)"] * len(libres)),
+                        [v for par in libres for v in par],
+                    )
+        finally:
+            conn.close()
+    except Exception:
+        # Sin BD al apagar: el bloque queda PENDIENTE en la auditoría
+        pass
+
+
+# -----------------------
+# Auditoría
+# -----------------------
+def _rangos(numeros: list[int]) -> list[tuple[int, int]]:
+    out = []
+    for n in numeros:
+        if out and out[-1][1] == n - 1:
+            out[-1] = (out[-1][0], n)
+        else:
+            out.append((n, n))
+    return out
+
+
+def auditar_huecos(serie: str | None = None) -> list[dict]:
+    """
+    Números reservados que no tienen factura, agrupados en rangos:
+    [{serie, desde, hasta, estado, proceso}, ...]
+    """
+    serie = serie or serie_por_defecto()
+    with connection.cursor() as cur:
+        cur.execute("""
+            SELECT b.id, b.desde, b.hasta, b.proceso, b.liberado_en, b.usado_hasta,
+                   COUNT(f.id) AS usados
+            FROM factura_bloque b
+            LEFT JOIN factura f
+              ON f.serie = b.serie AND f.numero BETWEEN b.desde AND b.hasta
+            WHERE b.serie = %s
+            GROUP BY b.id, b.desde, b.hasta, b.proceso, b.liberado_en, b.usado_hasta
+            ORDER BY b.desde
+        """, [serie])
+        incompletos = [r for r in cur.fetchall() if r[6] < r[2] - r[1] + 1]
+
+        out = []
+        for _id, desde, hasta, proceso, liberado_en, usado_hasta, _usados in incompletos:
+            cur.execute(
+                "SELECT numero FROM factura WHERE serie=%s AND numero BETWEEN %s AND %s",
+                [serie, desde, hasta],
+            )
+            emitidos = {r[0] for r in cur.fetchall()}
+            cur.execute(
+                "SELECT numero FROM factura_numero_libre WHERE serie=%s AND numero BETWEEN %s AND %s",
+                [serie, desde, hasta],
+            )
+            devueltos = {r[0] for r in cur.fetchall()}
+            faltan = [n for n in range(desde, hasta + 1) if n not in emitidos]
+            for a, z in _rangos([n for n in faltan if n in devueltos]):
+                out.append({"serie": serie, "desde": a, "hasta": z,
+                            "estado": LIBERADO, "proceso": proceso})
+            for a, z in _rangos([n for n in faltan if n not in devueltos]):
+                if liberado_en is None:
+                    estado = PENDIENTE
+                elif usado_hasta is not None and a > usado_hasta:
+                    estado = LIBERADO
+                else:
+                    estado = HUECO
+                    if usado_hasta is not None and z > usado_hasta:
+                        # El rango cruza el corte: separa lo entregado de lo devuelto
+                        out.append({"serie": serie, "desde": a, "hasta": usado_hasta,
+                                    "estado": HUECO, "proceso": proceso})
+                        a, estado = usado_hasta + 1, LIBERADO
+                out.append({"serie": serie, "desde": a, "hasta": z,
+                            "estado": estado, "proceso": proceso})
+    out.sort(key=lambda r: r["desde"])
+    return out
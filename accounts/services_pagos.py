@@ -0,0 +1,60 @@
+# accounts/services_pagos.py
+"""
+Libro de pagos para listados: pagado y saldo de muchos pedidos en una
+sola consulta agrupada sobre `pago`, memoizada durante el request.
+"""
+from decimal import Decimal
+
+from django.db import connection
+
+_ATTR_MEMO = "_totales_pagados"
+
+
+def totales_pagados(ids, request=None) -> dict[int, Decimal]:
+    """
+    {pedido_id: suma de pago.monto} para los ids dados (0 si no hay pagos).
+    Con `request`, los resultados se recuerdan y sólo se consultan ids nuevos.
+    """
+    ids = {int(i) for i in ids if i is not None}
+    memo = getattr(request, _ATTR_MEMO, None) if request is not None else None
+    if memo is None:
+        memo = {}
+        if request is not None:
+            setattr(request, _ATTR_MEMO, memo)
+
+    faltan = sorted(ids - memo.keys())
+    if faltan:
+        memo.update({i: Decimal("0") for i in faltan})
+        marks = ",".join(["%s"] * len(faltan))
+        with connection.cursor() as cur:
+            cur.execute(f"""
+                SELECT pedido_id, COALESCE(SUM(monto), 0)
+                FROM pago
+                WHERE pedido_id IN ({marks})
+                GROUP BY pedido_id
+            """, faltan)
+            for pid, suma in cur.fetchall():
+                memo[int(pid)] = Decimal(str(suma or 0))
+
+    return {i: memo[i] for i in ids}
+
+
+def anotar_saldos(pedidos, request=None, id_attr: str = "id", total_attr: str = "total"):
+    """
+    Agrega `pagado` y `saldo` a cada pedido (objeto o dict) de la lista.
+    Devuelve la misma lista para poder encadenar.
+    """
+    pedidos = list(pedidos)
+
+    def _get(p, attr):
+        return p.get(attr) if isinstance(p, dict) else getattr(p, attr, None)
+
+    totales = totales_pagados((_get(p, id_attr) for p in pedidos), request)
+    for p in pedidos:
+        pagado = totales.get(int(_get(p, id_attr)), Decimal("0"))
+        saldo = Decimal(str(_get(p, total_attr) or 0)) - pagado
+        if isinstance(p, dict):
+            p["pagado"], p["saldo"] = pagado, saldo
+        else:
+            p.pagado, p.saldo = pagado, saldo
+    return pedidos
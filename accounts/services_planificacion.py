@@ -0,0 +1,128 @@
+# accounts/services_planificacion.py
+"""
+Plan de insumos para un horizonte de entregas (MRP simple).
+
+- `receta` se carga como matriz R (producto × insumo, cantidad por unidad).
+- La demanda es el vector d (por producto) de las líneas de pedidos
+  pendientes de producir con entrega dentro del horizonte. Las líneas ya
+  producidas una por una (`produccion_linea`) no cuentan.
+- Requerimiento = d @ R; faltante = max(requerimiento - stock, 0);
+  máximo producible de cada producto = min_i(stock_i / R[p, i]) sobre los
+  insumos de su receta, con el stock completo para ese producto.
+- Cuatro consultas fijas (demanda, pedidos, insumos, receta) sin importar
+  cuántos pedidos haya; el resto es álgebra de NumPy en memoria.
+"""
+from dataclasses import dataclass, field
+from datetime import date, datetime, time, timedelta
+
+from django.db import connection
+from django.utils import timezone
+
+ESTADOS_PENDIENTES = ("CONFIRMADO", "EN_PRODUCCION")
+
+
+@dataclass
+class Plan:
+    desde: date
+    hasta: date  # exclusivo
+    pedidos: int = 0
+    # [{insumo_id, insumo, um, requerido, stock, faltante}] con requerido > 0
+    insumos: list = field(default_factory=list)
+    # [{producto_id, producto, demanda, max_producible, limitante, sin_receta}]
+    productos: list = field(default_factory=list)
+
+    @property
+    def faltantes(self) -> list[dict]:
+        return [i for i in self.insumos if i["faltante"] > 0]
+
+
+def _rango(desde: date, hasta: date):
+    tz = timezone.get_current_timezone()
+    return (timezone.make_aware(datetime.combine(desde, time.min), tz),
+            timezone.make_aware(datetime.combine(hasta, time.min), tz))
+
+
+def _fetch(sql: str, params=None) -> list[tuple]:
+    with connection.cursor() as cur:
+        cur.execute(sql, params or [])
+        return cur.fetchall()
+
+
+def planificar(desde: date | None = None, dias: int = 1,
+               estados: tuple = ESTADOS_PENDIENTES) -> Plan:
+    """Plan para las entregas en [desde, desde + dias). Por defecto, mañana."""
+    import numpy as np
+
+    desde = desde or timezone.localdate() + timedelta(days=1)
+    hasta = desde + timedelta(days=max(int(dias), 1))
+    plan = Plan(desde, hasta)
+    ini, fin = _rango(desde, hasta)
+    marks = ",".join(["%s"] * len(estados))
+
+    demanda = _fetch(f"""
+        SELECT dp.producto_id, pr.nombre, SUM(dp.cantidad)
+        FROM detalle_pedido dp
+        JOIN pedido   p  ON p.id = dp.pedido_id
+        JOIN producto pr ON pr.id = dp.producto_id
+        LEFT JOIN produccion_linea pl
+          ON pl.pedido_id = dp.pedido_id AND pl.producto_id = dp.producto_id
+         AND pl.sabor_id = dp.sabor_id
+        WHERE p.estado IN ({marks})
+          AND p.fecha_entrega_programada >= %s AND p.fecha_entrega_programada < %s
+          AND pl.pedido_id IS NULL
+        GROUP BY dp.producto_id, pr.nombre
+        ORDER BY pr.nombre
+    """, list(estados) + [ini, fin])
+    if not demanda:
+        return plan
+    plan.pedidos = _fetch(f"""
+        SELECT COUNT(DISTINCT dp.pedido_id)
+        FROM detalle_pedido dp
+        JOIN pedido p ON p.id = dp.pedido_id
+        LEFT JOIN produccion_linea pl
+          ON pl.pedido_id = dp.pedido_id AND pl.producto_id = dp.producto_id
+         AND pl.sabor_id = dp.sabor_id
+        WHERE p.estado IN ({marks})
+          AND p.fecha_entrega_programada >= %s AND p.fecha_entrega_programada < %s
+          AND pl.pedido_id IS NULL
+    """, list(estados) + [ini, fin])[0][0]
+
+    insumos = _fetch("SELECT id, nombre, unidad_medida, cantidad_disponible FROM insumo ORDER BY nombre")
+    recetas = _fetch("SELECT producto_id, insumo_id, cantidad FROM receta")
+
+    col = {iid: j for j, (iid, *_rest) in enumerate(insumos)}
+    fila = {pid: k for k, (pid, *_rest) in enumerate(demanda)}
+
+    R = np.zeros((len(demanda), len(insumos)))
+    for pid, iid, cant in recetas:
+        if pid in fila and iid in col:
+            R[fila[pid], col[iid]] = float(cant)
+    d = np.array([float(q) for _pid, _nombre, q in demanda])
+    stock = np.array([float(s or 0) for *_rest, s in insumos])
+
+    requerido = d @ R
+    faltante = np.maximum(requerido - stock, 0.0)
+
+    usa = R > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        alcance = np.where(usa, np.maximum(stock, 0.0) / np.where(usa, R, 1.0), np.inf)
+    max_prod = np.floor(alcance.min(axis=1))
+    limitante = alcance.argmin(axis=1)
+
+    for j in np.flatnonzero(requerido > 0):
+        iid, nombre, um, _s = insumos[j]
+        plan.insumos.append({
+            "insumo_id": iid, "insumo": nombre, "um": um,
+            "requerido": round(float(requerido[j]), 3),
+            "stock": round(float(stock[j]), 3),
+            "faltante": round(float(faltante[j]), 3),
+        })
+    for k, (pid, nombre, q) in enumerate(demanda):
+        sin_receta = not usa[k].any()
+        plan.productos.append({
+            "producto_id": pid, "producto": nombre, "demanda": int(q),
+            "max_producible": None if sin_receta else int(max_prod[k]),
+            "limitante": None if sin_receta else insumos[limitante[k]][1],
+            "sin_receta": sin_receta,
+        })
+    return plan
@@ -0,0 +1,243 @@
+# accounts/services_produccion.py
+"""
+Producción por lote: descuenta los insumos de todas las líneas de uno o
+más pedidos y los deja LISTO_ENTREGA.
+
+- Orden de locks fijo: primero los pedidos, después los insumos, cada uno
+  con un solo SELECT ... FOR UPDATE en orden ascendente de id.
+- Todo se valida en memoria: un pedido se produce entero o no se produce
+  (se informa qué le falta); los demás del lote siguen. Puede usar su
+  propia reserva de insumos pero no la de otros pedidos, y al producirse
+  la libera.
+- Las salidas van al kardex en un INSERT multi-fila (con saldo_resultante)
+  y el stock se ajusta con un único UPDATE ... CASE.
+- Las líneas producidas una por una (`producir_linea()`, desde
+  gestionar_produccion) quedan en `produccion_linea` y no se vuelven a
+  descontar al producir el pedido entero. Validan con la misma regla:
+  stock menos lo reservado por otros pedidos.
+- Si MySQL aborta por deadlock, la operación entera se reintenta.
+"""
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import services_despacho, services_eventos, services_horneado, services_reservas
+from .utils import reintentar_si_deadlock
+
+PRODUCIBLES = ("CONFIRMADO", "EN_PRODUCCION")
+CERO = Decimal("0")
+LOTE_KARDEX = 500
+
+
+def _marks(n: int) -> str:
+    return ",".join(["%s"] * n)
+
+
+def lineas_producidas(pedido_id: int) -> set[tuple[int, int]]:
+    """{(producto_id, sabor_id)} de las líneas del pedido ya producidas una por una."""
+    with connection.cursor() as cur:
+        cur.execute(
+            "SELECT producto_id, sabor_id FROM produccion_linea WHERE pedido_id=%s",
+            [pedido_id],
+        )
+        return set(cur.fetchall())
+
+
+def marcar_linea(pedido_id: int, producto_id: int, sabor_id: int) -> bool:
+    """
+    Anota la línea como producida. Llamar con el pedido bloqueado (FOR
+    UPDATE); devuelve False si ya lo estaba y no hay que descontar otra vez.
+    """
+    with connection.cursor() as cur:
+        cur.execute(
+            "SELECT 1 FROM produccion_linea WHERE pedido_id=%s AND producto_id=%s AND sabor_id=%s",
+            [pedido_id, producto_id, sabor_id],
+        )
+        if cur.fetchone():
+            return False
+        cur.execute(
+            "INSERT INTO produccion_linea (pedido_id, producto_id, sabor_id) VALUES (%s, %s, %s)",
+            [pedido_id, producto_id, sabor_id],
+        )
+    return True
+
+
+@reintentar_si_deadlock()
+def producir_linea(pedido_id: int, producto_id: int, sabor_id: int) -> bool:
+    """
+    Descuenta los insumos de una línea del pedido. Valida contra el stock
+    bloqueado menos lo reservado por otros pedidos (lo propio sí se usa) y
+    levanta StockInsuficiente si no alcanza. Devuelve False si la línea ya
+    estaba producida.
+    """
+    with transaction.atomic():
+        with connection.cursor() as cur:
+            cur.execute("SELECT id FROM pedido WHERE id=%s FOR UPDATE", [pedido_id])
+            if not marcar_linea(pedido_id, producto_id, sabor_id):
+                return False
+            cur.execute("""
+                SELECT r.insumo_id, dp.cantidad, r.cantidad * dp.cantidad AS necesario
+                FROM detalle_pedido dp
+                JOIN receta r ON r.producto_id = dp.producto_id
+                WHERE dp.pedido_id = %s AND dp.producto_id = %s AND dp.sabor_id = %s
+                ORDER BY r.insumo_id
+            """, [pedido_id, producto_id, sabor_id])
+            consumos = cur.fetchall()
+            if not consumos:
+                return True
+
+            necesario: dict[int, Decimal] = {}
+            for iid, _cant, nec in consumos:
+                necesario[iid] = necesario.get(iid, CERO) + Decimal(nec)
+            propio = services_reservas.reservas_de([pedido_id]).get(pedido_id, {})
+            cur.execute(f"""
+                SELECT id, nombre, cantidad_disponible, cantidad_reservada FROM insumo
+                WHERE id IN ({_marks(len(necesario))}) ORDER BY id FOR UPDATE
+            """, sorted(necesario))
+            faltantes, stock = [], {}
+            for iid, nombre, disp, res in cur.fetchall():
+                stock[iid] = Decimal(disp or 0)
+                atp = stock[iid] - Decimal(res or 0) + propio.get(iid, CERO)
+                if necesario[iid] > atp:
+                    faltantes.append({"insumo_id": iid, "insumo": nombre,
+                                      "atp": atp, "necesario": necesario[iid]})
+            if faltantes:
+                raise services_reservas.StockInsuficiente(faltantes)
+
+            ahora = timezone.now()
+            filas_kardex = []
+            for iid, cant, nec in consumos:
+                stock[iid] -= Decimal(nec)
+                filas_kardex.append([
+                    iid, ahora, "SALIDA", "CONSUMO", Decimal(nec),
+                    f"Pedido {pedido_id} – prod {producto_id}/{sabor_id} x{cant}", stock[iid],
+                ])
+            _escribir_consumos(cur, filas_kardex, stock)
+        # Lo consumido deja de estar reservado
+        services_reservas.descontar(pedido_id, necesario)
+        # La línea sale del programa de horneado
+        transaction.on_commit(lambda: services_horneado.pedido_cambio(pedido_id))
+    return True
+
+
+def _escribir_consumos(cur, filas_kardex: list, stock: dict):
+    """Salidas al kardex en INSERT multi-fila y stock final con un UPDATE ... CASE."""
+    for i in range(0, len(filas_kardex), LOTE_KARDEX):
+        bloque = filas_kardex[i:i + LOTE_KARDEX]
+        cur.execute(f"""
+            INSERT INTO kardex (insumo_id, fecha, tipo, motivo, cantidad,
+                                observacion, saldo_resultante)
+            VALUES {",".join(["(%s,%s,%s,%s,%s,%s,%s)"] * len(bloque))}
+        """, [v for fila in bloque for v in fila])
+
+    tocados = sorted({f[0] for f in filas_kardex})
+    if tocados:
+        casos = " ".join(["WHEN %s THEN %s"] * len(tocados))
+        params = [v for iid in tocados for v in (iid, stock[iid])]
+        cur.execute(f"""
+            UPDATE insumo SET cantidad_disponible = CASE id {casos} END
+            WHERE id IN ({_marks(len(tocados))})
+        """, params + tocados)
+
+
+@reintentar_si_deadlock()
+def producir_pedidos(pedido_ids) -> dict:
+    """
+    {"producidos": [pedido_id, ...], "rechazados": {pedido_id: motivo}}
+    """
+    ids = sorted({int(i) for i in pedido_ids})
+    producidos, rechazados = [], {}
+    if not ids:
+        return {"producidos": producidos, "rechazados": rechazados}
+
+    with transaction.atomic():
+        with connection.cursor() as cur:
+            cur.execute(
+                f"SELECT id, estado FROM pedido WHERE id IN ({_marks(len(ids))}) ORDER BY id FOR UPDATE",
+                ids,
+            )
+            estados = dict(cur.fetchall())
+            for pid in ids:
+                if pid not in estados:
+                    rechazados[pid] = "no existe"
+                elif estados[pid] not in PRODUCIBLES:
+                    rechazados[pid] = f"estado {estados[pid]}"
+            candidatos = [pid for pid in ids if pid not in rechazados]
+            if not candidatos:
+                return {"producidos": producidos, "rechazados": rechazados}
+
+            cur.execute(f"""
+                SELECT dp.pedido_id, dp.producto_id, dp.sabor_id, dp.cantidad,
+                       r.insumo_id, r.cantidad * dp.cantidad AS necesario
+                FROM detalle_pedido dp
+                JOIN receta r ON r.producto_id = dp.producto_id
+                LEFT JOIN produccion_linea pl
+                  ON pl.pedido_id = dp.pedido_id AND pl.producto_id = dp.producto_id
+                 AND pl.sabor_id = dp.sabor_id
+                WHERE dp.pedido_id IN ({_marks(len(candidatos))})
+                  AND pl.pedido_id IS NULL
+                ORDER BY dp.pedido_id, dp.producto_id, dp.sabor_id, r.insumo_id
+            """, candidatos)
+            consumos = cur.fetchall()
+
+            reservas = services_reservas.reservas_de(candidatos)
+            insumo_ids = sorted({c[4] for c in consumos}
+                                | {iid for r in reservas.values() for iid in r})
+            stock, reservado, nombres = {}, {}, {}
+            if insumo_ids:
+                cur.execute(f"""
+                    SELECT id, nombre, cantidad_disponible, cantidad_reservada FROM insumo
+                    WHERE id IN ({_marks(len(insumo_ids))}) ORDER BY id FOR UPDATE
+                """, insumo_ids)
+                for iid, nombre, disp, res in cur.fetchall():
+                    stock[iid], reservado[iid] = Decimal(disp or 0), Decimal(res or 0)
+                    nombres[iid] = nombre
+
+            por_pedido: dict[int, list] = {pid: [] for pid in candidatos}
+            for c in consumos:
+                por_pedido[c[0]].append(c)
+
+            # Validación en memoria, pedido por pedido en orden de id
+            ahora = timezone.now()
+            filas_kardex = []
+            for pid in candidatos:
+                necesario: dict[int, Decimal] = {}
+                for _p, _prod, _sab, _cant, iid, nec in por_pedido[pid]:
+                    necesario[iid] = necesario.get(iid, CERO) + Decimal(nec)
+                propio = reservas.get(pid, {})
+                # Stock usable: lo físico menos lo reservado por otros pedidos
+                usable = {
+                    iid: stock.get(iid, CERO) - reservado.get(iid, CERO) + propio.get(iid, CERO)
+                    for iid in necesario
+                }
+                faltan = [
+                    f"{nombres.get(iid, iid)} (faltan {n - usable[iid]})"
+                    for iid, n in necesario.items() if n > usable[iid]
+                ]
+                if faltan:
+                    rechazados[pid] = "faltan insumos: " + ", ".join(faltan)
+                    continue
+                for iid, c in propio.items():
+                    reservado[iid] = reservado.get(iid, CERO) - c
+                for _p, prod, sab, cant, iid, nec in por_pedido[pid]:
+                    stock[iid] -= Decimal(nec)
+                    filas_kardex.append([
+                        iid, ahora, "SALIDA", "CONSUMO", Decimal(nec),
+                        f"Pedido {pid} – prod {prod}/{sab} x{cant}", stock[iid],
+                    ])
+                producidos.append(pid)
+
+            if not producidos:
+                return {"producidos": producidos, "rechazados": rechazados}
+
+            _escribir_consumos(cur, filas_kardex, stock)
+
+            cur.execute(
+                f"UPDATE pedido SET estado='LISTO_ENTREGA' WHERE id IN ({_marks(len(producidos))})",
+                producidos,
+            )
+        services_reservas.liberar(producidos)
+        services_despacho.sincronizar_lote(producidos)
+        services_eventos.registrar(producidos, services_eventos.ESTADO)
+    return {"producidos": producidos, "rechazados": rechazados}
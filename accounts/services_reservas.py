@@ -0,0 +1,204 @@
+# accounts/services_reservas.py
+"""
+Reserva de insumos al confirmar pedidos.
+
+- `reserva_insumo` guarda cuánto de cada insumo tiene comprometido cada
+  pedido CONFIRMADO / EN_PRODUCCION (según su receta al confirmar/editar).
+- `insumo.cantidad_reservada` es la suma por insumo, mantenida bajo el
+  lock de la fila del insumo: disponible para prometer (ATP) =
+  cantidad_disponible - cantidad_reservada, sin sumar reservas al leer.
+- `reservar()` calcula la necesidad del pedido con una consulta, bloquea
+  los insumos en orden de id con un solo SELECT ... FOR UPDATE y escribe
+  todo por conjunto: la confirmación sigue siendo una transacción corta.
+- La reserva se libera al cancelar, al producir o cuando el pedido pasa a
+  LISTO_ENTREGA / ENTREGADO. `recalcular()` repara el acumulado.
+- Orden de locks: el pedido (lo toma quien llama) y después los insumos.
+- Reservar/liberar marcan los momentos en que un pedido entra o sale del
+  conjunto activo: tras el commit se avisa al programa de horneado.
+"""
+from decimal import Decimal
+
+from django.db import connection, transaction
+
+from . import services_horneado
+
+ACTIVOS = ("CONFIRMADO", "EN_PRODUCCION")
+CERO = Decimal("0")
+
+
+class StockInsuficiente(Exception):
+    """El pedido necesita más de lo disponible para prometer."""
+
+    def __init__(self, faltantes: list[dict]):
+        self.faltantes = faltantes
+        super().__init__(", ".join(
+            f"{f['insumo']} (disponible {f['atp']}, requiere {f['necesario']})" for f in faltantes
+        ))
+
+
+def _marks(n: int) -> str:
+    return ",".join(["%s"] * n)
+
+
+def _avisar_programa(pedido_ids):
+    ids = list(pedido_ids)
+    transaction.on_commit(lambda: [services_horneado.pedido_cambio(pid) for pid in ids])
+
+
+def _bloquear(cur, insumo_ids) -> dict[int, tuple]:
+    """{insumo_id: (nombre, disponible, reservada)} con lock, en orden de id."""
+    ids = sorted(insumo_ids)
+    if not ids:
+        return {}
+    cur.execute(f"""
+        SELECT id, nombre, cantidad_disponible, cantidad_reservada
+        FROM insumo WHERE id IN ({_marks(len(ids))})
+        ORDER BY id FOR UPDATE
+    """, ids)
+    return {iid: (nombre, Decimal(disp or 0), Decimal(res or 0))
+            for iid, nombre, disp, res in cur.fetchall()}
+
+
+def _sumar_reservada(cur, deltas: dict[int, Decimal]):
+    """cantidad_reservada += delta por insumo, en un UPDATE (locks ya tomados)."""
+    deltas = {iid: d for iid, d in deltas.items() if d}
+    if not deltas:
+        return
+    ids = sorted(deltas)
+    casos = " ".join(["WHEN %s THEN %s"] * len(ids))
+    cur.execute(f"""
+        UPDATE insumo
+        SET cantidad_reservada = GREATEST(cantidad_reservada + CASE id {casos} END, 0)
+        WHERE id IN ({_marks(len(ids))})
+    """, [v for iid in ids for v in (iid, deltas[iid])] + ids)
+
+
+def reservas_de(pedido_ids) -> dict[int, dict[int, Decimal]]:
+    """{pedido_id: {insumo_id: cantidad}} reservado hoy por cada pedido."""
+    ids = sorted({int(i) for i in pedido_ids})
+    if not ids:
+        return {}
+    with connection.cursor() as cur:
+        cur.execute(
+            f"SELECT pedido_id, insumo_id, cantidad FROM reserva_insumo WHERE pedido_id IN ({_marks(len(ids))})",
+            ids,
+        )
+        out: dict = {}
+        for pid, iid, cant in cur.fetchall():
+            out.setdefault(pid, {})[iid] = Decimal(cant)
+    return out
+
+
+def reservar(pedido_id: int):
+    """
+    (Re)hace la reserva del pedido según sus líneas actuales. Llamar dentro
+    de la transacción que lo confirma o edita; si no alcanza, levanta
+    StockInsuficiente y esa transacción se revierte.
+    """
+    with transaction.atomic(savepoint=False), connection.cursor() as cur:
+        cur.execute("""
+            SELECT r.insumo_id, SUM(r.cantidad * dp.cantidad)
+            FROM detalle_pedido dp
+            JOIN receta r ON r.producto_id = dp.producto_id
+            WHERE dp.pedido_id = %s
+            GROUP BY r.insumo_id
+        """, [pedido_id])
+        necesidad = {iid: Decimal(n) for iid, n in cur.fetchall()}
+        actual = reservas_de([pedido_id]).get(pedido_id, {})
+
+        inv = _bloquear(cur, set(necesidad) | set(actual))
+        faltantes = []
+        for iid, n in sorted(necesidad.items()):
+            nombre, disp, res = inv[iid]
+            atp = disp - res + actual.get(iid, CERO)  # lo propio ya estaba reservado
+            if n > atp:
+                faltantes.append({"insumo_id": iid, "insumo": nombre, "atp": atp, "necesario": n})
+        if faltantes:
+            raise StockInsuficiente(faltantes)
+
+        cur.execute("DELETE FROM reserva_insumo WHERE pedido_id=%s", [pedido_id])
+        if necesidad:
+            cur.execute(f"""
+                INSERT INTO reserva_insumo (pedido_id, insumo_id, cantidad)
+                VALUES {",".join(["(%s,%s,%s)"] * len(necesidad))}
+            """, [v for iid, n in necesidad.items() for v in (pedido_id, iid, n)])
+        _sumar_reservada(cur, {
+            iid: necesidad.get(iid, CERO) - actual.get(iid, CERO) for iid in inv
+        })
+    _avisar_programa([pedido_id])
+
+
+def liberar(pedido_ids):
+    """Suelta todo lo reservado por los pedidos (cancelados, producidos o despachados)."""
+    ids = sorted({int(i) for i in pedido_ids})
+    if not ids:
+        return
+    _avisar_programa(ids)
+    with transaction.atomic(savepoint=False), connection.cursor() as cur:
+        cur.execute(f"""
+            SELECT insumo_id, SUM(cantidad) FROM reserva_insumo
+            WHERE pedido_id IN ({_marks(len(ids))})
+            GROUP BY insumo_id
+        """, ids)
+        reservado = {iid: Decimal(c) for iid, c in cur.fetchall()}
+        if not reservado:
+            return
+        _bloquear(cur, reservado)
+        _sumar_reservada(cur, {iid: -c for iid, c in reservado.items()})
+        cur.execute(f"DELETE FROM reserva_insumo WHERE pedido_id IN ({_marks(len(ids))})", ids)
+
+
+def descontar(pedido_id: int, consumos: dict[int, Decimal]):
+    """Baja la reserva del pedido por lo que se consumió de cada insumo (producción parcial)."""
+    propio = reservas_de([pedido_id]).get(pedido_id, {})
+    baja = {iid: min(Decimal(c), propio[iid]) for iid, c in consumos.items() if iid in propio}
+    if not baja:
+        return
+    with transaction.atomic(savepoint=False), connection.cursor() as cur:
+        _bloquear(cur, baja)
+        _sumar_reservada(cur, {iid: -c for iid, c in baja.items()})
+        ids = sorted(baja)
+        casos = " ".join(["WHEN %s THEN %s"] * len(ids))
+        cur.execute(f"""
+            UPDATE reserva_insumo SET cantidad = cantidad - CASE insumo_id {casos} END
+            WHERE pedido_id = %s AND insumo_id IN ({_marks(len(ids))})
+        """, [v for iid in ids for v in (iid, baja[iid])] + [pedido_id] + ids)
+        cur.execute("DELETE FROM reserva_insumo WHERE pedido_id=%s AND cantidad <= 0", [pedido_id])
+
+
+def atp(insumo_ids) -> dict[int, Decimal]:
+    """{insumo_id: disponible para prometer} leído del acumulado."""
+    ids = sorted({int(i) for i in insumo_ids})
+    if not ids:
+        return {}
+    with connection.cursor() as cur:
+        cur.execute(f"""
+            SELECT id, cantidad_disponible - cantidad_reservada FROM insumo
+            WHERE id IN ({_marks(len(ids))})
+        """, ids)
+        return {iid: Decimal(v) for iid, v in cur.fetchall()}
+
+
+def recalcular() -> int:
+    """
+    Borra reservas de pedidos que ya no están activos y rehace
+    cantidad_reservada desde reserva_insumo. Devuelve cuántas reservas borró.
+    """
+    marks = _marks(len(ACTIVOS))
+    with transaction.atomic(), connection.cursor() as cur:
+        cur.execute(f"""
+            DELETE ri FROM reserva_insumo ri
+            JOIN pedido p ON p.id = ri.pedido_id
+            WHERE p.estado NOT IN ({marks})
+        """, list(ACTIVOS))
+        borradas = cur.rowcount
+        cur.execute("SELECT id FROM insumo ORDER BY id FOR UPDATE")
+        cur.execute("""
+            UPDATE insumo i
+            LEFT JOIN (
+                SELECT insumo_id, SUM(cantidad) AS reservado
+                FROM reserva_insumo GROUP BY insumo_id
+            ) x ON x.insumo_id = i.id
+            SET i.cantidad_reservada = COALESCE(x.reservado, 0)
+        """)
+    return borradas
@@ -0,0 +1,299 @@
+# accounts/services_rutas.py
+"""
+Rutas de despacho: pedidos DELIVERY listos agrupados por zona, con las
+paradas ordenadas por vecino más cercano.
+
+- La zona sale de `direccion_entrega` buscando las palabras clave de la
+  tabla `zona` (gana la más larga que aparezca). Las zonas se cargan en el
+  admin.
+- Las coordenadas vienen de `direccion_geo` (cache por dirección
+  normalizada); si falta, se usa el centro de la zona. La llena
+  `manage.py geocodificar_direcciones` con las direcciones en cola que aún
+  no tienen coordenadas (geocoder de DESPACHO_GEOCODER o un CSV).
+- Asignar una ruta crea todos sus envíos en un INSERT multi-fila y los saca
+  de dispatch_queue en la misma transacción; cerrarla bloquea sus envíos
+  pendientes y los cierra con un solo UPDATE.
+"""
+import hashlib
+import math
+import unicodedata
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import services_eventos, services_reservas
+
+SIN_ZONA = "Sin zona"
+
+
+def normalizar_direccion(direccion: str) -> str:
+    txt = unicodedata.normalize("NFKD", direccion or "")
+    txt = "".join(c for c in txt if not unicodedata.combining(c))
+    return " ".join(txt.lower().split())
+
+
+def direccion_sha1(direccion_norm: str) -> str:
+    return hashlib.sha1(direccion_norm.encode("utf-8")).hexdigest()
+
+
+def _zonas() -> list[tuple]:
+    """[(id, nombre, palabra_clave_normalizada, lat, lng)], claves más largas primero."""
+    with connection.cursor() as cur:
+        cur.execute("SELECT id, nombre, palabra_clave, lat, lng FROM zona")
+        zonas = [(zid, nombre, normalizar_direccion(clave), lat, lng)
+                 for zid, nombre, clave, lat, lng in cur.fetchall()]
+    zonas.sort(key=lambda z: len(z[2]), reverse=True)
+    return zonas
+
+
+def _zona_de(direccion_norm: str, zonas: list[tuple]):
+    for z in zonas:
+        if z[2] and z[2] in direccion_norm:
+            return z
+    return None
+
+
+def _coordenadas(shas: list[str]) -> dict[str, tuple[float, float]]:
+    if not shas:
+        return {}
+    marks = ",".join(["%s"] * len(shas))
+    with connection.cursor() as cur:
+        cur.execute(f"""
+            SELECT direccion_sha1, lat, lng FROM direccion_geo
+            WHERE direccion_sha1 IN ({marks})
+        """, shas)
+        return {sha: (float(lat), float(lng)) for sha, lat, lng in cur.fetchall()}
+
+
+def direcciones_sin_coordenadas(limite: int | None = None) -> list[str]:
+    """Direcciones normalizadas (sin repetir) de los DELIVERY en cola que no están en direccion_geo."""
+    with connection.cursor() as cur:
+        cur.execute("""
+          SELECT DISTINCT p.direccion_entrega
+          FROM dispatch_queue dq
+          JOIN pedido p ON p.id = dq.pedido_id
+          WHERE UPPER(p.metodo_envio) = 'DELIVERY' AND p.direccion_entrega <> ''
+        """)
+        normas = {normalizar_direccion(r[0]) for r in cur.fetchall()}
+    por_sha = {direccion_sha1(n): n for n in normas if n}
+    conocidas = _coordenadas(sorted(por_sha))
+    faltan = sorted(n for sha, n in por_sha.items() if sha not in conocidas)
+    return faltan[:limite] if limite else faltan
+
+
+def guardar_coordenadas(filas: list[tuple[str, float, float]]) -> int:
+    """Upsert multi-fila en direccion_geo de [(direccion, lat, lng)]. Devuelve cuántas filas."""
+    vals = {}
+    for direccion, lat, lng in filas:
+        norm = normalizar_direccion(direccion)
+        if norm:
+            vals[direccion_sha1(norm)] = (norm[:200], lat, lng)
+    if not vals:
+        return 0
+    marks = ",".join(["(%s,%s,%s,%s)"] * len(vals))
+    with connection.cursor() as cur:
+        cur.execute(f"""
+            INSERT INTO direccion_geo (direccion_sha1, direccion, lat, lng)
+            VALUES {marks}
+            ON DUPLICATE KEY UPDATE lat = VALUES(lat), lng = VALUES(lng)
+        """, [v for sha, (d, lat, lng) in sorted(vals.items()) for v in (sha, d, lat, lng)])
+    return len(vals)
+
+
+def geocodificar(geocoder, limite: int | None = None) -> tuple[int, list[str]]:
+    """
+    Pide a `geocoder(direccion) -> (lat, lng) | None` las direcciones en cola
+    sin coordenadas y guarda las encontradas. Devuelve (guardadas, no encontradas).
+    """
+    encontradas, sin_resultado = [], []
+    for direccion in direcciones_sin_coordenadas(limite):
+        coord = geocoder(direccion)
+        if coord:
+            encontradas.append((direccion, *coord))
+        else:
+            sin_resultado.append(direccion)
+    return guardar_coordenadas(encontradas), sin_resultado
+
+
+def _distancia(a, b) -> float:
+    """Equirectangular: suficiente para ordenar paradas dentro de una ciudad."""
+    x = math.radians(b[1] - a[1]) * math.cos(math.radians((a[0] + b[0]) / 2))
+    y = math.radians(b[0] - a[0])
+    return x * x + y * y
+
+
+def _origen():
+    lat = getattr(settings, "DESPACHO_ORIGEN_LAT", None)
+    lng = getattr(settings, "DESPACHO_ORIGEN_LNG", None)
+    return (float(lat), float(lng)) if lat is not None and lng is not None else None
+
+
+def ordenar_paradas(paradas: list[dict], origen=None) -> list[dict]:
+    """
+    Vecino más cercano desde `origen` (o desde la primera parada).
+    Las paradas sin coordenadas van al final en su orden original.
+    """
+    con = [p for p in paradas if p.get("coord")]
+    sin = [p for p in paradas if not p.get("coord")]
+    ruta = []
+    actual = origen
+    while con:
+        if actual is None:
+            sig = con.pop(0)
+        else:
+            i = min(range(len(con)), key=lambda k: _distancia(actual, con[k]["coord"]))
+            sig = con.pop(i)
+        ruta.append(sig)
+        actual = sig["coord"]
+    return ruta + sin
+
+
+def planificar() -> list[dict]:
+    """
+    [{zona_id, zona, paradas: [pedido...]}] con los pedidos DELIVERY de la
+    cola de despacho, agrupados por zona y con paradas ya ordenadas.
+    """
+    with connection.cursor() as cur:
+        cur.execute("""
+          SELECT p.id, c.nombre AS cliente, c.telefono, p.direccion_entrega, p.total
+          FROM dispatch_queue dq
+          JOIN pedido  p ON p.id = dq.pedido_id
+          JOIN cliente c ON c.id = p.cliente_id
+          WHERE UPPER(p.metodo_envio) = 'DELIVERY'
+          ORDER BY dq.pedido_id
+        """)
+        cols = [c[0] for c in cur.description]
+        pedidos = [dict(zip(cols, r)) for r in cur.fetchall()]
+    if not pedidos:
+        return []
+
+    zonas = _zonas()
+    for p in pedidos:
+        norm = normalizar_direccion(p["direccion_entrega"])
+        p["_sha"] = direccion_sha1(norm)
+        p["_zona"] = _zona_de(norm, zonas)
+    coords = _coordenadas(sorted({p["_sha"] for p in pedidos}))
+
+    grupos: dict = {}
+    for p in pedidos:
+        z = p.pop("_zona")
+        sha = p.pop("_sha")
+        centro = (float(z[3]), float(z[4])) if z and z[3] is not None and z[4] is not None else None
+        p["coord"] = coords.get(sha) or centro
+        clave = z[0] if z else None
+        g = grupos.setdefault(clave, {"zona_id": clave, "zona": z[1] if z else SIN_ZONA, "paradas": []})
+        g["paradas"].append(p)
+
+    origen = _origen()
+    for g in grupos.values():
+        g["paradas"] = ordenar_paradas(g["paradas"], origen)
+    # Zonas con más paradas primero; "Sin zona" al final
+    return sorted(grupos.values(), key=lambda g: (g["zona_id"] is None, -len(g["paradas"])))
+
+
+def asignar_ruta(pedido_ids: list[int], nombre: str, telefono: str = "",
+                 zona_id: int | None = None) -> tuple[int | None, list[int]]:
+    """
+    Crea la ruta y un envío por pedido (en el orden dado) en una transacción.
+    Sólo toma los pedidos que siguen en la cola; devuelve (ruta_id, asignados).
+    """
+    ids = list(dict.fromkeys(int(i) for i in pedido_ids))
+    if not ids:
+        return None, []
+    marks = ",".join(["%s"] * len(ids))
+
+    with transaction.atomic():
+        with connection.cursor() as cur:
+            # Bloquea las filas de la cola: dos despachadores no toman el mismo pedido
+            cur.execute(f"""
+                SELECT pedido_id FROM dispatch_queue
+                WHERE pedido_id IN ({marks}) FOR UPDATE
+            """, ids)
+            libres = {r[0] for r in cur.fetchall()}
+            asignados = [i for i in ids if i in libres]
+            if not asignados:
+                return None, []
+
+            cur.execute("""
+                INSERT INTO despacho_ruta (zona_id, nombre_repartidor, telefono_repartidor)
+                VALUES (%s, %s, %s)
+            """, [zona_id, nombre, telefono or None])
+            ruta_id = cur.lastrowid
+
+            filas = ",".join(["(%s,'PENDIENTE',%s,%s,%s,%s)"] * len(asignados))
+            params = []
+            for orden, pid in enumerate(asignados, start=1):
+                params += [pid, nombre, telefono or None, ruta_id, orden]
+            cur.execute(f"""
+                INSERT INTO envio (pedido_id, estado, nombre_repartidor, telefono_repartidor,
+                                   ruta_id, orden)
+                VALUES {filas}
+            """, params)
+
+            # Con envío creado ya no cumplen la precondición de la cola
+            marks = ",".join(["%s"] * len(asignados))
+            cur.execute(f"DELETE FROM dispatch_queue WHERE pedido_id IN ({marks})", asignados)
+        services_eventos.registrar(asignados, services_eventos.ENVIO)
+    return ruta_id, asignados
+
+
+def cerrar_ruta(ruta_id: int) -> int:
+    """Marca ENTREGADO los envíos/pedidos pendientes de la ruta. Devuelve cuántos envíos cerró."""
+    with transaction.atomic():
+        with connection.cursor() as cur:
+            # Sólo los envíos que cierra esta llamada: los ya entregados no
+            # vuelven a liberar reservas ni a emitir eventos
+            cur.execute("""
+                SELECT pedido_id FROM envio
+                WHERE ruta_id = %s AND estado <> 'ENTREGADO'
+                ORDER BY pedido_id FOR UPDATE
+            """, [ruta_id])
+            pedidos = [r[0] for r in cur.fetchall()]
+            if pedidos:
+                marks = ",".join(["%s"] * len(pedidos))
+                # El rowcount del UPDATE multi-tabla suma envío y pedido:
+                # lo cerrado son los envíos bloqueados arriba
+                cur.execute(f"""
+                    UPDATE envio e
+                    JOIN pedido p ON p.id = e.pedido_id
+                    SET e.estado = 'ENTREGADO', p.estado = 'ENTREGADO'
+                    WHERE e.ruta_id = %s AND e.pedido_id IN ({marks})
+                """, [ruta_id, *pedidos])
+            cur.execute("""
+                UPDATE despacho_ruta SET estado = 'CERRADA', cerrada_en = NOW()
+                WHERE id = %s AND estado = 'ABIERTA'
+            """, [ruta_id])
+        services_reservas.liberar(pedidos)
+        services_eventos.registrar(pedidos, services_eventos.ENVIO)
+    return len(pedidos)
+
+
+def rutas_abiertas() -> list[dict]:
+    with connection.cursor() as cur:
+        cur.execute("""
+            SELECT r.id, COALESCE(z.nombre, %s) AS zona, r.nombre_repartidor,
+                   r.telefono_repartidor, r.creada_en, COUNT(e.id) AS paradas
+            FROM despacho_ruta r
+            LEFT JOIN zona  z ON z.id = r.zona_id
+            LEFT JOIN envio e ON e.ruta_id = r.id
+            WHERE r.estado = 'ABIERTA'
+            GROUP BY r.id, z.nombre, r.nombre_repartidor, r.telefono_repartidor, r.creada_en
+            ORDER BY r.id
+        """, [SIN_ZONA])
+        cols = [c[0] for c in cur.description]
+        return [dict(zip(cols, r)) for r in cur.fetchall()]
+
+
+def paradas_de_ruta(ruta_id: int) -> list[dict]:
+    with connection.cursor() as cur:
+        cur.execute("""
+            SELECT e.orden, p.id AS pedido_id, c.nombre AS cliente, c.telefono,
+                   p.direccion_entrega, e.estado
+            FROM envio e
+            JOIN pedido  p ON p.id = e.pedido_id
+            JOIN cliente c ON c.id = p.cliente_id
+            WHERE e.ruta_id = %s
+            ORDER BY e.orden
+        """, [ruta_id])
+        cols = [c[0] for c in cur.description]
+        return [dict(zip(cols, r)) for r in cur.fetchall()]
@@ -0,0 +1,177 @@
+# accounts/stripe_local.py
+"""
+Stand-in HTTP local para Stripe (sin red).
+
+Se activa con STRIPE_HTTP_CLIENT="local". Implementa lo mínimo que usa
+la app contra /v1/checkout/sessions: crear, recuperar y listar sesiones.
+Las sesiones nacen ya pagadas y su `url` apunta directo al success_url,
+así el flujo de checkout completo corre en tests o en desarrollo offline.
+Respeta Idempotency-Key igual que la API real.
+
+STRIPE_LOCAL_FIXTURE puede apuntar a un JSON con una lista de sesiones
+(o {"checkout_sessions": [...]}) que se precargan, p.ej. para probar la
+conciliación (`manage.py conciliar_pagos`).
+"""
+import bisect
+import io
+import json
+import threading
+import time
+import uuid
+from urllib.parse import parse_qsl, urlsplit
+
+import stripe
+from django.conf import settings
+
+from .stripe_service import _MedirLatenciaMixin
+
+
+def _desanidar(pares):
+    """`a[b][0][c]=x` -> {"a": {"b": {"0": {"c": "x"}}}} (form-encoding de Stripe)."""
+    out = {}
+    for clave, valor in pares:
+        partes = clave.replace("]", "").split("[")
+        nodo = out
+        for p in partes[:-1]:
+            nodo = nodo.setdefault(p, {})
+        nodo[partes[-1]] = valor
+    return out
+
+
+class _LocalBackend(stripe.HTTPClient):
+    name = "local"
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._sesiones = {}
+        self._orden = []  # (created, id) ascendente, para listar por rango
+        self._idempotencia = {}
+
+        fixture = getattr(settings, "STRIPE_LOCAL_FIXTURE", "")
+        if fixture:
+            self.cargar_fixture(fixture)
+
+    def cargar_fixture(self, path: str):
+        with open(path, encoding="utf-8") as fh:
+            data = json.load(fh)
+        if isinstance(data, dict):
+            data = data.get("checkout_sessions", [])
+        with self._lock:
+            for ses in data:
+                self._agregar(dict(ses))
+
+    # --- protocolo HTTPClient ---
+    def request(self, method, url, headers, post_data=None):
+        partes = urlsplit(url)
+        path = partes.path.rstrip("/")
+        method = method.lower()
+        key = (headers or {}).get("Idempotency-Key")
+
+        with self._lock:
+            if method == "post" and key and key in self._idempotencia:
+                return self._idempotencia[key]
+
+            if method == "post" and path == "/v1/checkout/sessions":
+                data = _desanidar(parse_qsl(post_data or "", keep_blank_values=True))
+                resp = self._responder(200, self._crear_sesion(data))
+            elif method == "get" and path == "/v1/checkout/sessions":
+                query = _desanidar(parse_qsl(partes.query, keep_blank_values=True))
+                resp = self._responder(200, self._listar_sesiones(query))
+            elif method == "get" and path.startswith("/v1/checkout/sessions/"):
+                sid = path.rsplit("/", 1)[-1]
+                ses = self._sesiones.get(sid)
+                resp = (self._responder(200, ses) if ses else
+                        self._error(404, f"No such checkout.session: '{sid}'"))
+            else:
+                resp = self._error(404, f"Unrecognized request URL ({method.upper()}: {path})")
+
+            if method == "post" and key:
+                self._idempotencia[key] = resp
+            return resp
+
+    def request_stream(self, method, url, headers, post_data=None):
+        """Misma respuesta que `request`, con el cuerpo como stream de bytes."""
+        body, status, resp_headers = self.request(method, url, headers, post_data)
+        return io.BytesIO(body.encode("utf-8")), status, resp_headers
+
+    def close(self):
+        pass
+
+    # --- recursos ---
+    def _crear_sesion(self, data: dict) -> dict:
+        total = 0
+        currency = "bob"
+        for li in (data.get("line_items") or {}).values():
+            pd = li.get("price_data") or {}
+            currency = pd.get("currency", currency)
+            total += int(pd.get("unit_amount", 0)) * int(li.get("quantity", 1))
+
+        sid = f"cs_local_{uuid.uuid4().hex}"
+        ses = {
+            "id": sid,
+            "object": "checkout.session",
+            "mode": data.get("mode", "payment"),
+            "status": "complete",
+            "payment_status": "paid",
+            "amount_total": total,
+            "currency": currency,
+            "metadata": data.get("metadata") or {},
+            "created": int(time.time()),
+            "expires_at": int(time.time()) + 24 * 3600,
+            "success_url": data.get("success_url"),
+            "cancel_url": data.get("cancel_url"),
+            "url": (data.get("success_url") or "").replace("{CHECKOUT_SESSION_ID}", sid),
+        }
+        self._agregar(ses)
+        return ses
+
+    def _agregar(self, ses: dict):
+        ses.setdefault("object", "checkout.session")
+        ses.setdefault("created", int(time.time()))
+        if ses["id"] in self._sesiones:
+            return
+        self._sesiones[ses["id"]] = ses
+        bisect.insort(self._orden, (int(ses["created"]), ses["id"]))
+
+    def _listar_sesiones(self, q: dict) -> dict:
+        """Más recientes primero, paginado con starting_after como la API real."""
+        created = q.get("created") or {}
+        lo = bisect.bisect_left(self._orden, (int(created.get("gte", 0)), ""))
+        hi = (bisect.bisect_left(self._orden, (int(created["lt"]), ""))
+              if "lt" in created else len(self._orden))
+
+        after = q.get("starting_after")
+        if after and after in self._sesiones:
+            hi = min(hi, bisect.bisect_left(
+                self._orden, (int(self._sesiones[after]["created"]), after)))
+
+        limite = min(int(q.get("limit", 10)), 100)
+        status = q.get("status")
+        data = []
+        i = hi - 1
+        while i >= lo and len(data) < limite:
+            ses = self._sesiones[self._orden[i][1]]
+            if not status or ses.get("status") == status:
+                data.append(ses)
+            i -= 1
+        return {
+            "object": "list",
+            "url": "/v1/checkout/sessions",
+            "has_more": i >= lo,
+            "data": data,
+        }
+
+    # --- helpers ---
+    def _responder(self, status: int, body: dict):
+        headers = {"Request-Id": f"req_local_{uuid.uuid4().hex[:14]}"}
+        return json.dumps(body), status, headers
+
+    def _error(self, status: int, message: str):
+        return self._responder(status, {
+            "error": {"type": "invalid_request_error", "message": message}
+        })
+
+
+class LocalStripeHTTPClient(_MedirLatenciaMixin, _LocalBackend):
+    """Backend local con las mismas métricas que el cliente real."""
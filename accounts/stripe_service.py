@@ -1,12 +1,123 @@
-from django.conf import settings
+# accounts/stripe_service.py
+"""
+Cliente Stripe compartido por todo el proceso.
+
+- Un solo StripeClient (nada de `stripe.api_key` global por request).
+- Pool de conexiones HTTP persistente (requests.Session + HTTPAdapter).
+- Timeouts estrictos de conexión/lectura.
+- Reintentos con backoff exponencial + jitter (los hace el propio SDK;
+  cada POST lleva Idempotency-Key, así que reintentar es seguro).
+- Métricas de latencia en memoria (ver `metricas()`).
+- Backend HTTP enchufable: STRIPE_HTTP_CLIENT="local" usa el stand-in
+  en memoria de `stripe_local` (tests / desarrollo sin red).
+"""
+import logging
+import threading
+import time
+
 import stripe
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+_client = None
+_client_lock = threading.Lock()
+
+_metricas = {"llamadas": 0, "errores": 0, "total_ms": 0.0, "max_ms": 0.0}
+_metricas_lock = threading.Lock()
+
+
+# -----------------------
+# Métricas
+# -----------------------
+def _registrar(ms: float, error: bool):
+    with _metricas_lock:
+        _metricas["llamadas"] += 1
+        _metricas["total_ms"] += ms
+        _metricas["max_ms"] = max(_metricas["max_ms"], ms)
+        if error:
+            _metricas["errores"] += 1
+
+
+def metricas() -> dict:
+    """Snapshot de latencias de Stripe desde el arranque del proceso."""
+    with _metricas_lock:
+        m = dict(_metricas)
+    m["promedio_ms"] = (m["total_ms"] / m["llamadas"]) if m["llamadas"] else 0.0
+    return m
+
+
+class _MedirLatenciaMixin:
+    """Mide cada intento HTTP (incluye los reintentos del SDK)."""
+
+    def request(self, method, url, headers, post_data=None):
+        t0 = time.perf_counter()
+        error = True
+        try:
+            resp = super().request(method, url, headers, post_data)
+            error = resp[1] >= 400
+            return resp
+        finally:
+            ms = (time.perf_counter() - t0) * 1000
+            _registrar(ms, error)
+            logger.debug("stripe %s %s %.1f ms", method.upper(), url, ms)
+
+
+class PooledRequestsClient(_MedirLatenciaMixin, stripe.RequestsClient):
+    """RequestsClient con una Session compartida y pool dimensionado."""
+
+    def __init__(self, connect_timeout: float, read_timeout: float, pool_maxsize: int):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        super().__init__(timeout=(connect_timeout, read_timeout), session=session)
+
+
+# -----------------------
+# Cliente compartido
+# -----------------------
+def _build_http_client():
+    backend = (getattr(settings, "STRIPE_HTTP_CLIENT", "") or "").strip()
+    if backend == "local":
+        from .stripe_local import LocalStripeHTTPClient
+        return LocalStripeHTTPClient()
+    if backend:
+        return import_string(backend)()
+    return PooledRequestsClient(
+        connect_timeout=float(getattr(settings, "STRIPE_CONNECT_TIMEOUT", 3)),
+        read_timeout=float(getattr(settings, "STRIPE_READ_TIMEOUT", 10)),
+        pool_maxsize=int(getattr(settings, "STRIPE_POOL_MAXSIZE", 10)),
+    )
+
+
+def get_client() -> stripe.StripeClient:
+    """Devuelve el StripeClient del proceso (se crea una sola vez)."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = stripe.StripeClient(
+                    settings.STRIPE_SECRET_KEY or "sk_test_local",
+                    http_client=_build_http_client(),
+                    max_network_retries=int(getattr(settings, "STRIPE_MAX_NETWORK_RETRIES", 2)),
+                )
+    return _client
+
+
+def reset_client():
+    """Descarta el cliente actual (p.ej. al cambiar settings en tests)."""
+    global _client
+    with _client_lock:
+        _client = None
 
-def init_stripe():
-    stripe.api_key = settings.STRIPE_SECRET_KEY
-    return stripe
 
 def create_checkout_session(pedido, success_url, cancel_url):
-    stripe = init_stripe()
+    client = get_client()
 
     # Obtiene detalles (ajusta si tus related_name cambian)
     detalles = getattr(pedido, "detalles", None) or getattr(pedido, "detallepedido_set", None)
@@ -35,11 +146,11 @@ def create_checkout_session(pedido, success_url, cancel_url):
         "user_id": str(getattr(pedido, "user_id", "")),
     }
 
-    session = stripe.checkout.Session.create(
-        mode="payment",
-        success_url=success_url,
-        cancel_url=cancel_url,
-        line_items=line_items,
-        metadata=metadata,
-    )
+    session = client.v1.checkout.sessions.create(params={
+        "mode": "payment",
+        "success_url": success_url,
+        "cancel_url": cancel_url,
+        "line_items": line_items,
+        "metadata": metadata,
+    })
     return session
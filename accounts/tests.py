@@ -1,3 +1,1737 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import time
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.db import DataError, IntegrityError, connection
+from django.test import RequestFactory, SimpleTestCase, TransactionTestCase, override_settings
+
+from . import stripe_service
+from .services_pagos import anotar_saldos, totales_pagados
+
+
+ES_MYSQL = connection.vendor == "mysql"
+solo_mysql = skipUnless(ES_MYSQL, "SQL propio de MySQL (FOR UPDATE, UPDATE ... JOIN, ON DUPLICATE KEY)")
+
+
+def ddl_local(ddl: str) -> str:
+    """El DDL en el motor de la corrida (sqlite no tiene AUTO_INCREMENT ni ENGINE)."""
+    if ES_MYSQL:
+        return ddl
+    return ddl.replace("INT AUTO_INCREMENT PRIMARY KEY", "INTEGER PRIMARY KEY AUTOINCREMENT").replace(
+        " ENGINE=InnoDB", "")
+
+
+class TablasLegadasTestCase(TransactionTestCase):
+    """
+    Las tablas legadas (managed=False) no existen en la BD de tests: cada
+    clase declara en `tablas` las versiones mínimas que necesita, que se
+    crean una vez por clase y se vacían después de cada test.
+    """
+    tablas: dict[str, str] = {}  # nombre -> CREATE TABLE, en orden de dependencias
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with connection.cursor() as cur:
+            for ddl in cls.tablas.values():
+                cur.execute(ddl)
+
+    @classmethod
+    def tearDownClass(cls):
+        with connection.cursor() as cur:
+            for nombre in reversed(list(cls.tablas)):
+                cur.execute(f"DROP TABLE IF EXISTS {nombre}")
+        super().tearDownClass()
+
+    def tearDown(self):
+        with connection.cursor() as cur:
+            for nombre in reversed(list(self.tablas)):
+                cur.execute(f"DELETE FROM {nombre}")
+        super().tearDown()
+
+    def sql(self, sql: str, params=None) -> list[tuple]:
+        with connection.cursor() as cur:
+            cur.execute(sql, params or [])
+            return cur.fetchall() if cur.description else []
+
+
+DDL_PEDIDO = """
+    CREATE TABLE pedido (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        cliente_id INT NOT NULL DEFAULT 1,
+        estado VARCHAR(20) NULL,
+        metodo_envio VARCHAR(20) NOT NULL DEFAULT 'RETIRO',
+        total DECIMAL(12,2) NOT NULL DEFAULT 0,
+        created_at DATETIME NULL,
+        fecha_entrega_programada DATETIME NULL
+    ) ENGINE=InnoDB
+"""
+DDL_PAGO = """
+    CREATE TABLE pago (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        pedido_id INT NOT NULL,
+        metodo VARCHAR(20) NOT NULL,
+        monto DECIMAL(12,2) NOT NULL,
+        referencia VARCHAR(120) NULL,
+        registrado_por_id INT NULL,
+        created_at DATETIME NOT NULL,
+        UNIQUE KEY ux_pago_referencia (referencia),
+        CONSTRAINT fk_pago_pedido FOREIGN KEY (pedido_id) REFERENCES pedido (id)
+    ) ENGINE=InnoDB
+"""
+DDL_CLIENTE = """
+    CREATE TABLE cliente (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        usuario_id INT NULL,
+        nombre VARCHAR(120) NOT NULL,
+        direccion VARCHAR(200) NOT NULL DEFAULT ''
+    ) ENGINE=InnoDB
+"""
+DDL_FACTURA = """
+    CREATE TABLE factura (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        pedido_id INT NOT NULL,
+        nro VARCHAR(60) NOT NULL,
+        fecha DATETIME NULL,
+        nit_cliente VARCHAR(60) NOT NULL,
+        razon_social VARCHAR(200) NOT NULL,
+        total DECIMAL(12,2) NOT NULL,
+        serie VARCHAR(20) NULL,
+        numero BIGINT NULL,
+        UNIQUE KEY ux_factura_pedido (pedido_id),
+        UNIQUE KEY ux_factura_nro (nro),
+        UNIQUE KEY ux_factura_serie_numero (serie, numero)
+    ) ENGINE=InnoDB
+"""
+DDL_ENVIO = """
+    CREATE TABLE envio (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        pedido_id INT NOT NULL,
+        ruta_id INT NULL,
+        estado VARCHAR(20) NOT NULL
+    ) ENGINE=InnoDB
+"""
+# Sin AUTO_INCREMENT ni ENGINE: también corre en SQLite (los tests ponen el id)
+DDL_PEDIDO_EVENTO = """
+    CREATE TABLE pedido_evento (
+        id BIGINT NOT NULL PRIMARY KEY,
+        pedido_id INT NOT NULL,
+        cliente_id INT NOT NULL,
+        tipo VARCHAR(10) NOT NULL,
+        estado VARCHAR(20) NULL,
+        estado_envio VARCHAR(9) NULL,
+        origen VARCHAR(120) NOT NULL,
+        creado_en DATETIME NULL
+    )
+"""
+
+
+@solo_mysql
+@mock.patch("accounts.views_pagos.services_eventos.registrar")
+@mock.patch("accounts.views_pagos.services_despacho.sincronizar")
+class PagoIdempotenteTests(TablasLegadasTestCase):
+    tablas = {"pedido": DDL_PEDIDO, "pago": DDL_PAGO}
+
+    def setUp(self):
+        self.sql("INSERT INTO pedido (id, estado, total) VALUES (1, 'CONFIRMADO', 100)")
+
+    def test_segunda_confirmacion_no_duplica(self, sincronizar, registrar):
+        from .views_pagos import _insertar_pago_idempotente
+
+        self.assertTrue(_insertar_pago_idempotente(1, "TRANSFERENCIA", "100.00", "cs_1", None))
+        self.assertFalse(_insertar_pago_idempotente(1, "TRANSFERENCIA", "100.00", "cs_1", None))
+        self.assertEqual(self.sql("SELECT COUNT(*), SUM(monto) FROM pago")[0], (1, Decimal("100.00")))
+        sincronizar.assert_called_once_with(1)
+
+    def test_pedido_inexistente_no_se_reporta_como_duplicado(self, sincronizar, registrar):
+        from .views_pagos import _insertar_pago_idempotente
+
+        with self.assertRaises(IntegrityError):
+            _insertar_pago_idempotente(999, "TRANSFERENCIA", "10.00", "cs_2", None)
+        self.assertEqual(self.sql("SELECT COUNT(*) FROM pago")[0][0], 0)
+
+    def test_referencia_demasiado_larga_falla(self, sincronizar, registrar):
+        from .views_pagos import _insertar_pago_idempotente
+
+        with self.assertRaises(DataError):
+            _insertar_pago_idempotente(1, "TRANSFERENCIA", "10.00", "x" * 200, None)
+        sincronizar.assert_not_called()
+
+
+
+def _cursor_falso(fetchone=None, error=None):
+    """`connection` de reemplazo cuyo cursor devuelve `fetchone` o lanza `error`."""
+    cur = mock.MagicMock()
+    cur.fetchone.return_value = fetchone
+    if error is not None:
+        cur.execute.side_effect = error
+    conn = mock.MagicMock()
+    conn.cursor.return_value.__enter__.return_value = cur
+    return conn
+
+
+def _mensajes(request) -> list[tuple[int, str]]:
+    return [(m.level, m.message) for m in request._messages._queued_messages]
+
+
+@mock.patch("accounts.views_pedidos.services_checkout.invalidar")
+@mock.patch("accounts.views_pedidos.Usuario")
+@mock.patch("accounts.views_pedidos.get_object_or_404")
+class PagoRegistrarTests(TransactionTestCase):
+    def _post(self):
+        from django.contrib.messages.storage.cookie import CookieStorage
+        from .views_pedidos import pago_registrar
+
+        request = RequestFactory().post("/pedidos/1/pago/", {
+            "metodo": "EFECTIVO", "monto": "10", "referencia": "r-1"})
+        request.user = SimpleNamespace(is_authenticated=True, is_staff=False,
+                                       is_superuser=False, email="c@example.com")
+        request._messages = CookieStorage(request)
+        return request, pago_registrar
+
+    def _preparar(self, get_pedido, usuario):
+        get_pedido.return_value = SimpleNamespace(id=1, total=Decimal("10"),
+                                                  cliente=SimpleNamespace(usuario_id=5))
+        usuario.objects.get.return_value = SimpleNamespace(id=5)
+
+    def test_referencia_duplicada_se_informa(self, get_pedido, usuario, invalidar):
+        self._preparar(get_pedido, usuario)
+        request, vista = self._post()
+        with mock.patch("accounts.views_pedidos.connection",
+                        _cursor_falso(error=IntegrityError(1062, "Duplicate entry"))):
+            resp = vista(request, 1)
+        self.assertEqual(resp.status_code, 302)
+        self.assertIn("referencia", _mensajes(request)[0][1])
+        invalidar.assert_not_called()
+
+    def test_otro_fallo_de_integridad_no_es_un_duplicado(self, get_pedido, usuario, invalidar):
+        self._preparar(get_pedido, usuario)
+        request, vista = self._post()
+        with mock.patch("accounts.views_pedidos.connection",
+                        _cursor_falso(error=IntegrityError(1452, "foreign key constraint fails"))):
+            with self.assertRaises(IntegrityError):
+                vista(request, 1)
+
+
+class PagoExitosoTests(TransactionTestCase):
+    @mock.patch("accounts.views_pagos._insertar_pago_idempotente",
+                side_effect=DataError(1406, "Data too long"))
+    @mock.patch("accounts.views_pagos._usuario_id_por_email", return_value=1)
+    @mock.patch("accounts.views_pagos._total_pagado", return_value=Decimal("0"))
+    @mock.patch("accounts.views_pagos._existe_referencia", return_value=False)
+    @mock.patch("accounts.views_pagos.get_client")
+    def test_insercion_fallida_no_se_muestra_como_exito(self, client, *_mocks):
+        from django.contrib import messages as msgs
+        from django.contrib.messages.storage.cookie import CookieStorage
+        from .views_pagos import pago_exitoso
+
+        client.return_value.v1.checkout.sessions.retrieve.return_value = {
+            "payment_status": "paid", "amount_total": 10000}
+        request = RequestFactory().get("/pago/1/ok/", {"session_id": "cs_1"})
+        request.user = SimpleNamespace(is_authenticated=True, email="c@example.com")
+        request._messages = CookieStorage(request)
+        with mock.patch("accounts.views_pagos.connection", _cursor_falso(fetchone=(100,))), \
+                self.assertLogs("accounts.views_pagos", "ERROR"):
+            pago_exitoso(request, 1)
+        ((nivel, _texto),) = _mensajes(request)
+        self.assertEqual(nivel, msgs.ERROR)
+
+
+class TotalesPagadosTests(TablasLegadasTestCase):
+    """Libro de pagos: una consulta por página, sin importar cuántos pedidos."""
+    tablas = {"pago": """
+        CREATE TABLE pago (
+            id INTEGER PRIMARY KEY,
+            pedido_id INTEGER NOT NULL,
+            monto DECIMAL(12,2) NOT NULL
+        )
+    """}
+
+    def setUp(self):
+        filas = []
+        for pid in range(1, 101):
+            filas += [(2 * pid - 1, pid, "10.00"), (2 * pid, pid, "2.50")]
+        with connection.cursor() as cur:
+            cur.executemany("INSERT INTO pago (id, pedido_id, monto) VALUES (%s, %s, %s)", filas)
+
+    def test_pagina_de_100_pedidos_es_una_consulta(self):
+        request = RequestFactory().get("/pedidos/confirmados/")
+        pedidos = [{"id": pid, "total": Decimal("20.00")} for pid in range(1, 101)]
+        pedidos.append({"id": 999, "total": Decimal("5.00")})
+
+        with self.assertNumQueries(1):
+            anotar_saldos(pedidos, request)
+        self.assertEqual(pedidos[0]["pagado"], Decimal("12.50"))
+        self.assertEqual(pedidos[0]["saldo"], Decimal("7.50"))
+        self.assertEqual(pedidos[-1]["pagado"], Decimal("0"))
+
+        # memoizado en el request
+        with self.assertNumQueries(0):
+            totales_pagados(range(1, 101), request)
+
+
+@override_settings(STRIPE_HTTP_CLIENT="local", STRIPE_SECRET_KEY="sk_test_local",
+                   STRIPE_LOCAL_FIXTURE="", CURRENCY="BOB")
+class StripeLocalTests(SimpleTestCase):
+    """El checkout corre contra el stand-in en memoria, sin red."""
+
+    def setUp(self):
+        stripe_service.reset_client()
+        self.addCleanup(stripe_service.reset_client)
+
+    def _pedido(self):
+        detalles = [
+            SimpleNamespace(producto_nombre="Torta", cantidad=2, precio_unitario=Decimal("45.50")),
+            SimpleNamespace(producto_nombre="Alfajor", cantidad=3, precio_unitario=Decimal("4.00")),
+        ]
+        return SimpleNamespace(id=7, total=Decimal("103.00"), user_id=1, detalles=detalles)
+
+    def test_crear_y_recuperar_sesion(self):
+        ses = stripe_service.create_checkout_session(
+            self._pedido(), "https://x/ok?session_id={CHECKOUT_SESSION_ID}", "https://x/cancel")
+        self.assertTrue(ses.id.startswith("cs_local_"))
+        self.assertEqual(ses.amount_total, 10300)
+        self.assertEqual(ses.currency, "bob")
+        self.assertEqual(ses.url, f"https://x/ok?session_id={ses.id}")
+
+        otra = stripe_service.get_client().v1.checkout.sessions.retrieve(ses.id)
+        self.assertEqual(otra.id, ses.id)
+        self.assertEqual(otra.metadata["pedido_id"], "7")
+        self.assertEqual(otra.payment_status, "paid")
+
+    def test_sesion_inexistente_da_404(self):
+        import stripe
+
+        with self.assertRaises(stripe.InvalidRequestError):
+            stripe_service.get_client().v1.checkout.sessions.retrieve("cs_local_nope")
+
+    def test_request_stream_devuelve_el_mismo_cuerpo(self):
+        from .stripe_local import LocalStripeHTTPClient
+
+        http = LocalStripeHTTPClient()
+        stream, status, _h = http.request_stream(
+            "post", "https://api.stripe.com/v1/checkout/sessions", {},
+            "mode=payment&line_items[0][price_data][unit_amount]=500&line_items[0][quantity]=1")
+        self.assertEqual(status, 200)
+        self.assertIn(b'"amount_total": 500', stream.read())
+
+
+class CheckoutReutilizacionTests(TablasLegadasTestCase):
+    """Aciertos en memoria sin llamadas; lo que viene de la tabla se verifica en Stripe."""
+    tablas = {"checkout_session_cache": """
+        CREATE TABLE checkout_session_cache (
+            pedido_id INT NOT NULL,
+            saldo_cents BIGINT NOT NULL,
+            session_id VARCHAR(120) NOT NULL,
+            url VARCHAR(1000) NOT NULL,
+            expires_at BIGINT NOT NULL,
+            PRIMARY KEY (pedido_id, saldo_cents)
+        )
+    """}
+
+    def setUp(self):
+        self.vence = int(time.time()) + 3600
+        sesiones = [
+            {"id": "cs_abierta", "status": "open", "payment_status": "unpaid", "expires_at": self.vence},
+            {"id": "cs_pagada", "status": "complete", "payment_status": "paid", "expires_at": self.vence},
+            {"id": "cs_expirada", "status": "expired", "payment_status": "unpaid", "expires_at": self.vence},
+        ]
+        fh = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+        json.dump(sesiones, fh)
+        fh.close()
+        self.addCleanup(os.unlink, fh.name)
+
+        ajustes = override_settings(STRIPE_HTTP_CLIENT="local", STRIPE_SECRET_KEY="sk_test_local",
+                                    STRIPE_LOCAL_FIXTURE=fh.name)
+        ajustes.enable()
+        self.addCleanup(ajustes.disable)
+        stripe_service.reset_client()
+        self.addCleanup(stripe_service.reset_client)
+        from . import services_checkout
+        services_checkout._memoria.clear()
+
+    def _otro_worker(self):
+        """Simula que la entrada la guardó otro proceso: no está en memoria."""
+        from . import services_checkout
+        services_checkout._memoria.clear()
+
+    def _cacheadas(self):
+        return [r[0] for r in self.sql("SELECT session_id FROM checkout_session_cache ORDER BY pedido_id")]
+
+    def test_sesion_abierta_se_reutiliza(self):
+        from . import services_checkout
+
+        services_checkout.guardar(1, 5000, "cs_abierta", "https://pay/abierta", self.vence)
+        self._otro_worker()
+        self.assertEqual(services_checkout.obtener_url(1, 5000), "https://pay/abierta")
+        self.assertIsNone(services_checkout.obtener_url(1, 4000))  # otro saldo
+
+    @mock.patch("accounts.services_checkout.get_client")
+    def test_acierto_en_memoria_no_consulta_nada(self, client):
+        from . import services_checkout
+
+        services_checkout.guardar(1, 5000, "cs_abierta", "https://pay/abierta", self.vence)
+        with self.assertNumQueries(0):
+            self.assertEqual(services_checkout.obtener_url(1, 5000), "https://pay/abierta")
+        client.assert_not_called()
+
+    def test_memoria_vieja_se_vuelve_a_verificar(self):
+        from . import services_checkout
+
+        services_checkout.guardar(1, 5000, "cs_pagada", "https://pay/pagada", self.vence)
+        with mock.patch.object(services_checkout, "VERIFICAR_S", 0):
+            self.assertIsNone(services_checkout.obtener_url(1, 5000))
+        self.assertEqual(self._cacheadas(), [])
+        self.assertEqual(services_checkout._memoria, {})
+
+    def test_sesion_pagada_o_expirada_se_descarta(self):
+        from . import services_checkout
+
+        services_checkout.guardar(1, 5000, "cs_pagada", "https://pay/pagada", self.vence)
+        services_checkout.guardar(2, 5000, "cs_expirada", "https://pay/expirada", self.vence)
+        services_checkout.guardar(3, 5000, "cs_no_existe", "https://pay/x", self.vence)
+        self._otro_worker()
+        self.assertIsNone(services_checkout.obtener_url(1, 5000))
+        self.assertIsNone(services_checkout.obtener_url(2, 5000))
+        self.assertIsNone(services_checkout.obtener_url(3, 5000))
+        self.assertEqual(self._cacheadas(), [])
+
+    def test_invalidar_vale_para_cualquier_proceso(self):
+        from . import services_checkout
+
+        services_checkout.guardar(1, 5000, "cs_abierta", "https://pay/abierta", self.vence)
+        services_checkout.guardar(2, 5000, "cs_abierta", "https://pay/abierta", self.vence)
+        services_checkout.invalidar(1)
+        services_checkout.invalidar_lote([2])
+        self.assertIsNone(services_checkout.obtener_url(1, 5000))
+        self.assertIsNone(services_checkout.obtener_url(2, 5000))
+
+
+class NumeroFacturaTests(TransactionTestCase):
+    """Un número tomado por una factura que no confirma vuelve a repartirse."""
+
+    def setUp(self):
+        from . import services_numeracion as num
+        self.num = num
+        num._bloques.clear()
+        num._devueltos.clear()
+        patcher = mock.patch.object(
+            num, "_reservar_bloque",
+            side_effect=lambda serie, **kw: num._Bloque(1, serie, 10, 19, os.getpid()),
+        )
+        self.reservar = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(num._bloques.clear)
+        self.addCleanup(num._devueltos.clear)
+
+    def test_rollback_devuelve_el_numero(self):
+        with self.assertRaises(IntegrityError):
+            with self.num.numero_factura("T") as (_serie, numero):
+                self.assertEqual(numero, 10)
+                raise IntegrityError(1062, "duplicado")
+        self.assertEqual(self.num.siguiente_numero("T"), ("T", 10))
+        self.assertEqual(self.reservar.call_count, 1)
+
+    def test_devueltos_fuera_de_orden_se_reparten_primero(self):
+        tomados = [self.num.siguiente_numero("T")[1] for _ in range(4)]
+        self.assertEqual(tomados, [10, 11, 12, 13])
+        self.num.devolver("T", [11, 13])
+        # 13 era el último entregado: sólo retrocede el bloque
+        self.assertEqual([self.num.siguiente_numero("T")[1] for _ in range(3)], [11, 13, 14])
+
+    def test_exige_transaccion_propia(self):
+        from django.db import transaction
+        with transaction.atomic(), self.assertRaises(RuntimeError):
+            with self.num.numero_factura("T"):
+                pass
+        self.assertEqual(self.reservar.call_count, 0)
+
+
+@solo_mysql
+@mock.patch("accounts.services_facturas.encolar_pdf")
+class EmitirPendientesTests(TablasLegadasTestCase):
+    tablas = {"cliente": DDL_CLIENTE, "pedido": DDL_PEDIDO, "pago": DDL_PAGO, "factura": DDL_FACTURA}
+
+    def setUp(self):
+        from . import services_facturas
+        self.sf = services_facturas
+        self.sql("INSERT INTO cliente (id, nombre) VALUES (1, 'Ana')")
+
+    def _pedido(self, pid, estado, total, pagos=()):
+        self.sql("INSERT INTO pedido (id, estado, total) VALUES (%s, %s, %s)", [pid, estado, total])
+        for i, monto in enumerate(pagos):
+            self.sql("INSERT INTO pago (pedido_id, metodo, monto, referencia, created_at) "
+                     "VALUES (%s, 'EFECTIVO', %s, %s, NOW())", [pid, monto, f"r{pid}-{i}"])
+
+    def test_solo_confirmados_con_cobro_neto_positivo(self, _encolar):
+        self._pedido(1, "CONFIRMADO", "50.00", ["50.00"])
+        self._pedido(2, "PENDIENTE", "50.00", ["50.00"])
+        self._pedido(3, "CONFIRMADO", "0.00")
+        self._pedido(4, "CONFIRMADO", "0.00", ["10.00", "-10.00"])
+        self._pedido(5, "CONFIRMADO", "50.00", ["20.00"])
+        self._pedido(6, "CANCELADO", "50.00", ["50.00"])
+        self.assertEqual([r[0] for r in self.sf.pedidos_por_facturar()], [1])
+
+    def test_pedido_facturado_en_paralelo_devuelve_su_numero(self, _encolar):
+        self._pedido(1, "CONFIRMADO", "50.00", ["50.00"])
+        self._pedido(2, "CONFIRMADO", "30.00", ["30.00"])
+        candidatos = self.sf.pedidos_por_facturar()
+        # Otro proceso factura el pedido 1 entre la selección y el INSERT
+        self.sql("INSERT INTO factura (pedido_id, nro, nit_cliente, razon_social, total, serie, numero) "
+                 "VALUES (1, 'X-1', '0', 'Ana', 50, 'X', 1)")
+        with mock.patch.object(self.sf, "pedidos_por_facturar", return_value=candidatos), \
+             mock.patch.object(self.sf, "reservar_rango", return_value=("T", 100, 101)), \
+             mock.patch.object(self.sf, "devolver") as devolver:
+            ids = self.sf.emitir_pendientes("T")
+        self.assertEqual(len(ids), 1)
+        self.assertEqual([tuple(r) for r in self.sql("SELECT pedido_id, numero FROM factura WHERE serie='T'")],
+                         [(2, 101)])
+        devolver.assert_called_once_with("T", [100])
+
+
+@solo_mysql
+@mock.patch("accounts.services_rutas.services_eventos.registrar")
+@mock.patch("accounts.services_rutas.services_reservas.liberar")
+class CerrarRutaTests(TablasLegadasTestCase):
+    tablas = {
+        "pedido": DDL_PEDIDO,
+        "despacho_ruta": """
+            CREATE TABLE despacho_ruta (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                estado VARCHAR(10) NOT NULL DEFAULT 'ABIERTA',
+                cerrada_en DATETIME NULL
+            ) ENGINE=InnoDB
+        """,
+        "envio": DDL_ENVIO,
+    }
+
+    def test_cuenta_y_notifica_solo_los_envios_que_cierra(self, liberar, registrar):
+        from .services_rutas import cerrar_ruta
+        self.sql("INSERT INTO despacho_ruta (id) VALUES (7)")
+        self.sql("INSERT INTO pedido (id, estado) VALUES (1, 'LISTO_ENTREGA'), (2, 'LISTO_ENTREGA'), "
+                 "(3, 'ENTREGADO')")
+        self.sql("INSERT INTO envio (pedido_id, ruta_id, estado) VALUES "
+                 "(1, 7, 'PENDIENTE'), (2, 7, 'PENDIENTE'), (3, 7, 'ENTREGADO')")
+
+        self.assertEqual(cerrar_ruta(7), 2)
+        liberar.assert_called_once_with([1, 2])
+        registrar.assert_called_once_with([1, 2], mock.ANY)
+        self.assertEqual([r[0] for r in self.sql("SELECT estado FROM pedido ORDER BY id")],
+                         ["ENTREGADO"] * 3)
+
+        # Cerrarla de nuevo no vuelve a liberar ni a notificar
+        self.assertEqual(cerrar_ruta(7), 0)
+        liberar.assert_called_with([])
+        registrar.assert_called_with([], mock.ANY)
+
+
+class PollerEventosTests(TablasLegadasTestCase):
+    tablas = {"pedido_evento": DDL_PEDIDO_EVENTO}
+
+    def _evento(self, eid):
+        self.sql("INSERT INTO pedido_evento (id, pedido_id, cliente_id, tipo, estado, origen) "
+                 "VALUES (%s, %s, 1, 'ESTADO', 'CONFIRMADO', 'otro:1')", [eid, eid])
+
+    @override_settings(EVENTOS_POLL_S=1)
+    async def test_id_menor_que_confirma_tarde_se_entrega(self):
+        from asgiref.sync import sync_to_async
+        from . import services_eventos as ev
+
+        insertar = sync_to_async(self._evento, thread_sensitive=False)
+        esperando, pasos = asyncio.Event(), asyncio.Queue()
+
+        async def dormir(_s):
+            esperando.set()
+            await pasos.get()
+
+        async def vuelta():
+            esperando.clear()
+            pasos.put_nowait(None)
+            await asyncio.wait_for(esperando.wait(), 5)
+
+        await insertar(1)
+        with mock.patch.object(ev.asyncio, "sleep", dormir):
+            sub = ev.suscribir(lambda e: True)
+            try:
+                await asyncio.wait_for(esperando.wait(), 5)
+                await insertar(3)   # confirma primero
+                await vuelta()
+                await insertar(2)   # id menor, confirma después
+                await vuelta()
+                recibidos = []
+                while not sub.cola.empty():
+                    recibidos.append(sub.cola.get_nowait()["id"])
+            finally:
+                ev.desuscribir(sub)
+                pasos.put_nowait(None)
+        self.assertEqual(recibidos, [2, 3])
+
+
+@solo_mysql
+class RegistrarEventosTests(TablasLegadasTestCase):
+    tablas = {
+        "pedido": DDL_PEDIDO,
+        "envio": DDL_ENVIO,
+        "pedido_evento": DDL_PEDIDO_EVENTO.replace("NOT NULL PRIMARY KEY", "AUTO_INCREMENT PRIMARY KEY"),
+    }
+
+    def test_ids_publicados_son_los_de_la_tabla(self):
+        from django.db import transaction
+        from . import services_eventos as ev
+        self.sql("INSERT INTO pedido (id, estado) VALUES (1, 'CONFIRMADO'), (2, 'LISTO_ENTREGA')")
+        self.sql("INSERT INTO pedido_evento (id, pedido_id, cliente_id, tipo, origen) "
+                 "VALUES (40, 9, 1, 'ESTADO', 'otro:1')")
+        with mock.patch.object(ev, "_despachar") as despachar:
+            with transaction.atomic():
+                ev.registrar([1, 2], ev.ESTADO)
+        publicados = {e["pedido_id"]: e["id"] for e in despachar.call_args.args[0]}
+        en_tabla = {pid: eid for eid, pid in self.sql(
+            "SELECT id, pedido_id FROM pedido_evento WHERE pedido_id IN (1, 2)")}
+        self.assertEqual(publicados, en_tabla)
+
+
+DDL_PEDIDO_PRECIO = """
+    CREATE TABLE pedido (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        estado VARCHAR(20) NULL,
+        costo_envio DECIMAL(12,2) NOT NULL DEFAULT 0,
+        total DECIMAL(12,2) NOT NULL DEFAULT 0,
+        created_at DATETIME NULL
+    ) ENGINE=InnoDB
+"""
+DDL_DETALLE_PEDIDO = """
+    CREATE TABLE detalle_pedido (
+        pedido_id INT NOT NULL,
+        producto_id INT NOT NULL,
+        sabor_id INT NOT NULL DEFAULT 1,
+        cantidad DECIMAL(12,2) NOT NULL,
+        precio_unitario DECIMAL(12,2) NOT NULL,
+        PRIMARY KEY (pedido_id, producto_id, sabor_id)
+    ) ENGINE=InnoDB
+"""
+DDL_PEDIDO_DESCUENTO = """
+    CREATE TABLE pedido_descuento (
+        pedido_id INT NOT NULL,
+        descuento_id INT NOT NULL,
+        monto_aplicado DECIMAL(12,2) NULL,
+        PRIMARY KEY (pedido_id, descuento_id)
+    ) ENGINE=InnoDB
+"""
+
+
+@solo_mysql
+@mock.patch("accounts.services_descuentos.services_checkout.invalidar_lote")
+@mock.patch("accounts.services_descuentos.services_despacho.sincronizar_lote")
+class AplicarLoteTests(TablasLegadasTestCase):
+    tablas = {
+        "pedido": DDL_PEDIDO_PRECIO,
+        "detalle_pedido": DDL_DETALLE_PEDIDO,
+        "pedido_descuento": DDL_PEDIDO_DESCUENTO,
+        "pago": DDL_PAGO.replace(
+            "CONSTRAINT fk_pago_pedido FOREIGN KEY (pedido_id) REFERENCES pedido (id)",
+            "KEY ix_pago_pedido (pedido_id)"),
+        "factura": DDL_FACTURA,
+    }
+
+    def _pedido(self, pid, estado, items, descuento=None):
+        self.sql("INSERT INTO pedido (id, estado, total) VALUES (%s, %s, %s)",
+                 [pid, estado, items - (descuento or 0)])
+        self.sql("INSERT INTO detalle_pedido (pedido_id, producto_id, cantidad, precio_unitario) "
+                 "VALUES (%s, 1, 1, %s)", [pid, items])
+        if descuento:
+            self.sql("INSERT INTO pedido_descuento VALUES (%s, 9, %s)", [pid, descuento])
+
+    def _estado(self, pid):
+        total = self.sql("SELECT total FROM pedido WHERE id=%s", [pid])[0][0]
+        filas = [tuple(r) for r in self.sql(
+            "SELECT descuento_id, monto_aplicado FROM pedido_descuento WHERE pedido_id=%s", [pid])]
+        return total, filas
+
+    def test_reemplaza_solo_si_descuenta_mas_y_solo_pedidos_editables(self, *_mocks):
+        from .models_db import Descuento
+        from .services_descuentos import FiltroPedidos, Regla, aplicar_lote
+        self._pedido(1, "PENDIENTE", 100, descuento=80)
+        self._pedido(2, "PENDIENTE", 100, descuento=30)
+        self._pedido(3, "PENDIENTE", 100)
+        self.sql("INSERT INTO pago (pedido_id, metodo, monto, created_at) VALUES (3, 'EFECTIVO', 100, NOW())")
+        self._pedido(4, "ENTREGADO", 100)
+        self._pedido(5, "CONFIRMADO", 100)
+        self.sql("INSERT INTO factura (pedido_id, nro, nit_cliente, razon_social, total) "
+                 "VALUES (5, 'F-5', '0', 'X', 100)")
+        self._pedido(6, "PENDIENTE", 40, descuento=10)
+
+        regla = Regla(7, "Promo", Descuento.TIPO_FIJO, Decimal("50"))
+        filtro = FiltroPedidos(estados=["PENDIENTE", "CONFIRMADO", "ENTREGADO"])
+        self.assertEqual(aplicar_lote(regla, filtro), 2)
+
+        self.assertEqual(self._estado(1), (Decimal("20.00"), [(9, Decimal("80.00"))]))
+        self.assertEqual(self._estado(2), (Decimal("50.00"), [(7, Decimal("50.00"))]))
+        self.assertEqual(self._estado(3), (Decimal("100.00"), []))
+        self.assertEqual(self._estado(4), (Decimal("100.00"), []))
+        self.assertEqual(self._estado(5), (Decimal("100.00"), []))
+        # Nunca por debajo de cero: el monto se topa en la base
+        self.assertEqual(self._estado(6), (Decimal("0.00"), [(7, Decimal("40.00"))]))
+
+
+class GuardarDescuentoTests(TablasLegadasTestCase):
+    """Al editar, el descuento automático no pisa uno mayor que ya tenga el pedido."""
+    tablas = {
+        "descuento": """
+            CREATE TABLE descuento (
+                id INT NOT NULL PRIMARY KEY,
+                nombre VARCHAR(120) NOT NULL,
+                tipo VARCHAR(20) NOT NULL,
+                valor DECIMAL(12,2) NOT NULL,
+                activo BOOL NOT NULL DEFAULT 1
+            )
+        """,
+        "pedido_descuento": DDL_PEDIDO_DESCUENTO.replace(" ENGINE=InnoDB", ""),
+    }
+
+    def setUp(self):
+        from .models_db import Descuento
+        from .services_descuentos import Regla
+        self.sql("INSERT INTO descuento (id, nombre, tipo, valor) VALUES "
+                 "(9, 'Manual', 'FIJO', 30), (7, 'Auto', 'PORCENTAJE', 10), (8, 'Auto50', 'PORCENTAJE', 50)")
+        self.sql("INSERT INTO pedido_descuento VALUES (1, 9, 30)")
+        self.auto10 = Regla(7, "Auto", Descuento.TIPO_PORCENTAJE, Decimal("10"))
+        self.auto50 = Regla(8, "Auto50", Descuento.TIPO_PORCENTAJE, Decimal("50"))
+
+    def _filas(self):
+        return [(d, Decimal(m)) for d, m in self.sql(
+            "SELECT descuento_id, monto_aplicado FROM pedido_descuento WHERE pedido_id=1")]
+
+    def test_conserva_el_manual_si_descuenta_mas(self):
+        from .services_descuentos import guardar_descuento
+        total = guardar_descuento(1, self.auto10, self.auto10.monto(Decimal("100")), Decimal("100"))
+        self.assertEqual(total, Decimal("30"))
+        self.assertEqual(self._filas(), [(9, Decimal("30"))])
+
+    def test_sin_regla_recalcula_el_monto_sobre_la_base_nueva(self):
+        from .services_descuentos import guardar_descuento
+        total = guardar_descuento(1, None, Decimal("0"), Decimal("20"))
+        self.assertEqual(total, Decimal("20"))
+        self.assertEqual(self._filas(), [(9, Decimal("20"))])
+
+    @solo_mysql
+    def test_el_automatico_mayor_reemplaza(self):
+        from .services_descuentos import guardar_descuento
+        total = guardar_descuento(1, self.auto50, self.auto50.monto(Decimal("100")), Decimal("100"))
+        self.assertEqual(total, Decimal("50.00"))
+        self.assertEqual(self._filas(), [(8, Decimal("50"))])
+
+
+class PermisosProduccionTests(SimpleTestCase):
+    def test_vistas_de_produccion_exigen_permiso(self):
+        from django.core.exceptions import PermissionDenied
+        from . import views_produccion as v
+
+        rf = RequestFactory()
+        casos = [
+            (v.producir_lote, rf.post("/produccion/producir/", {"pedido_ids": ["1"]}), (), "INVENTARIO_WRITE"),
+            (v.producir_item, rf.get("/"), (1, 1, 1), "INVENTARIO_WRITE"),
+            (v.plan_produccion, rf.get("/"), (), "INVENTARIO_READ"),
+            (v.plan_produccion_csv, rf.get("/"), (), "INVENTARIO_READ"),
+            (v.programa_horneado, rf.get("/"), (), "INVENTARIO_READ"),
+        ]
+        for vista, request, args, codigo in casos:
+            request.user = SimpleNamespace(is_authenticated=True, email="cajero@example.com")
+            with self.subTest(vista=vista.__name__), \
+                 mock.patch("accounts.permissions.tiene_permiso", return_value=False) as tiene:
+                with self.assertRaises(PermissionDenied):
+                    vista(request, *args)
+                self.assertEqual(tiene.call_args.args[1], codigo)
+
+
+DDL_INSUMO = """
+    CREATE TABLE insumo (
+        id INT NOT NULL PRIMARY KEY,
+        nombre VARCHAR(120) NOT NULL UNIQUE,
+        unidad_medida VARCHAR(10) NOT NULL DEFAULT 'kg',
+        cantidad_disponible DECIMAL(12,3) NOT NULL DEFAULT 0,
+        cantidad_reservada DECIMAL(14,3) NOT NULL DEFAULT 0,
+        fecha_actualizacion DATETIME NULL
+    )
+"""
+DDL_KARDEX = """
+    CREATE TABLE kardex (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        insumo_id INT NOT NULL,
+        fecha DATETIME NOT NULL,
+        tipo VARCHAR(10) NOT NULL,
+        motivo VARCHAR(20) NOT NULL,
+        cantidad DECIMAL(12,3) NOT NULL,
+        observacion VARCHAR(200) NULL,
+        saldo_resultante DECIMAL(14,3) NULL
+    ) ENGINE=InnoDB
+"""
+
+
+@mock.patch("accounts.views.services_insumos.catalogo_cambio")
+@mock.patch("accounts.permissions.tiene_permiso", return_value=True)
+class InsumoUpdateTests(TablasLegadasTestCase):
+    tablas = {"insumo": DDL_INSUMO}
+
+    def test_no_pisa_la_reserva_con_la_copia_leida(self, _tiene, _catalogo):
+        from django.contrib.messages.storage.cookie import CookieStorage
+        from . import views
+        from .models_db import Insumo
+
+        self.sql("INSERT INTO insumo (id, nombre, cantidad_disponible, cantidad_reservada) "
+                 "VALUES (1, 'Harina', 10, 2)")
+        leido = Insumo.objects.get(pk=1)
+        # Una confirmación reserva más mientras el form está abierto
+        self.sql("UPDATE insumo SET cantidad_reservada = 6 WHERE id = 1")
+
+        request = RequestFactory().post("/", {"nombre": "Harina 000", "unidad_medida": "kg",
+                                              "cantidad_disponible": "12"})
+        request.user = SimpleNamespace(is_authenticated=True, email="admin@example.com")
+        request._messages = CookieStorage(request)
+        with mock.patch.object(views, "get_object_or_404", return_value=leido):
+            views.insumo_update(request, 1)
+
+        fila = self.sql("SELECT nombre, cantidad_disponible, cantidad_reservada FROM insumo WHERE id=1")[0]
+        self.assertEqual((fila[0], Decimal(fila[1]), Decimal(fila[2])),
+                         ("Harina 000", Decimal("12"), Decimal("6")))
+
+
+@solo_mysql
+class ProducirLineaTests(TablasLegadasTestCase):
+    tablas = {
+        "pedido": DDL_PEDIDO,
+        "detalle_pedido": DDL_DETALLE_PEDIDO,
+        "receta": """
+            CREATE TABLE receta (
+                producto_id INT NOT NULL,
+                insumo_id INT NOT NULL,
+                cantidad DECIMAL(12,3) NOT NULL,
+                PRIMARY KEY (producto_id, insumo_id)
+            ) ENGINE=InnoDB
+        """,
+        "insumo": DDL_INSUMO,
+        "reserva_insumo": """
+            CREATE TABLE reserva_insumo (
+                pedido_id INT NOT NULL,
+                insumo_id INT NOT NULL,
+                cantidad DECIMAL(14,3) NOT NULL,
+                PRIMARY KEY (pedido_id, insumo_id)
+            ) ENGINE=InnoDB
+        """,
+        "kardex": DDL_KARDEX,
+        "produccion_linea": """
+            CREATE TABLE produccion_linea (
+                pedido_id INT NOT NULL,
+                producto_id INT NOT NULL,
+                sabor_id INT NOT NULL,
+                producido_en DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (pedido_id, producto_id, sabor_id)
+            ) ENGINE=InnoDB
+        """,
+    }
+
+    def setUp(self):
+        self.sql("INSERT INTO pedido (id, estado) VALUES (1, 'EN_PRODUCCION'), (2, 'CONFIRMADO')")
+        # Una galleta del producto 1 lleva 1 de harina; el pedido 1 pide 5
+        self.sql("INSERT INTO detalle_pedido (pedido_id, producto_id, cantidad, precio_unitario) "
+                 "VALUES (1, 1, 5, 10)")
+        self.sql("INSERT INTO receta VALUES (1, 1, 1)")
+
+    def test_no_usa_lo_reservado_por_otros_pedidos(self):
+        from .services_produccion import producir_linea
+        from .services_reservas import StockInsuficiente
+        self.sql("INSERT INTO insumo (id, nombre, cantidad_disponible, cantidad_reservada) "
+                 "VALUES (1, 'Harina', 10, 8)")
+        self.sql("INSERT INTO reserva_insumo VALUES (2, 1, 8)")
+
+        with self.assertRaises(StockInsuficiente):
+            producir_linea(1, 1, 1)
+        self.assertEqual(self.sql("SELECT COUNT(*) FROM produccion_linea")[0][0], 0)
+        self.assertEqual(Decimal(self.sql("SELECT cantidad_disponible FROM insumo")[0][0]), Decimal("10"))
+
+    @mock.patch("accounts.services_reservas.services_horneado.pedido_cambio")
+    def test_usa_su_reserva_y_no_descuenta_dos_veces(self, _avisar):
+        from .services_produccion import producir_linea
+        self.sql("INSERT INTO insumo (id, nombre, cantidad_disponible, cantidad_reservada) "
+                 "VALUES (1, 'Harina', 10, 8)")
+        self.sql("INSERT INTO reserva_insumo VALUES (1, 1, 5), (2, 1, 3)")
+
+        self.assertTrue(producir_linea(1, 1, 1))
+        self.assertFalse(producir_linea(1, 1, 1))
+        disp, res = self.sql("SELECT cantidad_disponible, cantidad_reservada FROM insumo")[0]
+        self.assertEqual((Decimal(disp), Decimal(res)), (Decimal("5"), Decimal("3")))
+        self.assertEqual(self.sql("SELECT COUNT(*) FROM kardex")[0][0], 1)
+
+
+@solo_mysql
+@mock.patch("accounts.services_reservas.services_horneado.pedido_cambio")
+@mock.patch("accounts.services_produccion.services_eventos.registrar")
+@mock.patch("accounts.services_produccion.services_despacho.sincronizar_lote")
+class ProducirPedidosTests(TablasLegadasTestCase):
+    tablas = ProducirLineaTests.tablas
+
+    def setUp(self):
+        self.sql("INSERT INTO pedido (id, estado) VALUES "
+                 "(1, 'CONFIRMADO'), (2, 'CONFIRMADO'), (3, 'ENTREGADO')")
+        # Pedido 1: 5 del producto 1 y 2 del producto 2 (esta ya producida suelta)
+        # Pedido 2: 20 del producto 1, más de lo que hay
+        self.sql("INSERT INTO detalle_pedido (pedido_id, producto_id, cantidad, precio_unitario) "
+                 "VALUES (1, 1, 5, 10), (1, 2, 2, 10), (2, 1, 20, 10)")
+        self.sql("INSERT INTO receta VALUES (1, 1, 1), (2, 1, 1)")
+        self.sql("INSERT INTO insumo (id, nombre, cantidad_disponible, cantidad_reservada) "
+                 "VALUES (1, 'Harina', 10, 5)")
+        self.sql("INSERT INTO reserva_insumo VALUES (1, 1, 5)")
+        self.sql("INSERT INTO produccion_linea (pedido_id, producto_id, sabor_id) VALUES (1, 2, 1)")
+
+    def test_rechaza_uno_y_produce_los_demas(self, sincronizar, registrar, _avisar):
+        from .services_produccion import producir_pedidos
+
+        r = producir_pedidos([3, 2, 1, 4])
+
+        self.assertEqual(r["producidos"], [1])
+        self.assertEqual(set(r["rechazados"]), {2, 3, 4})
+        self.assertIn("faltan insumos", r["rechazados"][2])
+        self.assertEqual(r["rechazados"][3], "estado ENTREGADO")
+        self.assertEqual(r["rechazados"][4], "no existe")
+        self.assertEqual(dict(self.sql("SELECT id, estado FROM pedido")),
+                         {1: "LISTO_ENTREGA", 2: "CONFIRMADO", 3: "ENTREGADO"})
+        sincronizar.assert_called_once_with([1])
+        self.assertEqual(registrar.call_args.args[0], [1])
+
+    def test_no_descuenta_las_lineas_producidas_sueltas(self, _sinc, _reg, _avisar):
+        from .services_produccion import producir_pedidos
+
+        producir_pedidos([1])
+
+        # Sólo la línea del producto 1 (5); la del producto 2 ya se descontó antes
+        disp, res = self.sql("SELECT cantidad_disponible, cantidad_reservada FROM insumo")[0]
+        self.assertEqual((Decimal(disp), Decimal(res)), (Decimal("5"), Decimal("0")))
+        self.assertEqual([Decimal(c) for (c,) in self.sql("SELECT cantidad FROM kardex")],
+                         [Decimal("5")])
+        self.assertEqual(self.sql("SELECT COUNT(*) FROM reserva_insumo")[0][0], 0)
+
+
+DDL_PRODUCTO = """
+    CREATE TABLE producto (
+        id INT NOT NULL PRIMARY KEY,
+        nombre VARCHAR(120) NOT NULL
+    )
+"""
+
+
+class PlanificacionTests(TablasLegadasTestCase):
+    tablas = {
+        "pedido": ddl_local(DDL_PEDIDO),
+        "detalle_pedido": ddl_local(DDL_DETALLE_PEDIDO),
+        "producto": DDL_PRODUCTO,
+        "insumo": DDL_INSUMO,
+        "receta": ddl_local(ProducirLineaTests.tablas["receta"]),
+        "produccion_linea": ddl_local(ProducirLineaTests.tablas["produccion_linea"]),
+    }
+
+    def setUp(self):
+        from datetime import datetime, timezone as dt_tz
+        dia = datetime(2030, 1, 10, 16, tzinfo=dt_tz.utc)       # 12:00 en La Paz
+        despues = datetime(2030, 1, 11, 16, tzinfo=dt_tz.utc)
+        self.sql("INSERT INTO producto VALUES (1, 'Galleta'), (2, 'Torta'), (3, 'Vela')")
+        self.sql("INSERT INTO insumo (id, nombre, cantidad_disponible) VALUES "
+                 "(1, 'Harina', 10), (2, 'Azucar', 1), (3, 'Sal', 5)")
+        # Galleta: 1 harina + 0.5 azúcar; Torta: 2 harina; Vela: sin receta
+        self.sql("INSERT INTO receta VALUES (1, 1, 1), (1, 2, 0.5), (2, 1, 2)")
+        self.sql("INSERT INTO pedido (id, estado, fecha_entrega_programada) VALUES "
+                 "(1, 'CONFIRMADO', %s), (2, 'EN_PRODUCCION', %s), (3, 'CANCELADO', %s), "
+                 "(4, 'CONFIRMADO', %s), (5, 'CONFIRMADO', %s)",
+                 [dia, dia, dia, despues, dia])
+        self.sql("INSERT INTO detalle_pedido (pedido_id, producto_id, sabor_id, cantidad, precio_unitario) "
+                 "VALUES (1, 1, 1, 4, 1), (1, 2, 1, 2, 1), (1, 3, 1, 1, 1), "
+                 "(2, 1, 1, 2, 1), (2, 2, 2, 1, 1), (3, 1, 1, 100, 1), (4, 1, 1, 50, 1), "
+                 "(5, 2, 1, 7, 1)")
+        # Ya producidas una por una: no cuentan
+        self.sql("INSERT INTO produccion_linea (pedido_id, producto_id, sabor_id) "
+                 "VALUES (2, 2, 2), (5, 2, 1)")
+
+    def _plan(self):
+        from datetime import date
+        from .services_planificacion import planificar
+        return planificar(date(2030, 1, 10))
+
+    def test_requerido_y_faltante(self):
+        plan = self._plan()
+        # Galleta 4 + 2, Torta 2, Vela 1; el pedido 5 ya está todo producido
+        self.assertEqual(plan.pedidos, 2)
+        insumos = {i["insumo"]: (i["requerido"], i["stock"], i["faltante"]) for i in plan.insumos}
+        self.assertEqual(insumos, {"Harina": (10.0, 10.0, 0.0), "Azucar": (3.0, 1.0, 2.0)})
+        self.assertEqual([i["insumo"] for i in plan.faltantes], ["Azucar"])
+
+    def test_maximo_producible_y_limitante(self):
+        productos = {p["producto"]: p for p in self._plan().productos}
+        self.assertEqual({n: p["demanda"] for n, p in productos.items()},
+                         {"Galleta": 6, "Torta": 2, "Vela": 1})
+        self.assertEqual((productos["Galleta"]["max_producible"], productos["Galleta"]["limitante"]),
+                         (2, "Azucar"))
+        self.assertEqual((productos["Torta"]["max_producible"], productos["Torta"]["limitante"]),
+                         (5, "Harina"))
+        self.assertTrue(productos["Vela"]["sin_receta"])
+        self.assertIsNone(productos["Vela"]["max_producible"])
+        self.assertIsNone(productos["Vela"]["limitante"])
+        self.assertFalse(productos["Galleta"]["sin_receta"])
+
+    def test_sin_demanda_en_el_horizonte(self):
+        from datetime import date
+        from .services_planificacion import planificar
+        plan = planificar(date(2030, 2, 1), dias=3)
+        self.assertEqual((plan.pedidos, plan.insumos, plan.productos), (0, [], []))
+
+
+@override_settings(HORNO_CAPACIDAD=10, HORNO_SLOT_MIN=60, HORNO_INICIO="07:00", HORNO_FIN="19:00",
+                   PROGRAMA_VENTANA_H=4, PROGRAMA_ANTICIPACION_MIN=60)
+@mock.patch("accounts.services_horneado.guardar_cursor")
+@mock.patch("accounts.services_horneado.leer_cursor", return_value=0)
+class ProgramaHorneadoTests(TablasLegadasTestCase):
+    tablas = {
+        "pedido": ddl_local(DDL_PEDIDO),
+        "detalle_pedido": ddl_local(DDL_DETALLE_PEDIDO),
+        "producto": DDL_PRODUCTO,
+        "sabor": DDL_PRODUCTO.replace("producto", "sabor"),
+        "produccion_linea": ddl_local(ProducirLineaTests.tablas["produccion_linea"]),
+    }
+
+    def setUp(self):
+        from datetime import date
+        from . import services_horneado
+        patcher = mock.patch.object(services_horneado, "_programa", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.desde = date(2030, 1, 10)
+        self.sql("INSERT INTO producto VALUES (1, 'Galleta'), (2, 'Torta')")
+        self.sql("INSERT INTO sabor VALUES (1, 'Chocolate'), (2, 'Vainilla')")
+        # Ventana 12-16 del día 10: Galleta/Chocolate 6 + 8 y Torta/Vainilla 3
+        self._pedido(1, self._hora(10, 12), [(1, 1, 6)])
+        self._pedido(2, self._hora(10, 14), [(1, 1, 8), (2, 2, 3)])
+        self._pedido(3, self._hora(11, 9), [(1, 1, 4)])
+
+    def _hora(self, dia: int, hora: int):
+        from datetime import datetime
+        from django.utils import timezone
+        return timezone.make_aware(datetime(2030, 1, dia, hora), timezone.get_current_timezone())
+
+    def _pedido(self, pid, entrega, lineas, estado="CONFIRMADO"):
+        self.sql("INSERT INTO pedido (id, estado, fecha_entrega_programada) VALUES (%s, %s, %s)",
+                 [pid, estado, entrega])
+        for prod, sab, cant in lineas:
+            self.sql("INSERT INTO detalle_pedido (pedido_id, producto_id, sabor_id, cantidad, "
+                     "precio_unitario) VALUES (%s, %s, %s, %s, 1)", [pid, prod, sab, cant])
+
+    @staticmethod
+    def _tandas(prog) -> list[tuple]:
+        return [(t.inicio, t.fin, t.producto, t.sabor, t.cantidad, t.pedidos, t.limite, t.clave)
+                for t in prog.tandas]
+
+    def test_parte_los_grupos_por_capacidad(self, _leer, _guardar):
+        from .services_horneado import planificar
+        prog = planificar(self.desde, 2)
+
+        self.assertEqual(
+            [(t.inicio, t.producto, t.sabor, t.cantidad, t.pedidos, t.limite) for t in prog.tandas],
+            [
+                # 14 galletas en tandas de 10: el pedido 1 entero y 4 del 2, luego el resto del 2
+                (self._hora(10, 7), "Galleta", "Chocolate", 10, [1, 2], self._hora(10, 11)),
+                (self._hora(10, 8), "Galleta", "Chocolate", 4, [2], self._hora(10, 13)),
+                (self._hora(10, 9), "Torta", "Vainilla", 3, [2], self._hora(10, 13)),
+                (self._hora(10, 10), "Galleta", "Chocolate", 4, [3], self._hora(11, 8)),
+            ],
+        )
+        self.assertEqual(prog.tardes, [])
+
+    def test_pedido_agregado_igual_que_replanificar(self, _leer, _guardar):
+        from .services_horneado import pedido_cambio, planificar, programa
+        prog = programa(self.desde, 2)
+        antes = list(prog.tandas)
+
+        # Entra en la ventana 8-12 del día 11: las tandas del día 10 no se tocan
+        self._pedido(4, self._hora(11, 10), [(2, 2, 9), (1, 1, 7)])
+        pedido_cambio(4)
+
+        self.assertEqual(self._tandas(prog), self._tandas(planificar(self.desde, 2)))
+        for vieja, nueva in zip(antes[:3], prog.tandas[:3]):
+            self.assertIs(vieja, nueva)
+        self.assertEqual(len(prog.tandas), 6)
+
+    def test_pedido_cancelado_igual_que_replanificar(self, _leer, _guardar):
+        from .services_horneado import pedido_cambio, planificar, programa
+        prog = programa(self.desde, 2)
+
+        self.sql("UPDATE pedido SET estado = 'CANCELADO' WHERE id = 1")
+        pedido_cambio(1)
+
+        self.assertEqual(self._tandas(prog), self._tandas(planificar(self.desde, 2)))
+        # Sin el pedido 1 las 8 galletas del 2 caben en una tanda
+        self.assertEqual([(t.producto, t.cantidad, t.pedidos) for t in prog.tandas],
+                         [("Galleta", 8, [2]), ("Torta", 3, [2]), ("Galleta", 4, [3])])
+
+    def test_linea_producida_sale_del_programa(self, _leer, _guardar):
+        from .services_horneado import pedido_cambio, planificar, programa
+        prog = programa(self.desde, 2)
+
+        self.sql("INSERT INTO produccion_linea (pedido_id, producto_id, sabor_id) VALUES (2, 2, 2)")
+        pedido_cambio(2)
+
+        self.assertEqual(self._tandas(prog), self._tandas(planificar(self.desde, 2)))
+        self.assertNotIn("Torta", [t.producto for t in prog.tandas])
+
+
+DDL_KARDEX_SNAPSHOT = """
+    CREATE TABLE kardex_snapshot (
+        insumo_id INT NOT NULL,
+        hasta_id BIGINT NOT NULL,
+        saldo DECIMAL(14,3) NOT NULL,
+        corte DATETIME NOT NULL,
+        PRIMARY KEY (insumo_id, hasta_id)
+    )
+"""
+
+# kardex en el motor de la corrida
+DDL_KARDEX_LOCAL = ddl_local(DDL_KARDEX)
+
+
+class ConteoTests(TablasLegadasTestCase):
+    tablas = {
+        "insumo": DDL_INSUMO,
+        "kardex": DDL_KARDEX_LOCAL,
+        "kardex_snapshot": DDL_KARDEX_SNAPSHOT,
+    }
+
+    def setUp(self):
+        self.sql("INSERT INTO insumo (id, nombre, cantidad_disponible) VALUES (1, 'Harina', 10.1)")
+        self.sql("INSERT INTO kardex (insumo_id, fecha, tipo, motivo, cantidad, saldo_resultante) "
+                 "VALUES (1, '2026-10-01', 'ENTRADA', 'COMPRA', 10.1, 10.1)")
+
+    def test_comparar_en_decimal(self):
+        from .services_conteo import comparar
+        (fila,) = comparar({1: Decimal("10.3")})
+        self.assertIsInstance(fila["diferencia"], Decimal)
+        self.assertEqual(fila["diferencia"], Decimal("0.2"))
+        self.assertEqual(fila["deriva"], Decimal("0"))
+
+    @solo_mysql
+    def test_conserva_los_movimientos_posteriores_a_la_vista_previa(self):
+        from .services_conteo import aplicar, comparar
+        from .services_kardex import registrar_movimiento
+        (fila,) = comparar({1: Decimal("8")})
+        # Entre la vista previa y la aprobación sale harina a producción
+        registrar_movimiento(1, "SALIDA", "CONSUMO", Decimal("3"))
+
+        (r,) = aplicar({1: fila["contado"]}, {1: fila["disponible"]})
+        self.assertTrue(r["ok"])
+        self.assertEqual(Decimal(self.sql("SELECT cantidad_disponible FROM insumo WHERE id=1")[0][0]),
+                         Decimal("5.0"))
+        ajuste = self.sql("SELECT cantidad FROM kardex WHERE tipo='AJUSTE'")
+        self.assertEqual([Decimal(a[0]) for a in ajuste], [Decimal("-2.1")])
+
+
+@mock.patch("accounts.services_insumos.guardar_cursor")
+@mock.patch("accounts.services_insumos.leer_cursor", return_value=1)
+class CatalogoInsumosTests(TablasLegadasTestCase):
+    tablas = {"insumo": DDL_INSUMO}
+
+    def setUp(self):
+        from . import services_insumos
+        services_insumos._catalogo = None
+        self.sql("INSERT INTO insumo (id, nombre) VALUES (1, 'Harina'), (2, 'Azúcar')")
+
+    def test_un_acierto_no_consulta_la_base(self, leer, _guardar):
+        from .services_insumos import catalogo
+        self.assertEqual([tuple(f) for f in catalogo()], [(2, "Azúcar"), (1, "Harina")])
+        with self.assertNumQueries(0):
+            catalogo()
+        self.assertEqual(leer.call_count, 1)
+
+    def test_revisa_la_version_cada_verificar_s(self, leer, _guardar):
+        from . import services_insumos
+        with mock.patch.object(services_insumos._time, "monotonic", return_value=1000.0) as reloj:
+            services_insumos.catalogo()
+            reloj.return_value += services_insumos.VERIFICAR_S
+            # Misma versión: se confirma la copia sin releer insumo
+            with self.assertNumQueries(0):
+                services_insumos.catalogo()
+            self.assertEqual(leer.call_count, 2)
+
+            leer.return_value = 2
+            self.sql("INSERT INTO insumo (id, nombre) VALUES (3, 'Cacao')")
+            reloj.return_value += services_insumos.VERIFICAR_S
+            self.assertEqual(len(services_insumos.catalogo()), 3)
+
+    def test_catalogo_cambio_invalida_en_el_proceso(self, _leer, guardar):
+        from . import services_insumos
+        services_insumos.catalogo()
+        self.sql("INSERT INTO insumo (id, nombre) VALUES (3, 'Cacao')")
+        services_insumos.catalogo_cambio()
+        guardar.assert_called_once()
+        self.assertEqual(len(services_insumos.catalogo()), 3)
+
+
+DDL_COMPRA = """
+    CREATE TABLE compra (
+        id INT PRIMARY KEY,
+        proveedor_id INT NULL,
+        fecha DATETIME NULL,
+        total DECIMAL(12,2) NULL,
+        recepcionada TINYINT(1) NOT NULL DEFAULT 0,
+        fecha_recepcion DATETIME NULL
+    )
+"""
+
+DDL_COMPRA_DETALLE = """
+    CREATE TABLE compra_detalle (
+        id BIGINT PRIMARY KEY,
+        compra_id INT NOT NULL,
+        insumo_id INT NOT NULL,
+        cantidad DECIMAL(12,3) NOT NULL,
+        costo_unitario DECIMAL(12,2) NOT NULL
+    )
+"""
+
+
+class ExportarKardexTests(TablasLegadasTestCase):
+    tablas = {
+        "insumo": DDL_INSUMO,
+        "kardex": DDL_KARDEX_LOCAL,
+        "compra": DDL_COMPRA,
+        "compra_detalle": DDL_COMPRA_DETALLE,
+    }
+
+    def setUp(self):
+        self.sql("INSERT INTO insumo (id, nombre, unidad_medida) VALUES (1, 'Harina', 'kg')")
+        self.sql("INSERT INTO compra (id, recepcionada, fecha_recepcion) VALUES (1, 1, '2026-09-30')")
+        self.sql("INSERT INTO compra_detalle (id, compra_id, insumo_id, cantidad, costo_unitario) "
+                 "VALUES (1, 1, 1, 10, 2.50)")
+        for kid, tipo, cant, saldo in [(1, "ENTRADA", 10, 10), (2, "SALIDA", 3, 7), (3, "SALIDA", 1, 6)]:
+            self.sql("INSERT INTO kardex (id, insumo_id, fecha, tipo, motivo, cantidad, saldo_resultante) "
+                     "VALUES (%s, 1, '2026-10-01 12:00:00', %s, 'COMPRA', %s, %s)", [kid, tipo, cant, saldo])
+
+    def _filas(self, bloques):
+        import csv
+        texto = b"".join(bloques).decode("utf-8")
+        return list(csv.reader(texto.splitlines()))
+
+    @mock.patch("accounts.services_kardex.BLOQUE_EXPORT", 2)
+    def test_csv_por_bloques_valorizado(self):
+        from .services_kardex import COLUMNAS_EXPORT, exportar
+        bloques = list(exportar())
+        # cabecera, dos bloques de filas y nada más (sin gzip no hay cola)
+        self.assertEqual(len(bloques), 3)
+        filas = self._filas(bloques)
+        self.assertEqual(filas[0], COLUMNAS_EXPORT)
+        self.assertEqual([f[0] for f in filas[1:]], ["1", "2", "3"])
+        col = {c: n for n, c in enumerate(COLUMNAS_EXPORT)}
+        self.assertEqual(filas[2][col["valor_movimiento"]], "-7.50")
+        self.assertEqual(filas[3][col["valor_saldo"]], "15.00")
+
+    # Última exportación hasta el id 1; esa corrida vio el máximo en 2
+    CURSORES = {"kardex.export.ultimo": 1, "kardex.export.tope": 2}
+
+    @mock.patch("accounts.services_kardex.guardar_cursor")
+    @mock.patch("accounts.services_kardex.leer_cursor", side_effect=CURSORES.get)
+    def test_incremental_llega_hasta_el_tope_anterior_y_avanza_al_terminar(self, _leer, guardar):
+        from .services_kardex import exportar
+        gen = exportar(incremental=True, avanzar=True)
+        next(gen)
+        gen.close()
+        guardar.assert_not_called()
+
+        # El 3 puede tener vecinos menores sin commit: sale en la próxima
+        filas = self._filas(exportar(incremental=True, avanzar=True))
+        self.assertEqual([f[0] for f in filas[1:]], ["2"])
+        self.assertEqual(guardar.call_args_list,
+                         [mock.call("kardex.export.ultimo", 2), mock.call("kardex.export.tope", 3)])
+
+    @mock.patch("accounts.services_kardex.guardar_cursor")
+    @mock.patch("accounts.services_kardex.leer_cursor", side_effect=CURSORES.get)
+    @mock.patch("accounts.permissions.tiene_permiso", return_value=True)
+    def test_get_incremental_es_vista_previa(self, _permiso, _leer, guardar):
+        from .views_inventario import kardex_export
+
+        request = RequestFactory().get("/", {"incremental": "1"})
+        request.user = SimpleNamespace(is_authenticated=True, email="inv@example.com")
+        filas = self._filas(kardex_export(request).streaming_content)
+        self.assertEqual([f[0] for f in filas[1:]], ["2"])
+        guardar.assert_not_called()
+
+    @mock.patch("accounts.services_kardex.guardar_cursor")
+    @mock.patch("accounts.services_kardex.leer_cursor", side_effect=CURSORES.get)
+    @mock.patch("accounts.permissions.tiene_permiso", return_value=True)
+    def test_post_incremental_marca_lo_exportado(self, tiene, _leer, guardar):
+        from .views_inventario import kardex_export_incremental
+
+        request = RequestFactory().get("/")
+        request.user = SimpleNamespace(is_authenticated=True, email="inv@example.com")
+        self.assertEqual(kardex_export_incremental(request).status_code, 405)
+
+        request = RequestFactory().post("/")
+        request.user = SimpleNamespace(is_authenticated=True, email="inv@example.com")
+        list(kardex_export_incremental(request).streaming_content)
+        self.assertEqual(tiene.call_args.args[1], "INVENTARIO_WRITE")
+        guardar.assert_any_call("kardex.export.ultimo", 2)
+
+    async def test_async_entrega_el_primer_bloque_sin_leer_el_resto(self):
+        from . import services_kardex
+        pedidos = []
+
+        def sin_fin(**_filtros):
+            while True:
+                pedidos.append(1)
+                yield b"x" * 10
+
+        with mock.patch.object(services_kardex, "exportar", sin_fin):
+            stream = services_kardex.exportar_async()
+            self.assertEqual(await stream.__anext__(), b"x" * 10)
+            self.assertEqual(len(pedidos), 1)
+            await stream.aclose()
+
+    @mock.patch("accounts.permissions.tiene_permiso", return_value=True)
+    async def test_vista_bajo_asgi_transmite_en_asincrono(self, _permiso):
+        from asgiref.sync import sync_to_async
+        from django.test import AsyncRequestFactory
+        from .views_inventario import kardex_export
+
+        request = AsyncRequestFactory().get("/inventario/kardex/export/")
+        request.user = SimpleNamespace(is_authenticated=True, email="inv@example.com")
+        resp = await sync_to_async(kardex_export)(request)
+        self.assertTrue(resp.is_async)
+        primero = await resp.__aiter__().__anext__()
+        self.assertTrue(primero.startswith(b"id,fecha,insumo_id"))
+
+
+DDL_PROCESO_CURSOR = """
+    CREATE TABLE proceso_cursor (
+        nombre VARCHAR(60) NOT NULL PRIMARY KEY,
+        valor BIGINT NOT NULL,
+        actualizado_en DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+
+@solo_mysql
+class ConciliacionTests(TablasLegadasTestCase):
+    """Corrida contra el stand-in local de Stripe cargado desde STRIPE_LOCAL_FIXTURE."""
+    tablas = {
+        "proceso_cursor": DDL_PROCESO_CURSOR,
+        "pedido": DDL_PEDIDO,
+        "pago": DDL_PAGO,
+        "conciliacion_pago": """
+            CREATE TABLE conciliacion_pago (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                referencia VARCHAR(120) NOT NULL,
+                tipo VARCHAR(20) NOT NULL,
+                pedido_id INT NULL,
+                pago_id INT NULL,
+                monto_stripe DECIMAL(12,2) NULL,
+                monto_pago DECIMAL(12,2) NULL,
+                detectado_en DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE KEY ux_conciliacion_ref_tipo (referencia, tipo)
+            )
+        """,
+        "conciliacion_sesion": """
+            CREATE TABLE conciliacion_sesion (
+                referencia VARCHAR(120) NOT NULL PRIMARY KEY,
+                created BIGINT NOT NULL
+            )
+        """,
+    }
+
+    def setUp(self):
+        hace = int(time.time()) - 600
+
+        def ses(sid, centavos, pedido, status="complete", pagada="paid"):
+            return {"id": sid, "status": status, "payment_status": pagada, "amount_total": centavos,
+                    "metadata": {"pedido_id": str(pedido)}, "created": hace}
+
+        sesiones = [
+            ses("cs_ok", 10000, 1),
+            ses("cs_monto", 5000, 2),
+            ses("cs_pedido", 3000, 9),
+            ses("cs_sin_pago", 2000, 4),
+            ses("cs_abierta", 7000, 4, status="open", pagada="unpaid"),
+        ]
+        fh = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+        json.dump({"checkout_sessions": sesiones}, fh)
+        fh.close()
+        self.addCleanup(os.unlink, fh.name)
+        ajustes = override_settings(STRIPE_HTTP_CLIENT="local", STRIPE_SECRET_KEY="sk_test_local",
+                                    STRIPE_LOCAL_FIXTURE=fh.name, STRIPE_MAX_NETWORK_RETRIES=0)
+        ajustes.enable()
+        self.addCleanup(ajustes.disable)
+        stripe_service.reset_client()
+        self.addCleanup(stripe_service.reset_client)
+
+        for pid in (1, 2, 3, 4):
+            self.sql("INSERT INTO pedido (id, estado, total) VALUES (%s, 'CONFIRMADO', 100)", [pid])
+        for pago_id, pid, metodo, monto, ref in [
+            (1, 1, "STRIPE", 100, "cs_ok"),
+            (2, 2, "STRIPE", 40, "cs_monto"),
+            (3, 3, "TRANSFERENCIA", 30, "cs_pedido"),
+            (4, 4, "EFECTIVO", 15, None),
+            (5, 4, "STRIPE", 25, "cs_fantasma"),
+        ]:
+            self._pago(pago_id, pid, metodo, monto, ref)
+
+    def _pago(self, pago_id, pid, metodo, monto, ref):
+        self.sql("INSERT INTO pago (id, pedido_id, metodo, monto, referencia, created_at) "
+                 "VALUES (%s, %s, %s, %s, %s, NOW())", [pago_id, pid, metodo, monto, ref])
+
+    def _hallazgos(self):
+        return sorted(tuple(r) for r in self.sql("SELECT referencia, tipo FROM conciliacion_pago"))
+
+    def test_diferencias_y_corrida_incremental(self):
+        from . import services_conciliacion as conc
+        from .utils import leer_cursor
+
+        stats = conc.conciliar(hilos=2)
+        self.assertEqual(stats, {"sesiones": 4, "conciliadas": 1, conc.SIN_PAGO: 1,
+                                 conc.MONTO: 1, conc.PEDIDO: 1, conc.SIN_STRIPE: 1})
+        self.assertEqual(self._hallazgos(), [
+            ("cs_fantasma", conc.SIN_STRIPE), ("cs_monto", conc.MONTO),
+            ("cs_pedido", conc.PEDIDO), ("cs_sin_pago", conc.SIN_PAGO),
+        ])
+        self.assertEqual(self.sql("SELECT COUNT(*) FROM conciliacion_sesion")[0][0], 4)
+        self.assertEqual(leer_cursor(conc.CURSOR_PAGO), 5)
+        self.assertGreater(leer_cursor(conc.CURSOR_CREATED), 0)
+
+        # Segunda corrida: se registra el pago que faltaba; los pagos ya
+        # revisados no se vuelven a cruzar y el solape no duplica hallazgos.
+        self._pago(6, 4, "STRIPE", 20, "cs_sin_pago")
+        stats = conc.conciliar(hilos=2)
+        self.assertEqual(stats[conc.SIN_STRIPE], 0)
+        self.assertEqual(stats[conc.SIN_PAGO], 0)
+        self.assertEqual(stats["conciliadas"], 2)
+        self.assertEqual(len(self._hallazgos()), 4)
+        self.assertEqual(leer_cursor(conc.CURSOR_PAGO), 6)
+
+
+@mock.patch("accounts.views_facturas.anotar_saldos")
+@mock.patch("accounts.views_facturas.FACTURAS_POR_PAGINA", 2)
+class FacturaListTests(TablasLegadasTestCase):
+    tablas = {
+        "usuario": "CREATE TABLE usuario (id INT PRIMARY KEY, email VARCHAR(120) NOT NULL)",
+        "cliente": "CREATE TABLE cliente (id INT PRIMARY KEY, usuario_id INT NOT NULL, nombre VARCHAR(120) NOT NULL)",
+        "pedido": "CREATE TABLE pedido (id INT PRIMARY KEY, cliente_id INT NOT NULL)",
+        "factura": """
+            CREATE TABLE factura (
+                id INT PRIMARY KEY,
+                pedido_id INT NOT NULL,
+                nro VARCHAR(60) NOT NULL,
+                fecha DATETIME NULL,
+                total DECIMAL(12,2) NOT NULL
+            )
+        """,
+    }
+
+    def setUp(self):
+        self.sql("INSERT INTO usuario (id, email) VALUES (1, 'ana@pan.bo'), (2, 'beto@pan.bo')")
+        self.sql("INSERT INTO cliente (id, usuario_id, nombre) VALUES (1, 1, 'Ana'), (2, 2, 'Beto')")
+        # Tres facturas comparten fecha: el corte de página cae en medio de ellas
+        for fid, fecha in [(1, "2026-10-01 10:00:00"), (2, "2026-10-02 10:00:00"),
+                           (3, "2026-10-02 10:00:00"), (4, "2026-10-02 10:00:00"),
+                           (5, "2026-10-03 10:00:00")]:
+            cliente = 1 if fid % 2 else 2
+            self.sql("INSERT INTO pedido (id, cliente_id) VALUES (%s, %s)", [fid, cliente])
+            self.sql("INSERT INTO factura (id, pedido_id, nro, fecha, total) VALUES (%s, %s, %s, %s, 10)",
+                     [fid, fid, f"F-{fid}", fecha])
+
+    def _pagina(self, **get):
+        from .views_facturas import factura_list
+        request = RequestFactory().get("/facturas/", get)
+        request.user = SimpleNamespace(is_authenticated=True)
+        with mock.patch("accounts.views_facturas.render") as render:
+            factura_list(request)
+        return render.call_args[0][2]
+
+    def test_paginas_por_keyset_sin_saltos_ni_repetidos(self, _anotar):
+        vistos, antes = [], None
+        while True:
+            ctx = self._pagina(**({"antes": antes} if antes else {}))
+            vistos += [r["id"] for r in ctx["rows"]]
+            antes = ctx["siguiente"]
+            if not antes:
+                break
+        self.assertEqual(vistos, [5, 4, 3, 2, 1])
+
+    def test_email_y_nro_filtran_por_prefijo(self, _anotar):
+        self.assertEqual([r["id"] for r in self._pagina(q="beto@")["rows"]], [4, 2])
+        self.assertEqual([r["id"] for r in self._pagina(q="f-3")["rows"]], [3])
+
+    def test_elige_el_camino_indexable(self, _anotar):
+        from .views_facturas import _filtro_texto
+        self.assertEqual(_filtro_texto("ana@pan"), ("u.email LIKE %s", ["ana@pan%"]))
+        self.assertEqual(_filtro_texto("f-12"), ("f.nro LIKE %s", ["F-12%"]))
+        self.assertEqual(_filtro_texto("12"), ("f.nro = %s", ["F-12"]))
+        # Los comodines del usuario no llegan al LIKE
+        self.assertEqual(_filtro_texto("a_b%@x")[1], ["a\\_b\\%@x%"])
+
+
+@override_settings(DESPACHO_ORIGEN_LAT="-16.499", DESPACHO_ORIGEN_LNG="-68.130")
+class RutasPlanificarTests(TablasLegadasTestCase):
+    tablas = {
+        "cliente": "CREATE TABLE cliente (id INT PRIMARY KEY, nombre VARCHAR(120) NOT NULL, telefono VARCHAR(40) NULL)",
+        "pedido": """
+            CREATE TABLE pedido (
+                id INT PRIMARY KEY,
+                cliente_id INT NOT NULL,
+                metodo_envio VARCHAR(20) NOT NULL,
+                direccion_entrega VARCHAR(200) NOT NULL DEFAULT '',
+                total DECIMAL(12,2) NOT NULL DEFAULT 0
+            )
+        """,
+        "dispatch_queue": "CREATE TABLE dispatch_queue (pedido_id INT PRIMARY KEY)",
+        "zona": """
+            CREATE TABLE zona (
+                id INT PRIMARY KEY,
+                nombre VARCHAR(80) NOT NULL,
+                palabra_clave VARCHAR(80) NOT NULL,
+                lat DECIMAL(9,6) NULL,
+                lng DECIMAL(9,6) NULL
+            )
+        """,
+        "direccion_geo": """
+            CREATE TABLE direccion_geo (
+                direccion_sha1 CHAR(40) NOT NULL PRIMARY KEY,
+                direccion VARCHAR(200) NOT NULL,
+                lat DECIMAL(9,6) NOT NULL,
+                lng DECIMAL(9,6) NOT NULL,
+                actualizado_en DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """,
+    }
+
+    def setUp(self):
+        from .services_rutas import direccion_sha1, normalizar_direccion
+
+        self.sql("INSERT INTO cliente (id, nombre) VALUES (1, 'Ana')")
+        self.sql("INSERT INTO zona (id, nombre, palabra_clave, lat, lng) VALUES "
+                 "(1, 'Centro', 'centro', -16.500, -68.130), (2, 'Sur', 'Calacoto', -16.540, -68.080)")
+        pedidos = [
+            (10, "DELIVERY", "Av. Camacho 100, Centro", (-16.500, -68.130)),
+            (11, "DELIVERY", "Calle Comercio 5, CENTRO", (-16.520, -68.130)),
+            (12, "delivery", "Calle Potosí 1, centro", (-16.505, -68.130)),
+            (13, "DELIVERY", "Calle 21 Calacoto", None),
+            (14, "DELIVERY", "Ciudad Satélite", None),
+            (15, "RETIRO", "Av. Camacho 200, Centro", None),
+        ]
+        for pid, metodo, direccion, coord in pedidos:
+            self.sql("INSERT INTO pedido (id, cliente_id, metodo_envio, direccion_entrega) "
+                     "VALUES (%s, 1, %s, %s)", [pid, metodo, direccion])
+            self.sql("INSERT INTO dispatch_queue (pedido_id) VALUES (%s)", [pid])
+            if coord:
+                norm = normalizar_direccion(direccion)
+                self.sql("INSERT INTO direccion_geo (direccion_sha1, direccion, lat, lng) "
+                         "VALUES (%s, %s, %s, %s)", [direccion_sha1(norm), norm, *coord])
+
+    def test_agrupa_por_zona_y_ordena_por_vecino_mas_cercano(self):
+        from .services_rutas import SIN_ZONA, planificar
+
+        grupos = planificar()
+        self.assertEqual([(g["zona"], [p["id"] for p in g["paradas"]]) for g in grupos],
+                         [("Centro", [10, 12, 11]), ("Sur", [13]), (SIN_ZONA, [14])])
+        # Sin coordenadas propias: centro de la zona; sin zona: ninguna
+        self.assertEqual(grupos[1]["paradas"][0]["coord"], (-16.54, -68.08))
+        self.assertIsNone(grupos[2]["paradas"][0]["coord"])
+
+    def test_direcciones_sin_coordenadas(self):
+        from .services_rutas import direcciones_sin_coordenadas
+
+        self.assertEqual(direcciones_sin_coordenadas(), ["calle 21 calacoto", "ciudad satelite"])
+        self.assertEqual(direcciones_sin_coordenadas(limite=1), ["calle 21 calacoto"])
+
+    @solo_mysql
+    def test_geocodificar_llena_la_cache(self):
+        from .services_rutas import geocodificar, planificar
+
+        guardadas, sin_resultado = geocodificar({"calle 21 calacoto": (-16.545, -68.075)}.get)
+        self.assertEqual((guardadas, sin_resultado), (1, ["ciudad satelite"]))
+        sur = next(g for g in planificar() if g["zona"] == "Sur")
+        self.assertEqual(sur["paradas"][0]["coord"], (-16.545, -68.075))
+
+
+@mock.patch("accounts.views_pedidos.services_despacho.sincronizar")
+@mock.patch("accounts.views_pedidos.services_checkout.invalidar")
+@mock.patch("accounts.views_pedidos.guardar_descuento", return_value=Decimal("0"))
+@mock.patch("accounts.views_pedidos.mejor_descuento", return_value=(None, Decimal("0")))
+@mock.patch("accounts.views_pedidos.Sabor")
+@mock.patch("accounts.views_pedidos.Producto")
+@mock.patch("accounts.views_pedidos.get_object_or_404")
+class PedidoEditarTests(TransactionTestCase):
+    def test_filas_repetidas_se_suman_en_una_linea(self, get_pedido, _prod, _sab, mejor, guardar, *_):
+        from django.contrib.messages.storage.cookie import CookieStorage
+        from .views_pedidos import pedido_editar
+
+        get_pedido.return_value = SimpleNamespace(id=7, costo_envio=Decimal("5"), estado="PENDIENTE")
+        request = RequestFactory().post("/pedidos/7/editar/", {
+            "filas": "3",
+            "p_0": "1", "s_0": "2", "c_0": "2", "u_0": "10",
+            "p_1": "1", "s_1": "2", "c_1": "3", "u_1": "10",
+            "p_2": "4", "s_2": "2", "c_2": "1", "u_2": "8",
+        })
+        request.user = SimpleNamespace(is_authenticated=True, is_staff=True, email="s@example.com")
+        request._messages = CookieStorage(request)
+        conn = _cursor_falso()
+        with mock.patch("accounts.views_pedidos.connection", conn):
+            pedido_editar(request, pedido_id=7)
+
+        base = Decimal("5") * 10 + 8 + 5
+        mejor.assert_called_once_with(base)
+        self.assertEqual(guardar.call_args[0][3], base)
+        cur = conn.cursor.return_value.__enter__.return_value
+        upserts = [c.args[1] for c in cur.execute.call_args_list if "INSERT INTO detalle_pedido" in c.args[0]]
+        self.assertEqual(upserts, [[7, 1, 2, "5", "10"], [7, 4, 2, "1", "8"]])
+        self.assertEqual(cur.execute.call_args_list[-1].args[1], [str(base), 7])
+
+
+def _post_lote(datos: dict):
+    from rest_framework.test import APIRequestFactory, force_authenticate
+    from .api import MovimientosLoteAPI
+
+    request = APIRequestFactory().post("/", datos, format="json")
+    force_authenticate(request, user=SimpleNamespace(is_authenticated=True, email="bodega@example.com"))
+    with mock.patch("accounts.api.tiene_permiso", return_value=True):
+        return MovimientosLoteAPI.as_view()(request)
+
+
+@solo_mysql
+class MovimientosLoteTests(TablasLegadasTestCase):
+    tablas = {"insumo": DDL_INSUMO, "kardex": DDL_KARDEX_LOCAL}
+
+    def setUp(self):
+        self.sql("INSERT INTO insumo (id, nombre, cantidad_disponible) VALUES (1, 'Harina', 10), (2, 'Azúcar', 5)")
+
+    def _stock(self) -> dict:
+        return {iid: Decimal(d) for iid, d in self.sql("SELECT id, cantidad_disponible FROM insumo")}
+
+    def test_salida_que_deja_negativo_se_rechaza_y_las_demas_aplican(self):
+        from .services_kardex import registrar_movimientos
+
+        r = registrar_movimientos([
+            {"insumo_id": 1, "tipo": "SALIDA", "motivo": "CONSUMO", "cantidad": 4},
+            {"insumo_id": 2, "tipo": "SALIDA", "motivo": "CONSUMO", "cantidad": 8},
+            {"insumo_id": 2, "tipo": "ENTRADA", "motivo": "COMPRA", "cantidad": 1},
+            # Se valida sobre el saldo que dejó la primera fila (6)
+            {"insumo_id": 1, "tipo": "SALIDA", "motivo": "CONSUMO", "cantidad": 7},
+            {"insumo_id": 1, "tipo": "AJUSTE", "motivo": "AJUSTE", "cantidad": -1},
+        ])
+
+        self.assertEqual([x["ok"] for x in r], [True, False, True, False, True])
+        self.assertIn("stock insuficiente", r[1]["error"])
+        self.assertEqual([x["saldo"] for x in r], [Decimal("6"), None, Decimal("6"), None, Decimal("5")])
+        self.assertEqual(self._stock(), {1: Decimal("5"), 2: Decimal("6")})
+        self.assertEqual([(iid, Decimal(s)) for iid, s in
+                          self.sql("SELECT insumo_id, saldo_resultante FROM kardex ORDER BY id")],
+                         [(1, Decimal("6")), (2, Decimal("6")), (1, Decimal("5"))])
+
+    def test_todo_o_nada_no_escribe_ninguna(self):
+        from .services_kardex import registrar_movimientos
+
+        r = registrar_movimientos([
+            {"insumo_id": 1, "tipo": "ENTRADA", "motivo": "COMPRA", "cantidad": 3},
+            {"insumo_id": 2, "tipo": "SALIDA", "motivo": "CONSUMO", "cantidad": 6},
+        ], todo_o_nada=True)
+
+        self.assertEqual([(x["ok"], x["saldo"]) for x in r], [(False, None), (False, None)])
+        self.assertIsNone(r[0]["error"])
+        self.assertEqual(self._stock(), {1: Decimal("10"), 2: Decimal("5")})
+        self.assertEqual(self.sql("SELECT COUNT(*) FROM kardex")[0][0], 0)
+
+    def test_api_responde_409_si_todo_o_nada_falla(self):
+        resp = _post_lote({"todo_o_nada": True, "filas": [
+            {"insumo_id": 1, "tipo": "ENTRADA", "motivo": "COMPRA", "cantidad": "3"},
+            {"insumo_id": 2, "tipo": "SALIDA", "motivo": "CONSUMO", "cantidad": "6"},
+        ]})
+
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual((resp.data["aplicadas"], resp.data["fallidas"]), (0, 1))
+        self.assertEqual(self._stock(), {1: Decimal("10"), 2: Decimal("5")})
+        self.assertEqual(self.sql("SELECT COUNT(*) FROM kardex")[0][0], 0)
+
+    def test_api_aplica_las_validas_sin_todo_o_nada(self):
+        resp = _post_lote({"filas": [
+            {"insumo_id": 1, "tipo": "ENTRADA", "motivo": "COMPRA", "cantidad": "3"},
+            {"insumo_id": 2, "tipo": "SALIDA", "motivo": "CONSUMO", "cantidad": "6"},
+        ]})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual((resp.data["aplicadas"], resp.data["fallidas"]), (1, 1))
+        self.assertEqual(self._stock(), {1: Decimal("13"), 2: Decimal("5")})
+
+
+class MovimientosLoteCantidadTests(TransactionTestCase):
+    """Sin filas válidas no se bloquea ningún insumo: corre en cualquier motor."""
+    FILAS = [
+        {"insumo_id": 1, "tipo": "SALIDA", "motivo": "CONSUMO", "cantidad": "0"},
+        {"insumo_id": 1, "tipo": "ENTRADA", "motivo": "COMPRA", "cantidad": "-2"},
+        {"insumo_id": 1, "tipo": "SALIDA", "motivo": "CONSUMO", "cantidad": "-1"},
+        {"insumo_id": 1, "tipo": "AJUSTE", "motivo": "AJUSTE", "cantidad": "0"},
+    ]
+
+    def test_rechaza_cantidad_cero_o_negativa_fuera_de_ajuste(self):
+        from .services_kardex import registrar_movimientos
+
+        r = registrar_movimientos([dict(f) for f in self.FILAS])
+        self.assertEqual([x["ok"] for x in r], [False] * 4)
+        for x in r:
+            self.assertIn("la cantidad debe ser positiva", x["error"])
+
+    def test_api_informa_las_filas_rechazadas(self):
+        resp = _post_lote({"filas": self.FILAS})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual((resp.data["aplicadas"], resp.data["fallidas"]), (0, 4))
+
+        resp = _post_lote({"filas": self.FILAS, "todo_o_nada": True})
+        self.assertEqual(resp.status_code, 409)
+
+
+@solo_mysql
+class FechaMovimientoTests(TablasLegadasTestCase):
+    """Las fechas de un insumo no retroceden: saldo_al coincide con el orden de escritura."""
+    tablas = {"insumo": DDL_INSUMO, "kardex": DDL_KARDEX_LOCAL}
+
+    def setUp(self):
+        from datetime import datetime
+        from django.utils import timezone
+        from .services_kardex import registrar_movimiento
+
+        self.d = lambda dia: timezone.make_aware(datetime(2026, 10, dia, 12))
+        self.sql("INSERT INTO insumo (id, nombre, cantidad_disponible) VALUES (1, 'Harina', 0), (2, 'Azúcar', 0)")
+        registrar_movimiento(1, "ENTRADA", "COMPRA", 10, fecha=self.d(10))
+        registrar_movimiento(2, "ENTRADA", "COMPRA", 10, fecha=self.d(1))
+
+    def test_rechaza_fecha_anterior_al_ultimo_movimiento(self):
+        from .services_kardex import FechaFueraDeOrden, registrar_movimiento, saldo_al
+
+        with self.assertRaises(FechaFueraDeOrden):
+            registrar_movimiento(1, "SALIDA", "CONSUMO", 3, fecha=self.d(5))
+        registrar_movimiento(1, "SALIDA", "CONSUMO", 3, fecha=self.d(11))
+        self.assertEqual(saldo_al(1, self.d(10)), Decimal("10"))
+        self.assertEqual(saldo_al(1, self.d(11)), Decimal("7"))
+
+    def test_lote_rechaza_solo_los_insumos_con_movimientos_posteriores(self):
+        from .services_kardex import registrar_movimientos
+
+        filas = [{"insumo_id": i, "tipo": "SALIDA", "motivo": "CONSUMO", "cantidad": 1} for i in (1, 2)]
+        r1, r2 = registrar_movimientos(filas, fecha=self.d(5))
+        self.assertFalse(r1["ok"])
+        self.assertIn("posteriores", r1["error"])
+        self.assertTrue(r2["ok"])
+
+    def test_rechaza_fecha_futura(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from .services_kardex import FechaFueraDeOrden, registrar_movimiento, registrar_movimientos
+
+        manana = timezone.now() + timedelta(days=1)
+        with self.assertRaises(FechaFueraDeOrden):
+            registrar_movimiento(2, "ENTRADA", "COMPRA", 1, fecha=manana)
+        (r,) = registrar_movimientos([{"insumo_id": 2, "tipo": "ENTRADA", "motivo": "COMPRA", "cantidad": 1}],
+                                     fecha=manana)
+        self.assertIn("futura", r["error"])
@@ -14,6 +14,7 @@ from . import (
     views_envios,
     views_pagos,         # Stripe / pagos manuales
     views_descuentos,    # CU30 – promociones y descuentos
+    views_eventos,       # SSE de estado de pedidos (ASGI)
 )
 
 # ---------- Reportes (funciones específicas) ----------
@@ -66,6 +67,10 @@ from .views_produccion import (
     pedidos_para_produccion,
     gestionar_produccion,
     producir_item,
+    plan_produccion,
+    plan_produccion_csv,
+    producir_lote,
+    programa_horneado,
 )
 
 # ---------- Web ----------
@@ -136,7 +141,12 @@ urlpatterns = [
         views_inventario.movimiento_crear,
         name="movimiento_crear",
     ),
+    path("inventario/movimientos/lote/", views_inventario.movimiento_lote, name="movimiento_lote"),
+    path("inventario/conteo/", views_inventario.conteo_inventario, name="conteo_inventario"),
     path("inventario/kardex/", views_inventario.kardex_list, name="kardex_list"),
+    path("inventario/kardex/export.csv", views_inventario.kardex_export, name="kardex_export"),
+    path("inventario/kardex/export-incremental.csv", views_inventario.kardex_export_incremental,
+         name="kardex_export_incremental"),
     path(
         "inventario/kardex/<int:pk>/",
         views_inventario.kardex_por_insumo,
@@ -206,6 +216,7 @@ urlpatterns = [
 
     # Facturas (CU17)
     path("facturas/", views_facturas.factura_list, name="factura_list"),
+    path("facturas/emitir-lote/", views_facturas.factura_emitir_lote, name="factura_emitir_lote"),
     path(
         "pedidos/<int:pedido_id>/factura/emitir/",
         views_facturas.factura_emitir,
@@ -216,6 +227,11 @@ urlpatterns = [
         views_facturas.factura_detalle,
         name="factura_detalle",
     ),
+    path(
+        "pedidos/<int:pedido_id>/factura/pdf/",
+        views_facturas.factura_pdf,
+        name="factura_pdf",
+    ),
 
     # Recetas (CU22)
     path("recetas/", recetas_list, name="recetas_list"),
@@ -229,6 +245,21 @@ urlpatterns += [
         views_envios.envio_crear_editar,
         name="envio_crear_editar",
     ),
+    path("envios/", views_envios.envio_list, name="envio_list"),
+    path(
+        "pedidos/<int:pedido_id>/envio/entregado/",
+        views_envios.envio_marcar_entregado,
+        name="envio_marcar_entregado",
+    ),
+
+    # Rutas de despacho por zona
+    path("despacho/", views_envios.despacho_rutas, name="despacho_rutas"),
+    path("despacho/asignar/", views_envios.despacho_asignar, name="despacho_asignar"),
+    path("despacho/rutas/<int:ruta_id>/", views_envios.despacho_ruta_detalle, name="despacho_ruta_detalle"),
+    path("despacho/rutas/<int:ruta_id>/cerrar/", views_envios.despacho_cerrar, name="despacho_cerrar"),
+
+    # Cambios de pedidos en vivo (Server-Sent Events)
+    path("eventos/pedidos/", views_eventos.eventos_pedidos, name="eventos_pedidos"),
 ]
 
 # ---------- Reportes ----------
@@ -345,6 +376,10 @@ urlpatterns += [
         producir_item,
         name="producir_item",
     ),
+    path("produccion/producir/", producir_lote, name="producir_lote"),
+    path("produccion/programa/", programa_horneado, name="programa_horneado"),
+    path("produccion/plan/", plan_produccion, name="plan_produccion"),
+    path("produccion/plan/export.csv", plan_produccion_csv, name="plan_produccion_csv"),
 ]
 
 # ---------- CU29: Calificar entrega / producto ----------
@@ -384,6 +419,11 @@ urlpatterns += [
         views_descuentos.descuento_toggle_activo,
         name="descuento_toggle",
     ),
+    path(
+        "descuentos/<int:descuento_id>/lote/",
+        views_descuentos.descuento_lote,
+        name="descuento_lote",
+    ),
     path(
         "pedidos/<int:pedido_id>/descuento/",
         views_descuentos.aplicar_descuento_pedido,
@@ -400,5 +440,7 @@ router.register(r"roles",    accounts_api.RolViewSet)
 router.register(r"usuarios", accounts_api.UsuarioViewSet)
 
 urlpatterns += [
+    path("api/inventario/movimientos/", accounts_api.MovimientosLoteAPI.as_view(),
+         name="api_movimientos_lote"),
     path("api/", include(router.urls)),
 ]
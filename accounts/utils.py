@@ -22,3 +22,56 @@ def log_event(request, entidad: str, entidad_id: int | None, accion: str):
     except Exception:
         # No bloquear el flujo si la bitácora falla
         pass
+
+
+# ---------- Cursores de procesos incrementales (tabla proceso_cursor) ----------
+def leer_cursor(nombre: str, default: int = 0) -> int:
+    from django.db import connection
+
+    with connection.cursor() as cur:
+        cur.execute("SELECT valor FROM proceso_cursor WHERE nombre=%s", [nombre])
+        row = cur.fetchone()
+    return int(row[0]) if row else default
+
+
+def guardar_cursor(nombre: str, valor: int):
+    from django.db import connection
+
+    with connection.cursor() as cur:
+        cur.execute("""
+            INSERT INTO proceso_cursor (nombre, valor) VALUES (%s, %s)
+            ON DUPLICATE KEY UPDATE valor=VALUES(valor)
+        """, [nombre, int(valor)])
+
+
+# ---------- Reintento ante deadlock (MySQL 1213) / lock wait timeout (1205) ----------
+ERRORES_REINTENTABLES = (1213, 1205)
+ER_DUP_ENTRY = 1062  # clave única duplicada
+
+
+def reintentar_si_deadlock(intentos: int = 3, espera: float = 0.05):
+    """
+    Decorador para funciones que abren su propia transacción: si MySQL la
+    aborta por deadlock o lock wait timeout, la repite con espera creciente.
+    Dentro de una transacción externa no reintenta (ya quedó revertida).
+    """
+    import functools
+    import random
+    import time
+
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            from django.db import OperationalError, connection
+
+            for n in range(intentos):
+                try:
+                    return fn(*args, **kwargs)
+                except OperationalError as e:
+                    codigo = e.args[0] if e.args else None
+                    if (codigo not in ERRORES_REINTENTABLES or n == intentos - 1
+                            or connection.in_atomic_block):
+                        raise
+                    time.sleep(espera * (2 ** n) * (1 + random.random()))
+        return wrapper
+    return deco
@@ -17,6 +17,8 @@ from .models_db import (
     UsuarioRol, RolPermiso, Pago
 )
 from .utils import log_event
+from . import services_checkout, services_despacho, services_eventos, services_insumos, services_reservas
+from .services_descuentos import guardar_descuento, mejor_descuento
 from .permissions import requiere_permiso
 from .forms_proveedor import ProveedorForm
 from .forms import InsumoForm
@@ -65,40 +67,39 @@ def crear_pedido(request, sabor_id):
             pass
 
     costo_envio = Decimal("5.00") if metodo == "DELIVERY" else Decimal("0.00")
-    pedido = Pedido.objects.create(
-        cliente=cliente,
-        estado="PENDIENTE",
-        metodo_envio=metodo,
-        costo_envio=costo_envio,
-        direccion_entrega=direccion,
-        total=Decimal("0.00"),
-        created_at=timezone.now(),
-        fecha_entrega_programada=fecha_entrega,
-    )
 
     producto = Producto.objects.filter(nombre__iexact="Galleta").first() or Producto.objects.first()
     if not producto:
         messages.error(request, "No hay productos definidos.")
         return redirect("catalogo")
 
-    with connection.cursor() as cur:
-        cur.execute(
-            """
-            INSERT INTO detalle_pedido (pedido_id, producto_id, sabor_id, cantidad, precio_unitario)
-            VALUES (%s, %s, %s, %s, %s)
-            """,
-            [pedido.id, producto.id, sabor.id, cantidad, Decimal("10.00")],
-        )
-
-    with connection.cursor() as cur:
-        cur.execute(
-            "SELECT COALESCE(SUM(sub_total), 0) FROM detalle_pedido WHERE pedido_id=%s",
-            [pedido.id],
+    # Total final en memoria: items + envío - mejor descuento activo
+    precio_unit = Decimal("10.00")
+    base = precio_unit * cantidad + costo_envio
+    regla, monto = mejor_descuento(base)
+
+    with transaction.atomic():
+        pedido = Pedido.objects.create(
+            cliente=cliente,
+            estado="PENDIENTE",
+            metodo_envio=metodo,
+            costo_envio=costo_envio,
+            direccion_entrega=direccion,
+            total=base - monto,
+            created_at=timezone.now(),
+            fecha_entrega_programada=fecha_entrega,
         )
-        subtotal = Decimal(cur.fetchone()[0] or 0)
 
-    pedido.total = subtotal + costo_envio
-    pedido.save(update_fields=["total"])
+        with connection.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO detalle_pedido (pedido_id, producto_id, sabor_id, cantidad, precio_unitario)
+                VALUES (%s, %s, %s, %s, %s)
+                """,
+                [pedido.id, producto.id, sabor.id, cantidad, precio_unit],
+            )
+        if regla:
+            guardar_descuento(pedido.id, regla, monto, base)
 
     messages.success(request, "Pedido creado correctamente.")
     return redirect("perfil")
@@ -111,8 +112,17 @@ def confirmar_pedido(request, pedido_id):
     from .views_auth import get_cliente_actual
     cliente = get_cliente_actual(request)
     pedido = get_object_or_404(Pedido, id=pedido_id, cliente=cliente, estado="PENDIENTE")
-    pedido.estado = "CONFIRMADO"
-    pedido.save(update_fields=["estado"])
+    try:
+        with transaction.atomic():
+            pedido.estado = "CONFIRMADO"
+            pedido.save(update_fields=["estado"])
+            # Compromete los insumos; si no alcanzan, no se confirma
+            services_reservas.reservar(pedido.id)
+            services_despacho.sincronizar(pedido.id)
+            services_eventos.registrar([pedido.id], services_eventos.ESTADO)
+    except services_reservas.StockInsuficiente as e:
+        messages.error(request, f"No podemos confirmar tu pedido por falta de insumos: {e}.")
+        return redirect("perfil")
     messages.success(request, "Tu pedido ha sido confirmado.")
     return redirect("perfil")
 
@@ -123,8 +133,13 @@ def cancelar_pedido(request, pedido_id):
     from .views_auth import get_cliente_actual
     cliente = get_cliente_actual(request)
     pedido = get_object_or_404(Pedido, id=pedido_id, cliente=cliente, estado="PENDIENTE")
-    pedido.estado = "CANCELADO"
-    pedido.save(update_fields=["estado"])
+    with transaction.atomic():
+        pedido.estado = "CANCELADO"
+        pedido.save(update_fields=["estado"])
+        services_reservas.liberar([pedido.id])
+        services_despacho.sincronizar(pedido.id)
+        services_eventos.registrar([pedido.id], services_eventos.ESTADO)
+    services_checkout.invalidar(pedido.id)
     messages.info(request, "Tu pedido ha sido cancelado.")
     return redirect("perfil")
 
@@ -211,6 +226,7 @@ def insumo_create(request):
     form = InsumoForm(request.POST or None)
     if request.method == "POST" and form.is_valid():
         form.save()
+        services_insumos.catalogo_cambio()
         messages.success(request, "Insumo creado.")
         return redirect("insumos_list")
     return render(request, "accounts/insumo_form.html", {"form": form, "title": "Nuevo insumo"})
@@ -222,7 +238,10 @@ def insumo_update(request, pk):
     obj = get_object_or_404(Insumo, pk=pk)
     form = InsumoForm(request.POST or None, instance=obj)
     if request.method == "POST" and form.is_valid():
-        form.save()
+        # Sólo los campos del form: cantidad_reservada la mantienen las
+        # reservas bajo lock y la copia leída al abrir la vista ya puede ser vieja
+        form.save(commit=False).save(update_fields=[*form._meta.fields, "fecha_actualizacion"])
+        services_insumos.catalogo_cambio()
         messages.success(request, "Insumo actualizado.")
         return redirect("insumos_list")
     return render(request, "accounts/insumo_form.html", {"form": form, "title": f"Editar: {obj.nombre}"})
@@ -235,6 +254,7 @@ def insumo_delete(request, pk):
     if request.method == "POST":
         try:
             obj.delete()
+            services_insumos.catalogo_cambio()
             messages.success(request, "Insumo eliminado.")
         except IntegrityError:
             messages.error(request, "No se puede eliminar: está referenciado en recetas/compras/kardex.")
@@ -14,6 +14,7 @@ from django.utils import timezone
 from .forms import RegistroForm, LoginForm
 from .forms_profile import ProfileForm
 from .models_db import Usuario, Cliente, Pedido, Bitacora
+from .services_pagos import anotar_saldos
 from .utils import log_event
 
 from django.shortcuts import render  # ya lo tienes arriba
@@ -135,10 +136,11 @@ def register_view(request):
 @login_required
 def perfil_view(request):
     cliente = get_cliente_actual(request)
-    pedidos = Pedido.objects.filter(cliente=cliente).order_by("-created_at")
-    gran_total = pedidos.filter(estado="PENDIENTE").aggregate(
+    qs = Pedido.objects.filter(cliente=cliente).order_by("-created_at")
+    gran_total = qs.filter(estado="PENDIENTE").aggregate(
         total=Sum("total")
     )["total"] or Decimal("0.00")
+    pedidos = anotar_saldos(qs, request)
 
     return render(
         request,
@@ -4,10 +4,14 @@ from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.db import connection, transaction
 from django.shortcuts import get_object_or_404, redirect, render
+from django.utils.dateparse import parse_date
 
-from .models_db import Descuento, Pedido, PedidoDescuento
+from .models_db import Descuento, EstadoPedido, Pedido, PedidoDescuento
 from .forms import DescuentoForm
 from .permissions import requiere_permiso
+from .services_descuentos import (
+    NO_EDITABLES, FiltroPedidos, aplicar_lote, invalidar, previsualizar, reglas_activas,
+)
 from .views_pedidos import _recalcular_total
 
 
@@ -34,6 +38,7 @@ def descuento_form(request, descuento_id=None):
         form = DescuentoForm(request.POST, instance=descuento)
         if form.is_valid():
             form.save()
+            invalidar()
             messages.success(request, "Descuento guardado correctamente.")
             return redirect("descuentos_list")
     else:
@@ -51,6 +56,7 @@ def descuento_toggle_activo(request, descuento_id):
     descuento = get_object_or_404(Descuento, pk=descuento_id)
     descuento.activo = not descuento.activo
     descuento.save(update_fields=["activo"])
+    invalidar()
     messages.success(
         request,
         f"Descuento '{descuento.nombre}' ahora está "
@@ -94,7 +100,11 @@ def aplicar_descuento_pedido(request, pedido_id):
             messages.error(request, "Debes seleccionar un descuento.")
             return redirect("aplicar_descuento_pedido", pedido_id=pedido.id)
 
-        descuento = get_object_or_404(Descuento, pk=desc_id)
+        regla = reglas_activas().get(int(desc_id)) if desc_id.isdigit() else None
+        if regla is None:
+            messages.error(request, "El descuento no existe o no está activo.")
+            return redirect("aplicar_descuento_pedido", pedido_id=pedido.id)
+        descuento = get_object_or_404(Descuento, pk=regla.id)
 
         base = _calcular_base_pedido(pedido.id)
 
@@ -102,13 +112,7 @@ def aplicar_descuento_pedido(request, pedido_id):
             messages.error(request, "El pedido no tiene items para aplicar descuento.")
             return redirect("aplicar_descuento_pedido", pedido_id=pedido.id)
 
-        # Calcula monto_aplicado según tipo
-        if descuento.tipo == Descuento.TIPO_FIJO:
-            monto = min(Decimal(descuento.valor), base)
-        else:  # PORCENTAJE
-            monto = (base * Decimal(descuento.valor) / Decimal("100")).quantize(
-                Decimal("0.01")
-            )
+        monto = regla.monto(base)
 
         with transaction.atomic():
             pedido_desc, _ = PedidoDescuento.objects.update_or_create(
@@ -129,3 +133,51 @@ def aplicar_descuento_pedido(request, pedido_id):
         "pedido": pedido,
         "descuentos": descuentos,
     })
+
+
+# ============================
+# Aplicar un descuento a muchos pedidos
+# ============================
+
+def _estados_editables() -> list[tuple[str, str]]:
+    return [(c, n) for c, n in EstadoPedido.choices if c not in NO_EDITABLES]
+
+
+def _filtro_desde_request(data) -> FiltroPedidos:
+    validos = {c for c, _ in _estados_editables()}
+    estados = [e for e in data.getlist("estado") if e in validos] or ["PENDIENTE"]
+    return FiltroPedidos(
+        estados=estados,
+        desde=parse_date(data.get("desde") or "") or None,
+        hasta=parse_date(data.get("hasta") or "") or None,
+    )
+
+
+@login_required
+@requiere_permiso("PEDIDO_WRITE")
+def descuento_lote(request, descuento_id):
+    """
+    Previsualiza (GET) o aplica (POST) un descuento a todos los pedidos
+    que cumplen el filtro: estados + rango de fecha de creación.
+    """
+    regla = reglas_activas().get(descuento_id)
+    if regla is None:
+        messages.error(request, "Sólo se pueden aplicar descuentos activos.")
+        return redirect("descuentos_list")
+
+    data = request.POST if request.method == "POST" else request.GET
+    filtro = _filtro_desde_request(data)
+
+    if request.method == "POST":
+        n = aplicar_lote(regla, filtro)
+        messages.success(request, f"Descuento '{regla.nombre}' aplicado a {n} pedido(s).")
+        return redirect("descuentos_list")
+
+    return render(request, "accounts/descuento_lote.html", {
+        "regla": regla,
+        "filtro": filtro,
+        "estados": _estados_editables(),
+        "desde": data.get("desde") or "",
+        "hasta": data.get("hasta") or "",
+        "preview": previsualizar(regla, filtro),
+    })
@@ -3,8 +3,12 @@ from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.db import connection, transaction
 from django.shortcuts import get_object_or_404, redirect, render
+from django.views.decorators.http import require_POST
 
 from .models_db import Pedido
+from .permissions import requiere_permiso
+from . import services_despacho, services_eventos, services_reservas, services_rutas
+from .services_pagos import anotar_saldos
 
 
 # --- helpers -------------------------------------------------
@@ -31,27 +35,10 @@ def _total_pagado(pid: int):
 
 def _pedidos_listos():
     """
-    Precondición CU24:
-    - pedido.estado IN ('CONFIRMADO')
-    - suma(pago.monto) >= pedido.total
-    - sin registro en envio
+    Precondición CU24 (estado CONFIRMADO, pagado, sin envío), mantenida
+    en dispatch_queue por services_despacho.sincronizar().
     """
-    with connection.cursor() as cur:
-        cur.execute("""
-          SELECT p.id, c.nombre AS cliente, p.metodo_envio, p.direccion_entrega,
-                 p.total, COALESCE(SUM(pg.monto),0) AS pagado
-          FROM pedido p
-          JOIN cliente c ON c.id = p.cliente_id
-          LEFT JOIN pago pg ON pg.pedido_id = p.id
-          LEFT JOIN envio e ON e.pedido_id = p.id
-          WHERE e.id IS NULL
-            AND p.estado IN ('CONFIRMADO')
-          GROUP BY p.id, c.nombre, p.metodo_envio, p.direccion_entrega, p.total
-          HAVING pagado >= p.total
-          ORDER BY p.id DESC
-        """)
-        cols = [c[0] for c in cur.description]
-        return [dict(zip(cols, r)) for r in cur.fetchall()]
+    return services_despacho.pedidos_listos()
 
 
 # --- vistas --------------------------------------------------
@@ -61,7 +48,8 @@ def envio_list(request):
     """
     Lista de pedidos listos para gestionar envío.
     """
-    rows = _pedidos_listos()
+    # Sólo filas de la cola; el pagado se anota para esas, no para el histórico
+    rows = anotar_saldos(_pedidos_listos(), request)
     return render(request, "accounts/envio_list.html", {"rows": rows})
 
 
@@ -105,7 +93,9 @@ def envio_crear_editar(request, pedido_id: int):
                       INSERT INTO envio (pedido_id, estado, nombre_repartidor, telefono_repartidor)
                       VALUES (%s, 'PENDIENTE', %s, %s)
                     """, [pedido.id, nombre, fono])
+                    services_despacho.sincronizar(pedido.id)
                     messages.success(request, "Envío registrado correctamente.")
+            services_eventos.registrar([pedido.id], services_eventos.ENVIO)
         return redirect("envio_crear_editar", pedido_id=pedido.id)
 
     return render(request, "accounts/envio_form.html", {
@@ -132,6 +122,68 @@ def envio_marcar_entregado(request, pedido_id: int):
         with connection.cursor() as cur:
             cur.execute("UPDATE envio SET estado='ENTREGADO' WHERE pedido_id=%s", [pedido.id])
             cur.execute("UPDATE pedido SET estado='ENTREGADO' WHERE id=%s", [pedido.id])
+        services_reservas.liberar([pedido.id])
+        services_despacho.sincronizar(pedido.id)
+        services_eventos.registrar([pedido.id], services_eventos.ENVIO)
 
     messages.success(request, "El pedido fue marcado como ENTREGADO.")
     return redirect("envio_crear_editar", pedido_id=pedido.id)
+
+
+# --- rutas de despacho ----------------------------------------
+
+@login_required
+@requiere_permiso("PEDIDO_READ")
+def despacho_rutas(request):
+    """Pedidos DELIVERY listos agrupados por zona + rutas abiertas."""
+    return render(request, "accounts/despacho_rutas.html", {
+        "grupos": services_rutas.planificar(),
+        "abiertas": services_rutas.rutas_abiertas(),
+    })
+
+
+@login_required
+@requiere_permiso("PEDIDO_WRITE")
+@require_POST
+def despacho_asignar(request):
+    """Asigna un repartidor a todas las paradas marcadas de una zona."""
+    nombre = (request.POST.get("nombre_repartidor") or "").strip()
+    fono = (request.POST.get("telefono_repartidor") or "").strip()
+    zona_id = request.POST.get("zona_id") or None
+    ids = [i for i in request.POST.getlist("pedido_id") if i.isdigit()]
+
+    if not nombre:
+        messages.error(request, "Debes indicar el repartidor de la ruta.")
+        return redirect("despacho_rutas")
+    if not ids:
+        messages.error(request, "Selecciona al menos un pedido.")
+        return redirect("despacho_rutas")
+
+    ruta_id, asignados = services_rutas.asignar_ruta(
+        ids, nombre, fono, int(zona_id) if zona_id and zona_id.isdigit() else None)
+    if not asignados:
+        messages.warning(request, "Los pedidos seleccionados ya no están pendientes de envío.")
+        return redirect("despacho_rutas")
+    omitidos = len(ids) - len(asignados)
+    messages.success(request, f"Ruta #{ruta_id}: {len(asignados)} parada(s) para {nombre}."
+                     + (f" {omitidos} pedido(s) ya estaban asignados." if omitidos else ""))
+    return redirect("despacho_ruta_detalle", ruta_id=ruta_id)
+
+
+@login_required
+@requiere_permiso("PEDIDO_READ")
+def despacho_ruta_detalle(request, ruta_id: int):
+    return render(request, "accounts/despacho_ruta_detalle.html", {
+        "ruta_id": ruta_id,
+        "paradas": services_rutas.paradas_de_ruta(ruta_id),
+    })
+
+
+@login_required
+@requiere_permiso("PEDIDO_WRITE")
+@require_POST
+def despacho_cerrar(request, ruta_id: int):
+    """Cierra la ruta: todos sus envíos y pedidos quedan ENTREGADO."""
+    n = services_rutas.cerrar_ruta(ruta_id)
+    messages.success(request, f"Ruta #{ruta_id} cerrada: {n} pedido(s) entregados.")
+    return redirect("despacho_rutas")
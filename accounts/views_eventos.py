@@ -0,0 +1,104 @@
+# accounts/views_eventos.py
+"""
+Stream SSE de cambios de pedidos (servido por la app ASGI: core/asgi.py).
+
+GET /eventos/pedidos/            -> staff: todos; cliente: sus pedidos
+GET /eventos/pedidos/?pedido=ID  -> sólo ese pedido
+Soporta Last-Event-ID para reponer lo perdido durante una reconexión.
+"""
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.decorators import login_required
+from django.db import close_old_connections
+from django.http import HttpResponseForbidden, StreamingHttpResponse
+
+from . import services_eventos
+from .models_db import Cliente, Pedido
+
+LATIDO_S = 15
+REPOSICION_MAX = 200
+
+
+def _cliente_id(email: str) -> int | None:
+    try:
+        return (Cliente.objects.filter(usuario__email=(email or "").lower())
+                .values_list("id", flat=True).first())
+    finally:
+        close_old_connections()
+
+
+def _cliente_de_pedido(pedido_id: int) -> int | None:
+    try:
+        return Pedido.objects.filter(pk=pedido_id).values_list("cliente_id", flat=True).first()
+    finally:
+        close_old_connections()
+
+
+def _reponer(ultimo_id: int, filtro) -> list[dict]:
+    try:
+        return [ev for ev in services_eventos.eventos_desde(ultimo_id, limite=REPOSICION_MAX) if filtro(ev)]
+    finally:
+        close_old_connections()
+
+
+def _sse(ev: dict) -> str:
+    datos = {k: v for k, v in ev.items() if k != "cliente_id"}
+    return f"id: {ev['id']}\nevent: pedido\ndata: {json.dumps(datos)}\n\n"
+
+
+async def _stream(filtro, ultimo_id: int | None):
+    sub = services_eventos.suscribir(filtro)
+    try:
+        yield "retry: 3000\n\n"
+        # Primero suscribirse y después reponer: no se pierde nada entre medio
+        vistos = 0
+        if ultimo_id:
+            for ev in await sync_to_async(_reponer, thread_sensitive=False)(ultimo_id, filtro):
+                vistos = max(vistos, ev["id"])
+                yield _sse(ev)
+        while True:
+            if sub.desbordada:
+                yield "event: recargar\ndata: {}\n\n"
+                return
+            try:
+                ev = await asyncio.wait_for(sub.cola.get(), timeout=LATIDO_S)
+            except asyncio.TimeoutError:
+                yield ": latido\n\n"
+                continue
+            if ev["id"] > vistos:
+                yield _sse(ev)
+    finally:
+        services_eventos.desuscribir(sub)
+
+
+@login_required
+async def eventos_pedidos(request):
+    user = await request.auser()
+    es_staff = user.is_staff or user.is_superuser
+
+    pedido_id = request.GET.get("pedido")
+    pedido_id = int(pedido_id) if pedido_id and pedido_id.isdigit() else None
+
+    cliente_id = None
+    if not es_staff:
+        cliente_id = await sync_to_async(_cliente_id, thread_sensitive=False)(user.email)
+        if cliente_id is None:
+            return HttpResponseForbidden("Sin cliente asociado.")
+        if pedido_id is not None:
+            duenio = await sync_to_async(_cliente_de_pedido, thread_sensitive=False)(pedido_id)
+            if duenio != cliente_id:
+                return HttpResponseForbidden("No tienes acceso a este pedido.")
+
+    def filtro(ev):
+        return ((pedido_id is None or ev["pedido_id"] == pedido_id)
+                and (cliente_id is None or ev["cliente_id"] == cliente_id))
+
+    ultimo = request.headers.get("Last-Event-ID") or request.GET.get("ultimo") or ""
+    ultimo = int(ultimo) if ultimo.isdigit() else None
+
+    resp = StreamingHttpResponse(_stream(filtro, ultimo), content_type="text/event-stream")
+    resp["Cache-Control"] = "no-cache"
+    resp["X-Accel-Buffering"] = "no"  # nginx: no bufferizar el stream
+    return resp
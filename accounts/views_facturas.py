@@ -1,11 +1,21 @@
 # accounts/views_facturas.py
+import re
+from datetime import timedelta
 from decimal import Decimal
+
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.db import connection, transaction
+from django.core.exceptions import PermissionDenied
+from django.db import IntegrityError, connection, transaction
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified
 from django.shortcuts import get_object_or_404, redirect, render
+from django.utils.dateparse import parse_date, parse_datetime
 
 from .models_db import Pedido, Pago, Factura
+from .permissions import tiene_permiso
+from .services_facturas import emitir_pendientes, encolar_pdf, items_pedido, pdf_de_factura
+from .services_numeracion import formatear, numero_factura, serie_por_defecto
+from .services_pagos import anotar_saldos
 
 def _total_pagado(pedido_id: int) -> Decimal:
     with connection.cursor() as cur:
@@ -43,24 +53,27 @@ def factura_emitir(request, pedido_id: int):
             messages.error(request, "Debes ingresar la Razón social / Nombre.")
             return redirect("factura_emitir", pedido_id=pedido.id)
 
-        # Nro de factura: seguimos tu patrón existente "F-<pedido_id>"
-        nro = f"F-{pedido.id}"
-
-        with transaction.atomic():
-            # defensa por si dos clicks rápidos
-            if Factura.objects.filter(pedido_id=pedido.id).exists():
-                messages.info(request, "Este pedido ya tiene factura emitida.")
-                return redirect("factura_detalle", pedido_id=pedido.id)
-
-            # Insert a tabla legada (puedes usar ORM también; dejo SQL explícito como en pagos)
-            with connection.cursor() as cur:
-                cur.execute(
-                    """
-                    INSERT INTO factura (pedido_id, nro, fecha, nit_cliente, razon_social, total)
-                    VALUES (%s, %s, NOW(), %s, %s, %s)
-                    """,
-                    [pedido.id, nro, nit, razon, str(pedido.total or 0)],
-                )
+        # Nro fiscal: siguiente número de la serie, tomado junto con la
+        # transacción de la factura (si no confirma, el número se devuelve)
+        try:
+            with numero_factura() as (serie, numero):
+                nro = formatear(serie, numero)
+                # factura.pedido_id es único: dos clicks rápidos terminan en IntegrityError
+                with connection.cursor() as cur:
+                    cur.execute(
+                        """
+                        INSERT INTO factura (pedido_id, serie, numero, nro, fecha,
+                                             nit_cliente, razon_social, total)
+                        VALUES (%s, %s, %s, %s, NOW(), %s, %s, %s)
+                        """,
+                        [pedido.id, serie, numero, nro, nit, razon, str(pedido.total or 0)],
+                    )
+                    factura_id = cur.lastrowid
+                # El PDF se genera en segundo plano, recién cuando la factura existe
+                transaction.on_commit(lambda: encolar_pdf(factura_id))
+        except IntegrityError:
+            messages.info(request, "Este pedido ya tiene factura emitida.")
+            return redirect("factura_detalle", pedido_id=pedido.id)
 
         messages.success(request, f"Factura {nro} generada correctamente.")
         return redirect("factura_detalle", pedido_id=pedido.id)
@@ -72,64 +85,143 @@ def factura_emitir(request, pedido_id: int):
     })
 
 
+@login_required
+def factura_emitir_lote(request):
+    """Factura de una vez todos los pedidos pagados que aún no tienen factura."""
+    if not (request.user.is_staff or request.user.is_superuser):
+        raise PermissionDenied("No tienes permiso.")
+    if request.method != "POST":
+        return redirect("factura_list")
+
+    ids = emitir_pendientes()
+    if ids:
+        messages.success(request, f"Se emitieron {len(ids)} factura(s).")
+    else:
+        messages.info(request, "No hay pedidos pagados pendientes de factura.")
+    return redirect("factura_list")
+
+
+def _puede_ver_factura(request, pedido) -> bool:
+    """El cliente dueño del pedido o personal con PEDIDO_WRITE (PEDIDO_READ lo tienen los clientes)."""
+    user = request.user
+    if user.is_staff or user.is_superuser or tiene_permiso(user, "PEDIDO_WRITE"):
+        return True
+    usuario = pedido.cliente.usuario if pedido.cliente_id else None
+    email = (getattr(usuario, "email", "") or "").lower()
+    return bool(email) and email == (user.email or "").lower()
+
+
 @login_required
 def factura_detalle(request, pedido_id: int):
-    pedido = get_object_or_404(Pedido, pk=pedido_id)
+    pedido = get_object_or_404(Pedido.objects.select_related("cliente__usuario"), pk=pedido_id)
+    if not _puede_ver_factura(request, pedido):
+        raise PermissionDenied("No tienes acceso a esta factura.")
     factura = get_object_or_404(Factura, pedido_id=pedido.id)
-    items = _items_pedido(pedido.id)      # <--- NUEVO
+    items = items_pedido(pedido.id)
     return render(request, "accounts/factura_detalle.html", {
         "pedido": pedido,
         "factura": factura,
-        "items": items,                   # <--- NUEVO
+        "items": items,
     })
 
 
+@login_required
+def factura_pdf(request, pedido_id: int):
+    """
+    Sirve el PDF ya generado (ETag fuerte = sha256 del contenido).
+    Si todavía no está, lo encola y responde 202: nunca se renderiza aquí.
+    """
+    pedido = get_object_or_404(Pedido.objects.select_related("cliente__usuario"), pk=pedido_id)
+    if not _puede_ver_factura(request, pedido):
+        raise PermissionDenied("No tienes acceso a esta factura.")
+    factura = get_object_or_404(Factura, pedido_id=pedido.id)
+    guardado = pdf_de_factura(factura.id)
+    if guardado is None:
+        encolar_pdf(factura.id)
+        resp = HttpResponse("El PDF de la factura se está generando, reintenta en unos segundos.",
+                            status=202, content_type="text/plain; charset=utf-8")
+        resp["Retry-After"] = "2"
+        return resp
 
-# ---- agrega al inicio del archivo (import ya existente) ----
-from django.db import connection
+    sha, path = guardado
+    etag = f'"{sha}"'
+    inm = request.headers.get("If-None-Match", "")
+    if etag in [t.strip() for t in inm.split(",")]:
+        resp = HttpResponseNotModified()
+    else:
+        resp = FileResponse(open(path, "rb"), content_type="application/pdf",
+                            filename=f"{factura.nro}.pdf")
+    resp["ETag"] = etag
+    resp["Cache-Control"] = "private, no-cache"
+    return resp
+
+
+FACTURAS_POR_PAGINA = 50
+_RE_NRO = re.compile(r"^[A-Za-z]{1,10}-\d*$")
 
-# ---- agrega debajo de _total_pagado() ----
-def _items_pedido(pedido_id: int):
-    """Devuelve el detalle del pedido para imprimir en factura."""
-    with connection.cursor() as cur:
-        cur.execute("""
-            SELECT pr.nombre AS producto,
-                   s.nombre  AS sabor,
-                   dp.cantidad,
-                   dp.precio_unitario,
-                   dp.sub_total
-            FROM detalle_pedido dp
-            JOIN producto pr ON pr.id = dp.producto_id
-            JOIN sabor    s  ON s.id = dp.sabor_id
-            WHERE dp.pedido_id = %s
-            ORDER BY pr.nombre, s.nombre
-        """, [pedido_id])
-        cols = [c[0] for c in cur.description]
-        return [dict(zip(cols, row)) for row in cur.fetchall()]
 
+def _prefijo_like(q: str) -> str:
+    """'abc' -> 'abc%' escapando comodines: LIKE por prefijo usa el índice."""
+    return q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def _filtro_texto(q: str):
+    """
+    Elige un camino indexable según la forma de `q`:
+    email -> prefijo sobre usuario.email; "F-12" -> prefijo sobre factura.nro;
+    "12" -> nro exacto en la serie por defecto; resto -> FULLTEXT (ngram) sobre cliente.nombre.
+    """
+    if "@" in q:
+        return "u.email LIKE %s", [_prefijo_like(q)]
+    if _RE_NRO.match(q):
+        return "f.nro LIKE %s", [_prefijo_like(q.upper())]
+    if q.isdigit():  # número suelto: factura exacta de la serie por defecto
+        return "f.nro = %s", [formatear(serie_por_defecto(), int(q))]
+    if len(q) < 2:  # más corto que un n-grama
+        return "c.nombre LIKE %s", [_prefijo_like(q)]
+    frase = '"' + q.replace('"', " ") + '"'
+    return "MATCH(c.nombre) AGAINST (%s IN BOOLEAN MODE)", [frase]
+
+
+def _leer_cursor(valor: str):
+    """'<fecha ISO>|<id>' -> (datetime, id) o None."""
+    try:
+        fecha, fid = valor.rsplit("|", 1)
+        dt = parse_datetime(fecha)
+        return (dt, int(fid)) if dt else None
+    except (ValueError, AttributeError):
+        return None
 
-from datetime import datetime
 
 @login_required
 def factura_list(request):
     q      = (request.GET.get("q") or "").strip()           # nro, nombre o email
     desde  = (request.GET.get("desde") or "").strip()
     hasta  = (request.GET.get("hasta") or "").strip()
+    cursor = _leer_cursor(request.GET.get("antes") or "")
 
     where  = ["1=1"]
     params = []
 
     if q:
-        where.append("(f.nro LIKE %s OR u.email LIKE %s OR c.nombre LIKE %s)")
-        like = f"%{q}%"
-        params += [like, like, like]
-
-    if desde:
-        where.append("DATE(f.fecha) >= %s")
-        params.append(desde)
-    if hasta:
-        where.append("DATE(f.fecha) <= %s")
-        params.append(hasta)
+        cond, p = _filtro_texto(q)
+        where.append(cond)
+        params += p
+
+    # Rangos semiabiertos sobre la columna (sin DATE()): usan ix_factura_fecha_id
+    d = parse_date(desde) if desde else None
+    if d:
+        where.append("f.fecha >= %s")
+        params.append(d)
+    h = parse_date(hasta) if hasta else None
+    if h:
+        where.append("f.fecha < %s")
+        params.append(h + timedelta(days=1))
+
+    # Keyset: sigue después de la última fila de la página anterior
+    if cursor:
+        where.append("(f.fecha < %s OR (f.fecha = %s AND f.id < %s))")
+        params += [cursor[0], cursor[0], cursor[1]]
 
     sql = f"""
       SELECT f.id, f.nro, f.fecha, f.total,
@@ -141,14 +233,23 @@ def factura_list(request):
       JOIN usuario u ON u.id = c.usuario_id
       WHERE {' AND '.join(where)}
       ORDER BY f.fecha DESC, f.id DESC
-      LIMIT 500
+      LIMIT %s
     """
     with connection.cursor() as cur:
-        cur.execute(sql, params)
+        cur.execute(sql, params + [FACTURAS_POR_PAGINA + 1])
         cols = [c[0] for c in cur.description]
         rows = [dict(zip(cols, r)) for r in cur.fetchall()]
 
+    siguiente = None
+    if len(rows) > FACTURAS_POR_PAGINA:
+        rows = rows[:FACTURAS_POR_PAGINA]
+        ult = rows[-1]
+        siguiente = f"{ult['fecha'].isoformat()}|{ult['id']}"
+    anotar_saldos(rows, request, id_attr="pedido_id")
+
     return render(request, "accounts/factura_list.html", {
         "rows": rows,
         "q": q, "desde": desde, "hasta": hasta,
+        "siguiente": siguiente,
+        "paginado": cursor is not None,
     })
@@ -1,16 +1,21 @@
 # accounts/views_inventario.py
-from decimal import Decimal
+import json
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.core.paginator import Paginator
+from django.core.handlers.asgi import ASGIRequest
 from django.db import transaction
-from django.db.models import F
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
-from django.utils import timezone
+from django.views.decorators.http import require_POST
 
+from . import services_conteo, services_insumos, services_kardex
 from .permissions import requiere_permiso
 from .models_db import Insumo, Kardex
-from .forms_inventario import MovimientoInventarioForm
+from .forms_inventario import (
+    ConteoInventarioForm, MovimientoInventarioForm, MovimientoLoteForm, MovimientoLoteFormSet,
+)
 
 @login_required
 @requiere_permiso("INVENTARIO_WRITE")
@@ -22,36 +27,23 @@ def movimiento_crear(request):
         motivo = form.cleaned_data["motivo"]
         cantidad = Decimal(form.cleaned_data["cantidad"])
         observacion = (form.cleaned_data.get("observacion") or "").strip()
-        fecha = form.get_fecha()
+        # Sin fecha: ahora (sin validar orden contra el resto del kardex)
+        fecha = form.cleaned_data["fecha"]
 
-        with transaction.atomic():
-            obj = Insumo.objects.select_for_update().get(pk=insumo.pk)
-
-            if tipo == "ENTRADA":
-                Insumo.objects.filter(pk=obj.pk).update(
-                    cantidad_disponible=F("cantidad_disponible") + cantidad
-                )
-            elif tipo == "SALIDA":
+        try:
+            with transaction.atomic():
+                obj = Insumo.objects.select_for_update().get(pk=insumo.pk)
                 # si quieres permitir negativo, elimina este if:
-                if obj.cantidad_disponible - cantidad < 0:
+                if tipo == "SALIDA" and obj.cantidad_disponible - cantidad < 0:
                     messages.error(request, "Stock insuficiente.")
                     return render(request, "accounts/movimiento_form.html", {"form": form})
-                Insumo.objects.filter(pk=obj.pk).update(
-                    cantidad_disponible=F("cantidad_disponible") - cantidad
-                )
-            else:  # AJUSTE: la cantidad es delta (+/-)
-                Insumo.objects.filter(pk=obj.pk).update(
-                    cantidad_disponible=F("cantidad_disponible") + cantidad
+                # AJUSTE: la cantidad es delta (+/-)
+                services_kardex.registrar_movimiento(
+                    obj.pk, tipo, motivo, cantidad, observacion, fecha=fecha
                 )
-
-            Kardex.objects.create(
-                insumo=obj,
-                fecha=fecha,
-                tipo=tipo,
-                motivo=motivo,
-                cantidad=cantidad,
-                observacion=observacion[:200] or None,
-            )
+        except services_kardex.FechaFueraDeOrden as e:
+            messages.error(request, f"Fecha inválida: {e}.")
+            return render(request, "accounts/movimiento_form.html", {"form": form})
 
         messages.success(request, "Movimiento registrado.")
         return redirect("kardex_list")
@@ -59,30 +51,171 @@ def movimiento_crear(request):
     return render(request, "accounts/movimiento_form.html", {"form": form})
 
 
+@login_required
+@requiere_permiso("INVENTARIO_WRITE")
+def movimiento_lote(request):
+    """Varios movimientos en una sola transacción (conteos, recepciones grandes)."""
+    insumos = services_insumos.catalogo()
+    try:
+        filas = min(max(int(request.GET.get("filas", 10)), 1), 500)
+    except ValueError:
+        filas = 10
+    form = MovimientoLoteForm(request.POST or None)
+    formset = MovimientoLoteFormSet(
+        request.POST or None, form_kwargs={"insumos": insumos},
+        initial=[{"tipo": "AJUSTE", "motivo": "AJUSTE"}] * filas,
+    )
+    resultados = None
+    if request.method == "POST" and form.is_valid() and formset.is_valid():
+        movs = [f.fila() for f in formset]
+        indices = [i for i, m in enumerate(movs, start=1) if m]
+        movs = [m for m in movs if m]
+        if not movs:
+            messages.error(request, "No hay filas con insumo y cantidad.")
+        else:
+            resultados = services_kardex.registrar_movimientos(
+                movs,
+                fecha=form.cleaned_data.get("fecha"),
+                todo_o_nada=form.cleaned_data.get("todo_o_nada"),
+            )
+            nombres = dict(insumos)
+            for r, i in zip(resultados, indices):
+                r["fila"], r["insumo"] = i, nombres.get(r["insumo_id"], r["insumo_id"])
+            ok = sum(1 for r in resultados if r["ok"])
+            if ok:
+                messages.success(request, f"{ok} movimiento(s) registrados.")
+            if ok < len(resultados):
+                messages.error(request, f"{len(resultados) - ok} fila(s) no se aplicaron.")
+    return render(request, "accounts/movimiento_lote.html", {
+        "form": form, "formset": formset, "resultados": resultados, "filas": filas,
+    })
+
+
+@login_required
+@requiere_permiso("INVENTARIO_WRITE")
+def conteo_inventario(request):
+    """Sube el conteo físico, muestra diferencias y, al aprobar, escribe los AJUSTE."""
+    if request.method == "POST" and request.POST.get("accion") == "aplicar":
+        try:
+            # {insumo_id: [contado, stock mostrado en la vista previa]}
+            conteo = json.loads(request.POST.get("conteo") or "{}")
+            fecha = request.POST.get("fecha") or None
+            resultados = services_conteo.aplicar(
+                {iid: c for iid, (c, _p) in conteo.items()},
+                {iid: p for iid, (_c, p) in conteo.items()},
+                fecha=fecha and datetime.fromisoformat(fecha))
+        except (ValueError, TypeError, InvalidOperation):
+            messages.error(request, "Conteo inválido; vuelve a subir el archivo.")
+            return redirect("conteo_inventario")
+        fallidas = [r for r in resultados if not r["ok"]]
+        if fallidas:
+            messages.error(request, "No se aplicó el conteo: " + ", ".join(
+                f"insumo {r['insumo_id']}: {r['error']}" for r in fallidas if r["error"]))
+        elif resultados:
+            messages.success(request, f"Conteo aplicado: {len(resultados)} ajuste(s).")
+        else:
+            messages.info(request, "El conteo coincide con el stock; no hubo ajustes.")
+        return redirect("kardex_list")
+
+    form = ConteoInventarioForm(request.POST or None, request.FILES or None)
+    ctx = {"form": form}
+    if request.method == "POST" and form.is_valid():
+        conteo = services_conteo.leer_conteo(form.cleaned_data["archivo"])
+        filas = services_conteo.comparar(conteo.contados)
+        fecha = form.cleaned_data.get("fecha")
+        ctx.update({
+            "errores": conteo.errores,
+            "diferencias": [f for f in filas if f["diferencia"]],
+            "sin_diferencia": sum(1 for f in filas if not f["diferencia"]),
+            "conteo_json": json.dumps({str(f["insumo_id"]): [str(f["contado"]), str(f["disponible"])]
+                                       for f in filas}),
+            "fecha": fecha.isoformat() if fecha else "",
+        })
+    return render(request, "accounts/conteo_inventario.html", ctx)
+
+
+def _entero(valor) -> int | None:
+    return int(valor) if (valor or "").isdigit() else None
+
+
 @login_required
 @requiere_permiso("INVENTARIO_READ")
 def kardex_list(request):
-    qs = Kardex.objects.select_related("insumo").order_by("-fecha", "-id")
-    insumo_id = request.GET.get("insumo")
-    if insumo_id:
-        qs = qs.filter(insumo_id=insumo_id)
-    page = Paginator(qs, 20).get_page(request.GET.get("page"))
-    insumos = Insumo.objects.all().order_by("nombre")
+    insumo_id = _entero(request.GET.get("insumo"))
+    movimientos, siguiente = services_kardex.pagina(insumo_id, _entero(request.GET.get("antes")))
+    insumos = services_insumos.catalogo()
+    nombres = dict(insumos)
+    for m in movimientos:
+        m.insumo_nombre = nombres.get(m.insumo_id, m.insumo_id)
     return render(
         request, "accounts/kardex_list.html",
-        {"page": page, "insumos": insumos, "insumo_id": insumo_id}
+        {"movimientos": movimientos, "siguiente": siguiente, "insumos": insumos,
+         "insumo_id": insumo_id, "desde_inicio": bool(request.GET.get("antes"))}
+    )
+
+
+def _fecha(valor) -> date | None:
+    try:
+        return date.fromisoformat(valor or "")
+    except ValueError:
+        return None
+
+
+def _stream_export(request, avanzar: bool = False):
+    datos = request.POST if avanzar else request.GET
+    comprimir = datos.get("gzip") == "1"
+    incremental = avanzar or datos.get("incremental") == "1"
+    nombre = "kardex_incremental" if incremental else "kardex"
+    filtros = dict(
+        desde=_fecha(datos.get("d1")), hasta=_fecha(datos.get("d2")),
+        insumo_id=_entero(datos.get("insumo")),
+        incremental=incremental, avanzar=avanzar, comprimir=comprimir,
+    )
+    # Cada servidor recibe el iterador que sabe transmitir sin acumular:
+    # ASGI uno asíncrono, WSGI el generador síncrono.
+    if isinstance(request, ASGIRequest):
+        contenido = services_kardex.exportar_async(**filtros)
+    else:
+        contenido = services_kardex.exportar(**filtros)
+    resp = StreamingHttpResponse(
+        contenido,
+        content_type="application/gzip" if comprimir else "text/csv; charset=utf-8",
     )
+    resp["Content-Disposition"] = f'attachment; filename="{nombre}.csv{".gz" if comprimir else ""}"'
+    resp["X-Accel-Buffering"] = "no"  # nginx: no bufferizar el stream
+    return resp
+
+
+@login_required
+@requiere_permiso("INVENTARIO_READ")
+def kardex_export(request):
+    """
+    CSV del kardex para contabilidad (?d1, ?d2, ?insumo, ?gzip=1, ?incremental=1).
+    Con incremental es una vista previa de lo pendiente: no mueve el cursor.
+    """
+    return _stream_export(request)
+
+
+@login_required
+@requiere_permiso("INVENTARIO_WRITE")
+@require_POST
+def kardex_export_incremental(request):
+    """Exporta lo pendiente y, si la descarga termina, lo marca como exportado (gzip=1 opcional)."""
+    return _stream_export(request, avanzar=True)
 
 
 @login_required
 @requiere_permiso("INVENTARIO_READ")
 def kardex_por_insumo(request, pk: int):
     insumo = get_object_or_404(Insumo, pk=pk)
-    page = Paginator(
-        Kardex.objects.filter(insumo=insumo).order_by("-fecha", "-id"),
-        20
-    ).get_page(request.GET.get("page"))
+    # Deriva: el saldo del último movimiento debería ser el stock actual
+    ultimo = (Kardex.objects.filter(insumo=insumo).order_by("-id")
+              .values_list("saldo_resultante", flat=True).first())
+    deriva = ultimo if ultimo is not None and ultimo != insumo.cantidad_disponible else None
+    movimientos, siguiente = services_kardex.pagina(insumo.pk, _entero(request.GET.get("antes")))
     return render(
         request, "accounts/kardex_por_insumo.html",
-        {"insumo": insumo, "page": page}
+        {"insumo": insumo, "movimientos": movimientos, "siguiente": siguiente, "deriva": deriva,
+         "desde_inicio": bool(request.GET.get("antes")),
+         "atp": insumo.cantidad_disponible - insumo.cantidad_reservada}
     )
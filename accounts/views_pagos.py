@@ -1,15 +1,21 @@
 # accounts/views_pagos.py
+import logging
 from decimal import Decimal, ROUND_HALF_UP
 import stripe
 
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.db import connection
+from django.db import IntegrityError, connection, transaction
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
 
 from .models_db import Pedido
+from . import services_checkout, services_despacho, services_eventos
+from .stripe_service import get_client
+from .utils import ER_DUP_ENTRY
+
+logger = logging.getLogger(__name__)
 
 
 # -----------------------
@@ -23,7 +29,7 @@ def _total_pagado(pedido_id: int) -> Decimal:
 
 
 def _existe_referencia(ref: str) -> bool:
-    """Evita duplicados por session_id."""
+    """Atajo por índice único (ux_pago_referencia) para no volver a consultar Stripe."""
     if not ref:
         return False
     with connection.cursor() as cur:
@@ -31,6 +37,33 @@ def _existe_referencia(ref: str) -> bool:
         return cur.fetchone() is not None
 
 
+def _insertar_pago_idempotente(pedido_id: int, metodo: str, monto, referencia: str,
+                               registrador_id: int | None) -> bool:
+    """
+    Inserta el pago en una sola sentencia. El índice único sobre
+    `pago.referencia` hace que una confirmación repetida o concurrente
+    con el mismo session_id no inserte nada.
+    Devuelve True si la fila se insertó y False si la referencia ya
+    existía; cualquier otro error (FK, truncado en modo estricto) se
+    propaga.
+    """
+    with transaction.atomic():
+        try:
+            # Savepoint: un duplicado no invalida la transacción de quien llama
+            with transaction.atomic(), connection.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO pago (pedido_id, metodo, monto, referencia, registrado_por_id, created_at)
+                    VALUES (%s, %s, %s, %s, %s, NOW())
+                """, [pedido_id, metodo, monto, referencia, registrador_id])
+        except IntegrityError as e:
+            if (e.args[0] if e.args else None) != ER_DUP_ENTRY:
+                raise
+            return False
+        services_despacho.sincronizar(pedido_id)
+        services_eventos.registrar([pedido_id], services_eventos.PAGO)
+    return True
+
+
 def _usuario_id_por_email(email: str) -> int | None:
     """Retorna id en tabla 'usuario' a partir del email."""
     if not email:
@@ -71,8 +104,6 @@ def _es_duenio_del_pedido(request, pedido: Pedido) -> bool:
 # -----------------------
 @login_required
 def crear_checkout_session(request, pedido_id: int):
-    stripe.api_key = settings.STRIPE_SECRET_KEY
-
     # Trae el pedido y valida propiedad por email
     pedido = get_object_or_404(
         Pedido.objects.select_related("cliente__usuario"),
@@ -97,11 +128,19 @@ def crear_checkout_session(request, pedido_id: int):
     success_url = f"{domain}{reverse('pago_exitoso', args=[pedido.id])}?session_id={{CHECKOUT_SESSION_ID}}"
     cancel_url  = f"{domain}{reverse('pago_cancelado', args=[pedido.id])}"
 
+    # ¿Ya hay una sesión abierta para este mismo saldo? Redirigir sin llamar a Stripe.
+    url_cacheada = services_checkout.obtener_url(pedido.id, cents)
+    if url_cacheada:
+        return redirect(url_cacheada, code=303)
+
+    # Mismo pedido + mismo saldo + mismo usuario => misma sesión (reintentos y dobles clics)
+    idem_key = f"checkout-{pedido.id}-{cents}-{request.user.pk}"
+
     try:
-        session = stripe.checkout.Session.create(
-            mode="payment",
-            payment_method_types=["card"],
-            line_items=[{
+        session = get_client().v1.checkout.sessions.create(params={
+            "mode": "payment",
+            "payment_method_types": ["card"],
+            "line_items": [{
                 "price_data": {
                     "currency": currency,
                     "product_data": {"name": f"Pedido #{pedido.id}"},
@@ -109,37 +148,37 @@ def crear_checkout_session(request, pedido_id: int):
                 },
                 "quantity": 1,
             }],
-            success_url=success_url,
-            cancel_url=cancel_url,
-            metadata={
+            "success_url": success_url,
+            "cancel_url": cancel_url,
+            "metadata": {
                 "pedido_id": str(pedido.id),
                 "user_email": getattr(request.user, "email", "") or "",
                 "saldo": str(saldo),
-            }
-        )
-    except stripe.error.StripeError as e:
+            },
+        }, options={"idempotency_key": idem_key})
+    except stripe.StripeError as e:
         messages.error(request, f"Error creando sesión de Stripe: {getattr(e, 'user_message', str(e))}")
         return redirect("pedido_detalle", pedido_id=pedido.id)
 
+    services_checkout.guardar(pedido.id, cents, session.id, session.url, session.expires_at)
     return redirect(session.url, code=303)
 
 
 @login_required
 def pago_exitoso(request, pedido_id: int):
-    stripe.api_key = settings.STRIPE_SECRET_KEY
     session_id = request.GET.get("session_id")
     if not session_id:
         messages.warning(request, "No se encontró la sesión de pago.")
         return redirect("pedido_detalle", pedido_id=pedido_id)
 
-    # Idempotencia
+    # Idempotencia (atajo; la garantía la da el índice único de abajo)
     if _existe_referencia(session_id):
         messages.success(request, "Pago ya registrado anteriormente.")
         return redirect("pedido_detalle", pedido_id=pedido_id)
 
     try:
-        session = stripe.checkout.Session.retrieve(session_id)
-    except stripe.error.StripeError as e:
+        session = get_client().v1.checkout.sessions.retrieve(session_id)
+    except stripe.StripeError as e:
         messages.warning(request, f"No se pudo validar la sesión de pago: {getattr(e, 'user_message', str(e))}")
         return redirect("pedido_detalle", pedido_id=pedido_id)
 
@@ -164,20 +203,18 @@ def pago_exitoso(request, pedido_id: int):
         registrador_id = _usuario_id_dueno_pedido(pedido_id)
 
     try:
-        with connection.cursor() as cur:
-            cur.execute("""
-                INSERT INTO pago (pedido_id, metodo, monto, referencia, registrado_por_id, created_at)
-                VALUES (%s, %s, %s, %s, %s, NOW())
-            """, [pedido_id, "TRANSFERENCIA", float(amount_paid), session_id, registrador_id])
-        messages.success(request, "Pago registrado correctamente (Stripe).")
-    except Exception as e:
-        print("Error insertando pago:", e)
-        import traceback
-        traceback.print_exc()
-        messages.success(
+        if _insertar_pago_idempotente(pedido_id, "TRANSFERENCIA", str(amount_paid),
+                                      session_id, registrador_id):
+            services_checkout.invalidar(pedido_id)
+            messages.success(request, "Pago registrado correctamente (Stripe).")
+        else:
+            messages.success(request, "Pago ya registrado anteriormente.")
+    except Exception:
+        logger.exception("pago: no se pudo registrar la sesión %s del pedido %s", session_id, pedido_id)
+        messages.error(
             request,
             "Pago aprobado en Stripe, pero no se pudo insertar el registro. "
-            "Si no aparece en la lista, regístralo manualmente con la referencia."
+            "Regístralo manualmente con la referencia."
         )
 
     return redirect("pedido_detalle", pedido_id=pedido_id)
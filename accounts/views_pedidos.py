@@ -4,7 +4,7 @@ from decimal import Decimal
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.core.paginator import Paginator
-from django.db import connection, models, transaction
+from django.db import IntegrityError, connection, models, transaction
 from django.db.models import F, Q, Value
 from django.db.models.functions import Coalesce, NullIf, Trim
 from django.shortcuts import get_object_or_404, redirect, render
@@ -17,6 +17,10 @@ from .models_db import (
     Pago,
 )
 from .permissions import requiere_permiso, owner_or_staff_pedido
+from . import services_checkout, services_despacho, services_eventos, services_reservas
+from .services_descuentos import guardar_descuento, mejor_descuento
+from .services_pagos import anotar_saldos
+from .utils import ER_DUP_ENTRY
 
 
 # ============================
@@ -64,6 +68,9 @@ def _recalcular_total(pedido_id: int):
             SET p.total = x.items + p.costo_envio - COALESCE(d.descuentos, 0)
             WHERE p.id = %s
         """, [pedido_id, pedido_id, pedido_id])
+    # El saldo cambió: las sesiones de checkout abiertas ya no sirven
+    services_checkout.invalidar(pedido_id)
+    services_despacho.sincronizar(pedido_id)
 
 
 
@@ -172,33 +179,57 @@ def pedido_editar(request, pedido_id):
 
             items.append((pid, sid, cant, prec))
 
-        with transaction.atomic():
-            with connection.cursor() as cur:
-                if items:
-                    cur.execute(
-                        """
-                        DELETE FROM detalle_pedido
-                        WHERE pedido_id=%s
-                          AND (producto_id, sabor_id) NOT IN (
-                             """ + ",".join(["(%s,%s)"] * len(items)) + """
-                          )
-                        """,
-                        [pedido.id] + [x for t in [(p, s) for p, s, _, _ in items] for x in t]
-                    )
-                else:
-                    cur.execute("DELETE FROM detalle_pedido WHERE pedido_id=%s", [pedido.id])
-
-                for p_id, s_id, cant, pu in items:
-                    cur.execute("""
-                    INSERT INTO detalle_pedido
-                      (pedido_id, producto_id, sabor_id, cantidad, precio_unitario)
-                    VALUES (%s, %s, %s, %s, %s)
-                    ON DUPLICATE KEY UPDATE
-                       cantidad=VALUES(cantidad),
-                       precio_unitario=VALUES(precio_unitario)
-                    """, [pedido.id, p_id, s_id, str(cant), str(pu)])
+        # Filas repetidas del mismo (producto, sabor) son una sola línea de
+        # detalle_pedido: se suman las cantidades y vale el último precio
+        lineas = {}
+        for pid, sid, cant, prec in items:
+            previa = lineas.get((pid, sid))
+            lineas[(pid, sid)] = ((previa[0] if previa else 0) + cant, prec)
+        items = [(pid, sid, cant, prec) for (pid, sid), (cant, prec) in lineas.items()]
+
+        # Total final en memoria: items + envío - el mayor entre el mejor
+        # descuento activo y los que ya tiene el pedido
+        base = sum((c * u for _, _, c, u in items), Decimal("0")) + Decimal(pedido.costo_envio or 0)
+        regla, monto = mejor_descuento(base)
 
-            _recalcular_total(pedido.id)
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cur:
+                    if items:
+                        cur.execute(
+                            """
+                            DELETE FROM detalle_pedido
+                            WHERE pedido_id=%s
+                              AND (producto_id, sabor_id) NOT IN (
+                                 """ + ",".join(["(%s,%s)"] * len(items)) + """
+                              )
+                            """,
+                            [pedido.id] + [x for t in [(p, s) for p, s, _, _ in items] for x in t]
+                        )
+                    else:
+                        cur.execute("DELETE FROM detalle_pedido WHERE pedido_id=%s", [pedido.id])
+
+                    for p_id, s_id, cant, pu in items:
+                        cur.execute("""
+                        INSERT INTO detalle_pedido
+                          (pedido_id, producto_id, sabor_id, cantidad, precio_unitario)
+                        VALUES (%s, %s, %s, %s, %s)
+                        ON DUPLICATE KEY UPDATE
+                           cantidad=VALUES(cantidad),
+                           precio_unitario=VALUES(precio_unitario)
+                        """, [pedido.id, p_id, s_id, str(cant), str(pu)])
+
+                    descuentos = guardar_descuento(pedido.id, regla, monto, base)
+                    cur.execute("UPDATE pedido SET total=%s WHERE id=%s",
+                                [str(base - descuentos), pedido.id])
+                # Las líneas cambiaron: rehace la reserva de insumos si está activa
+                if pedido.estado in services_reservas.ACTIVOS:
+                    services_reservas.reservar(pedido.id)
+                services_checkout.invalidar(pedido.id)
+                services_despacho.sincronizar(pedido.id)
+        except services_reservas.StockInsuficiente as e:
+            messages.error(request, f"No hay insumos para el pedido modificado: {e}.")
+            return redirect("pedido_editar", pedido_id=pedido.id)
 
         messages.success(request, "Pedido actualizado.")
         return redirect("pedido_detalle", pedido_id=pedido.id)
@@ -237,7 +268,7 @@ def pedidos_confirmados(request):
                 "estados_confirmados": ESTADOS,
             })
 
-    qs = qs.select_related("cliente", "cliente__usuario").annotate(
+    qs = qs.select_related("cliente", "cliente__usuario", "calificacion").annotate(
         cliente_nombre=Coalesce(
             NullIf(Trim(F("cliente__nombre")), Value("")),
             NullIf(Trim(F("cliente__usuario__nombre")), Value("")),
@@ -254,9 +285,11 @@ def pedidos_confirmados(request):
             qs = qs.filter(cliente_nombre__icontains=q)
 
     page_obj = Paginator(qs, 15).get_page(request.GET.get("page"))
+    # pagado/saldo de toda la página en una sola consulta
+    pedidos = anotar_saldos(page_obj.object_list, request)
 
     return render(request, "accounts/pedidos_confirmados.html", {
-        "pedidos": page_obj.object_list,
+        "pedidos": pedidos,
         "page_obj": page_obj,
         "q": q,
         "estados_confirmados": ESTADOS,
@@ -307,11 +340,23 @@ def pago_registrar(request, pedido_id):
         if not puede_cliente:
             app_user = Usuario.objects.order_by("id").first()
 
-        with connection.cursor() as cur:
-            cur.execute("""
-                INSERT INTO pago (pedido_id, metodo, monto, referencia, registrado_por_id, created_at)
-                VALUES (%s, %s, %s, %s, %s, NOW())
-            """, [pedido.id, metodo, str(monto), referencia or None, app_user.id])
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO pago (pedido_id, metodo, monto, referencia, registrado_por_id, created_at)
+                        VALUES (%s, %s, %s, %s, %s, NOW())
+                    """, [pedido.id, metodo, str(monto), referencia or None, app_user.id])
+                services_despacho.sincronizar(pedido.id)
+                services_eventos.registrar([pedido.id], services_eventos.PAGO)
+        except IntegrityError as e:
+            # ux_pago_referencia: la referencia ya está registrada en otro pago.
+            # Cualquier otro fallo de integridad (FK, NOT NULL) no es un duplicado.
+            if (e.args[0] if e.args else None) != ER_DUP_ENTRY:
+                raise
+            messages.error(request, "Ya existe un pago con esa referencia.")
+            return redirect("pago_registrar", pedido_id=pedido.id)
+        services_checkout.invalidar(pedido.id)
 
         messages.success(request, "Pago registrado.")
         return redirect("pedido_detalle", pedido_id=pedido.id)
@@ -355,8 +400,12 @@ def pedido_recibido(request, pedido_id):
         return redirect("pedidos_confirmados")
 
         # 4) Marcar como ENTREGADO
-    pedido.estado = "ENTREGADO"
-    pedido.save(update_fields=["estado"])
+    with transaction.atomic():
+        pedido.estado = "ENTREGADO"
+        pedido.save(update_fields=["estado"])
+        services_reservas.liberar([pedido.id])
+        services_despacho.sincronizar(pedido.id)
+        services_eventos.registrar([pedido.id], services_eventos.ESTADO)
 
     messages.success(
         request,
@@ -1,59 +1,15 @@
 from django.contrib.auth.decorators import login_required, permission_required
-from django.db import connection, transaction
+from django.db import transaction
 from django.shortcuts import get_object_or_404, render, redirect
 from django.contrib import messages
 
 
-from .models_db import Pedido, DetallePedido, Producto, Sabor, Insumo, Kardex
-from .models_recetas import Receta
-
-
-# Util: verificar stock de insumos para un producto
-from decimal import Decimal
-from django.db import connection
-
-def _insumos_necesarios(producto_id: int, cantidad_producto: int):
-    """
-    Devuelve los insumos requeridos para producir `cantidad_producto` unidades del producto,
-    junto con stock por kardex y faltante.
-    Requiere tablas: receta(producto_id, insumo_id, cantidad), insumo, kardex.
-    """
-    with connection.cursor() as cur:
-        cur.execute("""
-            SELECT
-                r.insumo_id                                AS insumo_id,
-                i.nombre                                   AS insumo,
-                i.unidad_medida                            AS um,
-                i.cantidad_disponible                      AS stock_db,
-                -- Stock por movimientos: entradas - salidas ± ajustes
-                COALESCE(SUM(
-                    CASE
-                        WHEN k.tipo = 'ENTRADA' THEN k.cantidad
-                        WHEN k.tipo = 'SALIDA'  THEN -k.cantidad
-                        WHEN k.tipo = 'AJUSTE'  THEN k.cantidad
-                        ELSE 0
-                    END
-                ), 0)                                       AS stock_kardex,
-                (r.cantidad * %s)                          AS necesario
-            FROM receta r
-            JOIN insumo i   ON i.id = r.insumo_id
-            LEFT JOIN kardex k ON k.insumo_id = r.insumo_id
-            WHERE r.producto_id = %s
-            GROUP BY r.insumo_id, i.nombre, i.unidad_medida, i.cantidad_disponible, r.cantidad
-            ORDER BY i.nombre
-        """, [cantidad_producto, producto_id])
-
-        cols = [c[0] for c in cur.description]
-        rows = [dict(zip(cols, r)) for r in cur.fetchall()]
-
-    # Calcula faltante (usa el mejor stock disponible)
-    for r in rows:
-        stock_ref = r["stock_kardex"] if r["stock_kardex"] is not None else 0
-        if not stock_ref:  # si kardex aún no tiene movimientos, usa el stock_db
-            stock_ref = r["stock_db"] or 0
-        r["faltante"] = max(Decimal(r["necesario"]) - Decimal(stock_ref), Decimal("0"))
-
-    return rows
+from .models_db import Pedido, DetallePedido
+from .permissions import requiere_permiso
+from . import (
+    services_despacho, services_eventos, services_insumos, services_horneado,
+    services_planificacion, services_produccion, services_reservas,
+)
 
 
 from django.contrib.auth.decorators import login_required
@@ -70,7 +26,6 @@ def pedidos_para_produccion(request):
     )
     return render(request, 'produccion/pedidos_para_produccion.html', {'pedidos': pedidos})
 
-from decimal import Decimal
 @login_required
 def gestionar_produccion(request, pedido_id: int):
     """
@@ -83,25 +38,34 @@ def gestionar_produccion(request, pedido_id: int):
              .select_related('producto', 'sabor')
              .order_by('producto_id', 'sabor_id'))
 
-    # Verificar insumos por cada ítem (agregamos un atributo calculado)
+    # Insumos de todas las líneas en una sola consulta
+    req = services_insumos.requerimientos([pedido_id])
+    producidas = services_produccion.lineas_producidas(pedido_id)
     verificados = []
     for it in items:
-        checks = _insumos_necesarios(it.producto_id, it.cantidad)
-        ok = all(Decimal(ch.get("faltante", 0)) <= 0 for ch in checks)
-        verificados.append((it, ok, checks))
+        checks = req.checks(pedido_id, it.producto_id, it.sabor_id)
+        verificados.append((it, req.linea_ok(pedido_id, it.producto_id, it.sabor_id), checks,
+                            (it.producto_id, it.sabor_id) in producidas))
 
     # Acciones de estado
     if request.method == 'POST':
         accion = request.POST.get('accion')
         if accion == 'en_produccion' and pedido.estado == 'CONFIRMADO':
-            Pedido.objects.filter(id=pedido.id).update(estado='EN_PRODUCCION')
+            with transaction.atomic():
+                Pedido.objects.filter(id=pedido.id).update(estado='EN_PRODUCCION')
+                services_despacho.sincronizar(pedido.id)
+                services_eventos.registrar([pedido.id], services_eventos.ESTADO)
             messages.success(request, 'Pedido pasado a EN_PRODUCCION.')
             return redirect('gestionar_produccion', pedido_id=pedido.id)
 
         if accion == 'listo_entrega' and pedido.estado in ['CONFIRMADO', 'EN_PRODUCCION']:
-            # Requiere que TODOS los ítems estén OK
-            if all(ok for _, ok, _ in verificados):
-                Pedido.objects.filter(id=pedido.id).update(estado='LISTO_ENTREGA')
+            # Requiere stock para la demanda sumada de TODOS los ítems
+            if req.ok:
+                with transaction.atomic():
+                    Pedido.objects.filter(id=pedido.id).update(estado='LISTO_ENTREGA')
+                    services_reservas.liberar([pedido.id])
+                    services_despacho.sincronizar(pedido.id)
+                    services_eventos.registrar([pedido.id], services_eventos.ESTADO)
                 messages.success(request, 'Pedido marcado como LISTO_ENTREGA.')
                 return redirect('gestionar_produccion', pedido_id=pedido.id)
             else:
@@ -109,103 +73,118 @@ def gestionar_produccion(request, pedido_id: int):
 
     return render(request, 'produccion/gestionar_produccion.html', {
         'pedido': pedido,
-        'verificados': verificados,  # [(detalle, ok_bool, [(insumo_id,nombre,req,stock,ok), ...])]
+        'verificados': verificados,  # [(detalle, ok_bool, [check, ...], producida)]
+        'faltantes': req.faltantes,  # por insumo, sumando todas las líneas
     })
 
 # accounts/views_produccion.py
-from decimal import Decimal
 from django.contrib import messages
-from django.db import connection, transaction
+from django.db import transaction
 from django.shortcuts import get_object_or_404, redirect
 
 @login_required
+@requiere_permiso("INVENTARIO_WRITE")
 def producir_item(request, pedido_id: int, producto_id: int, sabor_id: int):
     """
     Descuenta del stock (kardex SALIDA/CONSUMO) los insumos requeridos
     para el ítem (producto_id, sabor_id) del pedido indicado.
-    Soporta tanto 'checks' como lista de tuplas o de diccionarios.
     """
-    # 1) Obtener el item (único por pedido/producto/sabor)
-    item = get_object_or_404(
+    get_object_or_404(
         DetallePedido,
         pedido_id=pedido_id,
         producto_id=producto_id,
         sabor_id=sabor_id,
     )
-
-    # 2) Calcular insumos necesarios (ya incluye la cantidad del item)
-    checks = _insumos_necesarios(producto_id, item.cantidad)
-
-    # 3) Si falta algo, no descontamos
-    def hay_faltante(c):
-        if isinstance(c, dict):
-            # si viene como dict (nuestro formato nuevo)
-            return Decimal(str(c.get("faltante", "0"))) > 0
-        else:
-            # si viene como tupla: (id, nombre, [um], requerido, stock, ok, ...)
-            # tomamos requerido y stock de posiciones seguras
-            try:
-                requerido = Decimal(str(c[2]))  # si el formato era (id, nombre, requerido, stock, ok)
-                stock = Decimal(str(c[3]))
-            except Exception:
-                # formato extendido: (id, nombre, um, requerido, stock, ok, ...)
-                requerido = Decimal(str(c[3]))
-                stock = Decimal(str(c[4]))
-            return (requerido - stock) > 0
-
-    if any(hay_faltante(c) for c in checks):
-        messages.error(request, "No se puede descontar: hay insumos con faltantes.")
+    # Valida y descuenta bajo lock, contra lo disponible para prometer
+    try:
+        producida = services_produccion.producir_linea(pedido_id, producto_id, sabor_id)
+    except services_reservas.StockInsuficiente as e:
+        messages.error(request, f"No se puede descontar, faltan insumos: {e}.")
+        return redirect("gestionar_produccion", pedido_id=pedido_id)
+    if not producida:
+        # Una línea se descuenta una sola vez (y "Producir todo" la saltea)
+        messages.info(request, "Los insumos de este ítem ya se descontaron.")
         return redirect("gestionar_produccion", pedido_id=pedido_id)
-
-    # 4) Descontar en una transacción
-    with transaction.atomic():
-        with connection.cursor() as cur:
-            for c in checks:
-                # Normalizar a (insumo_id, requerido)
-                if isinstance(c, dict):
-                    # Formato dict
-                    insumo_id = c.get("insumo_id")
-                    if not insumo_id:
-                        # Si no vino el id, buscamos por nombre (último recurso)
-                        cur.execute("SELECT id FROM insumo WHERE nombre=%s LIMIT 1", [c["insumo"]])
-                        row = cur.fetchone()
-                        if not row:
-                            raise ValueError(f"No existe insumo '{c['insumo']}' en la base de datos.")
-                        insumo_id = row[0]
-                    requerido = Decimal(str(c["necesario"]))
-                else:
-                    # Formato tupla
-                    # Puede ser (id, nombre, requerido, stock, ok)  -> len>=5
-                    # o (id, nombre, um, requerido, stock, ok, ...) -> len>=6
-                    if len(c) >= 5:
-                        try:
-                            insumo_id, _nombre, requerido, _stock, _ok = c[:5]
-                            requerido = Decimal(str(requerido))
-                        except Exception:
-                            # Versión con 'um'
-                            insumo_id, _nombre, _um, requerido, _stock, *_rest = c
-                            requerido = Decimal(str(requerido))
-                    else:
-                        raise ValueError("Formato de 'checks' no reconocido.")
-
-                # Insertar movimiento en kardex (SALIDA / CONSUMO)
-                cur.execute(
-                    """
-                    INSERT INTO kardex(insumo_id, fecha, tipo, motivo, cantidad, observacion)
-                    VALUES (%s, NOW(), 'SALIDA', 'CONSUMO', %s, %s)
-                    """,
-                    [
-                        insumo_id,
-                        requerido,
-                        f"Pedido {pedido_id} – prod {producto_id}/{sabor_id} x{item.cantidad}",
-                    ],
-                )
-
-                # Actualizar stock del insumo
-                cur.execute(
-                    "UPDATE insumo SET cantidad_disponible = cantidad_disponible - %s WHERE id = %s",
-                    [requerido, insumo_id],
-                )
 
     messages.success(request, "Insumos descontados correctamente.")
     return redirect("gestionar_produccion", pedido_id=pedido_id)
+
+
+
+@login_required
+@requiere_permiso("INVENTARIO_WRITE")
+def producir_lote(request):
+    """Descuenta los insumos de todas las líneas de los pedidos marcados (POST)."""
+    if request.method != "POST":
+        return redirect("pedidos_para_produccion")
+    ids = [int(x) for x in request.POST.getlist("pedido_ids") if x.isdigit()]
+    res = services_produccion.producir_pedidos(ids)
+    if res["producidos"]:
+        nros = ", ".join(f"#{i}" for i in res["producidos"])
+        messages.success(request, f"Producidos y LISTO_ENTREGA: {nros}.")
+    for pid, motivo in res["rechazados"].items():
+        messages.error(request, f"Pedido #{pid} no producido: {motivo}.")
+    if len(ids) == 1:
+        return redirect("gestionar_produccion", pedido_id=ids[0])
+    return redirect("pedidos_para_produccion")
+
+def _plan_desde_request(request):
+    """Horizonte desde ?desde=YYYY-MM-DD&dias=N (por defecto, mañana)."""
+    from datetime import date
+    try:
+        desde = date.fromisoformat(request.GET.get("desde", ""))
+    except ValueError:
+        desde = None
+    try:
+        dias = min(max(int(request.GET.get("dias", 1)), 1), 31)
+    except ValueError:
+        dias = 1
+    return services_planificacion.planificar(desde, dias), dias
+
+
+@login_required
+@requiere_permiso("INVENTARIO_READ")
+def plan_produccion(request):
+    """Demanda total de insumos para las entregas del horizonte."""
+    plan, dias = _plan_desde_request(request)
+    return render(request, "produccion/plan_produccion.html", {"plan": plan, "dias": dias})
+
+
+@login_required
+@requiere_permiso("INVENTARIO_READ")
+def plan_produccion_csv(request):
+    import csv
+    from django.http import HttpResponse
+
+    plan, _dias = _plan_desde_request(request)
+    resp = HttpResponse(content_type="text/csv; charset=utf-8")
+    resp["Content-Disposition"] = f'attachment; filename="plan_insumos_{plan.desde:%Y%m%d}.csv"'
+    w = csv.writer(resp)
+    w.writerow(["Insumo", "Unidad", "Requerido", "Stock", "Faltante"])
+    for i in plan.insumos:
+        w.writerow([i["insumo"], i["um"], f"{i['requerido']:.3f}",
+                    f"{i['stock']:.3f}", f"{i['faltante']:.3f}"])
+    w.writerow([])
+    w.writerow(["Producto", "Demanda", "Máximo producible", "Insumo limitante"])
+    for p in plan.productos:
+        w.writerow([p["producto"], p["demanda"],
+                    "sin receta" if p["sin_receta"] else p["max_producible"],
+                    p["limitante"] or ""])
+    return resp
+
+
+@login_required
+@requiere_permiso("INVENTARIO_READ")
+def programa_horneado(request):
+    """Tandas de horno por producto × sabor para la semana (o ?desde=&dias=)."""
+    from datetime import date
+    try:
+        desde = date.fromisoformat(request.GET.get("desde", ""))
+    except ValueError:
+        desde = None
+    try:
+        dias = min(max(int(request.GET.get("dias", 7)), 1), 14)
+    except ValueError:
+        dias = 7
+    prog = services_horneado.programa(desde, dias)
+    return render(request, "produccion/programa_horneado.html", {"prog": prog, "dias": dias})
@@ -76,7 +76,7 @@ DATABASES = {
         'OPTIONS': {
             'init_command': "SET sql_mode='STRICT_TRANS_TABLES'",
             'ssl': {'ca': None}  
-        }
+        },
     }
 }
 
@@ -100,6 +100,34 @@ STATICFILES_DIRS = [BASE_DIR / "static"]
 
 STATIC_ROOT = BASE_DIR / 'staticfiles'  # ← NUEVA línea
 
+# PDFs de facturas (almacenados por hash de contenido)
+FACTURAS_PDF_DIR = Path(os.getenv("FACTURAS_PDF_DIR", BASE_DIR / "media" / "facturas"))
+FACTURAS_PDF_WORKERS = int(os.getenv("FACTURAS_PDF_WORKERS", "2"))
+# Serie de numeración de este despliegue (una por punto de venta)
+FACTURA_SERIE = os.getenv("FACTURA_SERIE", "F")
+
+# Punto de partida de las rutas de despacho (vacío = primera parada)
+DESPACHO_ORIGEN_LAT = os.getenv("DESPACHO_ORIGEN_LAT") or None
+DESPACHO_ORIGEN_LNG = os.getenv("DESPACHO_ORIGEN_LNG") or None
+# Geocoder de `manage.py geocodificar_direcciones` (vacío = sólo --csv),
+# p. ej. "accounts.geocoder.nominatim"; la ciudad se agrega a cada dirección
+DESPACHO_GEOCODER = os.getenv("DESPACHO_GEOCODER", "")
+DESPACHO_CIUDAD = os.getenv("DESPACHO_CIUDAD", "")
+
+# Programa de horneado (ver accounts/services_horneado.py)
+HORNO_CAPACIDAD = int(os.getenv("HORNO_CAPACIDAD", "48"))        # unidades por tanda
+HORNO_SLOT_MIN = int(os.getenv("HORNO_SLOT_MIN", "30"))          # minutos por tanda
+HORNO_INICIO = os.getenv("HORNO_INICIO", "07:00")
+HORNO_FIN = os.getenv("HORNO_FIN", "19:00")
+PROGRAMA_VENTANA_H = int(os.getenv("PROGRAMA_VENTANA_H", "4"))   # agrupa entregas por bloques de N horas
+PROGRAMA_ANTICIPACION_MIN = int(os.getenv("PROGRAMA_ANTICIPACION_MIN", "60"))
+
+# Eventos SSE de pedidos: con más de un worker, cada uno lee de la BD los
+# eventos de los demás cada EVENTOS_POLL_S segundos (0 = sólo en proceso)
+EVENTOS_POLL_S = float(os.getenv("EVENTOS_POLL_S", "0"))
+# Días que se guardan en pedido_evento para reponer reconexiones (comando podar_eventos)
+EVENTOS_RETENCION_DIAS = int(os.getenv("EVENTOS_RETENCION_DIAS", "7"))
+
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 # Auth redirects
@@ -118,6 +146,15 @@ STRIPE_PUBLIC_KEY = os.getenv("STRIPE_PUBLIC_KEY", "")
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY", "")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET", "")
 
+# Cliente Stripe compartido (ver accounts/stripe_service.py)
+STRIPE_CONNECT_TIMEOUT = float(os.getenv("STRIPE_CONNECT_TIMEOUT", "3"))
+STRIPE_READ_TIMEOUT = float(os.getenv("STRIPE_READ_TIMEOUT", "10"))
+STRIPE_MAX_NETWORK_RETRIES = int(os.getenv("STRIPE_MAX_NETWORK_RETRIES", "2"))
+STRIPE_POOL_MAXSIZE = int(os.getenv("STRIPE_POOL_MAXSIZE", "10"))
+# "" = HTTP real con pool; "local" = stand-in en memoria; o ruta a una clase HTTPClient
+STRIPE_HTTP_CLIENT = os.getenv("STRIPE_HTTP_CLIENT", "")
+STRIPE_LOCAL_FIXTURE = os.getenv("STRIPE_LOCAL_FIXTURE", "")  # JSON de sesiones para el stand-in
+
 # Moneda & dominio
 CURRENCY = os.getenv("CURRENCY", "BOB")
 SITE_URL = os.getenv("SITE_URL", "http://localhost:8000")
@@ -0,0 +1,16 @@
+# core/settings_test.py
+"""
+Settings para correr los tests:
+
+    python manage.py test --settings=core.settings_test
+
+Las tablas legadas (managed=False) no existen en la BD de tests, así que
+no se corren las migraciones RunSQL que las alteran; cada clase de test
+crea las tablas mínimas que necesita (ver accounts.tests.TablasLegadasTestCase).
+"""
+from .settings import *  # noqa: F401,F403
+
+DATABASES["default"]["TEST"] = {"MIGRATE": False}  # noqa: F405
+
+# Checkout sin red (stand-in en memoria de accounts/stripe_local.py)
+STRIPE_HTTP_CLIENT = "local"
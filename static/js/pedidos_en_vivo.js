@@ -0,0 +1,24 @@
+// Cambios de pedidos en vivo (SSE: /eventos/pedidos/).
+// <div data-eventos-url="..."> activa el stream en la página.
+// - [data-pedido-estado="ID"] se actualiza con el nuevo estado.
+// - data-recargar en el contenedor: la lista se recarga (agrupando eventos).
+(function () {
+  var cont = document.querySelector("[data-eventos-url]");
+  if (!cont || !window.EventSource) return;
+
+  var recargar = cont.hasAttribute("data-recargar");
+  var pendiente = null;
+  var es = new EventSource(cont.getAttribute("data-eventos-url"));
+
+  es.addEventListener("pedido", function (e) {
+    var ev = JSON.parse(e.data);
+    document.querySelectorAll('[data-pedido-estado="' + ev.pedido_id + '"]').forEach(function (n) {
+      n.textContent = ev.estado;
+    });
+    if (recargar && !pendiente) {
+      pendiente = setTimeout(function () { window.location.reload(); }, 1000);
+    }
+  });
+
+  es.addEventListener("recargar", function () { window.location.reload(); });
+})();